@@ -0,0 +1,145 @@
+"""
+一括回答 - JSONL形式の質問をまとめて検索・回答し、完了した順にJSONLで書き出す
+（コーパス更新後の回答品質チェック用。最後にスループットと段階ごとのレイテンシを表示）
+
+入力: 1行1問 {"question": ..., "microcontroller": ..., "id": ...}（microcontroller・idは省略可）
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import contextlib
+from typing import List, Dict, Tuple
+
+# パス設定
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from config import Config
+from models.simple_vector_db import SimpleVectorDatabase
+from models.simple_rag_engine import SimpleRAGEngine
+
+# 結果出力を見やすくするため、各モジュールのINFOログは抑制
+logging.getLogger().setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+def load_questions(path: str) -> List[Dict]:
+    """JSONL形式の質問を読み込む（"-"で標準入力）"""
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        questions = [json.loads(line) for line in f if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return [item for item in questions if item.get("question")]
+
+def percentile(values: List[float], q: float) -> float:
+    """最近傍順位法によるパーセンタイル"""
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] if values else 0.0
+
+def print_report(results: List[Dict], elapsed: float):
+    """スループットと段階ごとのレイテンシ（p50/p90/p99）を標準エラーに表示"""
+    count = len(results)
+    print(f"{count} questions in {elapsed:.2f} s ({count / elapsed if elapsed else 0.0:.2f} questions/s)",
+          file=sys.stderr)
+    print(f"{'stage':<12} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}", file=sys.stderr)
+    for stage in ("retrieval", "generation", "end_to_end"):
+        values = [result["timings"][stage] for result in results]
+        row = " ".join(f"{percentile(values, q) * 1000:>9.1f}" for q in (0.5, 0.9, 0.99))
+        print(f"{stage:<12} {row} {max(values, default=0.0) * 1000:>9.1f}", file=sys.stderr)
+
+async def answer_all(engine: SimpleRAGEngine, questions: List[Dict], output, args) -> List[Dict]:
+    """完了した順に結果を書き出す"""
+    results = []
+    async for result in engine.answer_questions_batch_async(
+        questions, num_docs=args.num_docs, timeout=args.timeout, batch_size=args.batch_size
+    ):
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+        results.append(result)
+    return results
+
+def write_openai_batch(engine: SimpleRAGEngine, questions: List[Dict], output, args,
+                       fallback_output=None) -> Tuple[int, int]:
+    """検索だけ行い、OpenAI Batch APIの入力ファイルを書き出す
+    
+    関連ドキュメントが見つからない質問はリクエストにせず、対話時と同じ回答を
+    fallback_outputに書き出す（省略時は件数のみ表示）。(リクエスト数, 除外した質問数)を返す
+    """
+    batch_size = args.batch_size or Config.BATCH_RETRIEVAL_SIZE
+    written = skipped = 0
+    for start in range(0, len(questions), batch_size):
+        chunk = questions[start:start + batch_size]
+        microcontrollers = [item.get("microcontroller") or "NUCLEO-F767ZI" for item in chunk]
+        found = engine.search_batch([item["question"] for item in chunk], args.num_docs, microcontrollers)
+        for offset, (item, relevant_docs, microcontroller) in enumerate(zip(chunk, found, microcontrollers)):
+            custom_id = item.get("id", start + offset)
+            if not relevant_docs:
+                skipped += 1
+                if fallback_output is not None:
+                    result = dict(engine.no_context_answer(microcontroller),
+                                  index=start + offset, id=custom_id, question=item["question"])
+                    fallback_output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                continue
+            request = engine.openai_batch_request(custom_id, item["question"], relevant_docs, microcontroller)
+            output.write(json.dumps(request, ensure_ascii=False) + "\n")
+            written += 1
+    return written, skipped
+
+def main():
+    """メイン実行"""
+    parser = argparse.ArgumentParser(description="Batch question answering for offline evaluation runs")
+    parser.add_argument("questions", help="JSONL形式の質問ファイル（-で標準入力）")
+    parser.add_argument("--output", "-o", help="結果のJSONL（省略時は標準出力）")
+    parser.add_argument("--index", help="インデックスディレクトリ（省略時は既定のベクトルDB）")
+    parser.add_argument("--num-docs", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, help="同時に実行するLLM呼び出し数")
+    parser.add_argument("--timeout", type=float, help="1回のLLM呼び出しのタイムアウト（秒）")
+    parser.add_argument("--batch-size", type=int, help="1回の検索にまとめる質問数")
+    parser.add_argument("--template-only", action="store_true", help="OpenAIを使わずテンプレート回答のみ")
+    parser.add_argument("--openai-batch", action="store_true",
+                        help="回答せず、OpenAI Batch APIの入力ファイル（/v1/chat/completions）を書き出す")
+    parser.add_argument("--fallback-output",
+                        help="--openai-batchで関連ドキュメントがなくリクエストにしなかった質問の回答（JSONL）")
+    args = parser.parse_args()
+    
+    if args.concurrency:
+        Config.ASYNC_MAX_CONCURRENCY = args.concurrency
+    
+    questions = load_questions(args.questions)
+    if not questions:
+        print("No questions found.", file=sys.stderr)
+        return
+    
+    # 設定読み込み時のメッセージで標準出力のJSONLが崩れないよう、初期化中の出力は標準エラーへ
+    with contextlib.redirect_stdout(sys.stderr):
+        engine = SimpleRAGEngine(SimpleVectorDatabase(args.index), use_openai=not args.template_only)
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        if args.openai_batch:
+            fallback_output = open(args.fallback_output, "w", encoding="utf-8") if args.fallback_output else None
+            try:
+                count, skipped = write_openai_batch(engine, questions, output, args, fallback_output)
+            finally:
+                if fallback_output is not None:
+                    fallback_output.close()
+            print(f"Wrote {count} batch requests", file=sys.stderr)
+            if skipped:
+                print(f"Skipped {skipped} questions with no relevant documents"
+                      + (f" (answers written to {args.fallback_output})" if args.fallback_output else ""),
+                      file=sys.stderr)
+            return
+        
+        started = time.perf_counter()
+        results = asyncio.run(answer_all(engine, questions, output, args))
+        print_report(results, time.perf_counter() - started)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == "__main__":
+    main()
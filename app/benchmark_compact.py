@@ -0,0 +1,84 @@
+"""
+省メモリベクトルストアの評価 - int8 / float16 のrecall@k・メモリ・検索時間をfloat32の厳密検索と比較
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import numpy as np
+
+# パス設定
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from config import Config
+from models.compact_vector_db import CompactVectorDatabase
+
+# 計測結果を見やすくするため、各モジュールのINFOログは抑制
+logging.getLogger().setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+def synthetic_embeddings(num_vectors: int, dim: int, num_queries: int, seed: int = 0):
+    """クラスタ構造を持つ合成埋め込み（モデルなしで量子化誤差を見るため）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(num_vectors // 50, 1), dim)).astype(np.float32)
+    assignments = rng.integers(0, len(centers), size=num_vectors + num_queries)
+    vectors = centers[assignments] + 0.5 * rng.normal(size=(num_vectors + num_queries, dim)).astype(np.float32)
+    return vectors[:num_vectors], vectors[num_vectors:]
+
+def document_embeddings(files, num_queries: int):
+    """実際のドキュメントを埋め込み、一部のチャンクをクエリとして使う"""
+    from services.document_processor import DocumentProcessor
+    from models.vector_db_offline import create_offline_embeddings
+    
+    documents = DocumentProcessor().create_documents(files)
+    with tempfile.TemporaryDirectory() as temp_directory:
+        model = create_offline_embeddings(temp_directory)
+        vectors = np.asarray(model.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)]
+    return vectors, queries
+
+def main():
+    """メイン実行"""
+    parser = argparse.ArgumentParser(description="Compact vector store recall / memory benchmark")
+    parser.add_argument("files", nargs="*", help="埋め込むPDF/テキスト（省略時は合成データ）")
+    parser.add_argument("--vectors", type=int, default=20000, help="合成データのベクトル数")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    
+    if args.files:
+        vectors, queries = document_embeddings(args.files, args.queries)
+    else:
+        vectors, queries = synthetic_embeddings(args.vectors, args.dim, args.queries)
+    print(f"{len(vectors)} vectors x {vectors.shape[1]} dims, {len(queries)} queries, k={args.k}")
+    
+    # float32の厳密検索（基準）
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    start = time.perf_counter()
+    for query in queries:
+        np.argpartition(-(normalized @ query), args.k)[:args.k]
+    float_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"{'float32':<8} recall 1.000  memory {normalized.nbytes / 1e6:8.2f} MB  {float_ms:6.2f} ms/query")
+    
+    for dtype in ("int8", "float16"):
+        with tempfile.TemporaryDirectory() as temp_directory:
+            store = CompactVectorDatabase(temp_directory, dtype=dtype, embedding_model=object())
+            store.add_embeddings(vectors, [""] * len(vectors), [{} for _ in range(len(vectors))])
+            
+            start = time.perf_counter()
+            for query in queries:
+                store.search_by_vector(query, args.k)
+            search_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            
+            report = store.recall_report(vectors, queries, args.k)
+            print(f"{dtype:<8} recall {report['recall']:.3f}  memory {report['memory']['total'] / 1e6:8.2f} MB  "
+                  f"{search_ms:6.2f} ms/query  (min recall {report['min_recall']:.2f}, "
+                  f"max score error {report['max_score_error']:.4f})")
+
+if __name__ == "__main__":
+    main()
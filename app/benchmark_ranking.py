@@ -0,0 +1,123 @@
+"""
+ランキング方式のオフライン評価 - 固定クエリセットでTF-IDF / BM25 / BM25+ の precision@k を比較
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+import tempfile
+from typing import List, Dict, Optional
+
+# パス設定
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from langchain.schema import Document
+from config import Config
+from models.simple_vector_db import SimpleVectorDatabase
+from services.document_processor import DocumentProcessor
+
+# 計測結果を見やすくするため、各モジュールのINFOログは抑制
+logging.getLogger().setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+RANKINGS = ["tfidf", "bm25", "bm25+"]
+
+# 固定クエリセット（STM32 / NUCLEO マニュアル向け）
+# relevantは本文（小文字化）に対する判定条件: contains_allをすべて含み、contains_anyのいずれかを含むチャンクを正解とする
+# chunk_idsを指定した場合はそのチャンクのみを正解とする
+DEFAULT_JUDGMENTS = [
+    {"query": "GPIO 出力 設定 HAL_GPIO_WritePin", "relevant": {"contains_any": ["hal_gpio_writepin", "gpio_mode_output"]}},
+    {"query": "UART ボーレート 設定", "relevant": {"contains_any": ["baud"]}},
+    {"query": "UART 受信 割り込み", "relevant": {"contains_any": ["hal_uart_receive_it", "rxne"]}},
+    {"query": "PWM タイマー デューティ比", "relevant": {"contains_all": ["pwm"]}},
+    {"query": "ADC DMA 変換", "relevant": {"contains_all": ["adc", "dma"]}},
+    {"query": "ST-LINK デバッガ 接続", "relevant": {"contains_any": ["st-link", "stlink"]}},
+    {"query": "SWD デバッグ インターフェース", "relevant": {"contains_any": ["swd", "serial wire"]}},
+    {"query": "外部クロック HSE 水晶", "relevant": {"contains_any": ["hse"]}},
+    {"query": "USB OTG コネクタ", "relevant": {"contains_all": ["usb"], "contains_any": ["otg"]}},
+    {"query": "Ethernet RMII PHY", "relevant": {"contains_any": ["rmii"]}},
+    {"query": "電源 供給 VIN E5V", "relevant": {"contains_any": ["vin", "e5v"]}},
+    {"query": "ユーザーLED LD1 LD2 LD3", "relevant": {"contains_any": ["ld1", "ld2", "ld3"]}},
+    {"query": "STM32CubeMX プロジェクト 生成", "relevant": {"contains_any": ["cubemx"]}},
+    {"query": "NVIC 割り込み 優先度", "relevant": {"contains_any": ["nvic", "priority"]}},
+]
+
+def load_judgments(path: Optional[str]) -> List[Dict]:
+    """JSONL形式（1行1クエリ）の正解データを読み込む。省略時は固定クエリセット"""
+    if not path:
+        return DEFAULT_JUDGMENTS
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def is_relevant(doc: Document, relevant: Dict) -> bool:
+    """チャンクが正解条件を満たすか"""
+    if "chunk_ids" in relevant:
+        return doc.metadata.get("chunk_id") in relevant["chunk_ids"]
+    content = doc.page_content.lower()
+    if not all(term in content for term in relevant.get("contains_all", [])):
+        return False
+    any_terms = relevant.get("contains_any")
+    return not any_terms or any(term in content for term in any_terms)
+
+def evaluate(vector_db: SimpleVectorDatabase, judgments: List[Dict], ranking: str, ks: List[int]) -> Dict:
+    """1つのランキング方式について precision@k・MRR・上位チャンクの平均長を計算"""
+    max_k = max(ks)
+    precision = {k: 0.0 for k in ks}
+    reciprocal_rank = 0.0
+    retrieved_lengths = []
+    
+    for judgment in judgments:
+        results = vector_db.search_similar_documents(
+            judgment["query"], k=max_k, score_threshold=0.0, ranking=ranking
+        )
+        hits = [is_relevant(doc, judgment["relevant"]) for doc, _ in results]
+        
+        for k in ks:
+            precision[k] += sum(hits[:k]) / k
+        reciprocal_rank += next((1.0 / (rank + 1) for rank, hit in enumerate(hits) if hit), 0.0)
+        retrieved_lengths.extend(len(doc.page_content) for doc, _ in results[:min(ks)])
+    
+    num_queries = len(judgments)
+    return {
+        "ranking": ranking,
+        "precision": {k: value / num_queries for k, value in precision.items()},
+        "mrr": reciprocal_rank / num_queries,
+        "avg_retrieved_chars": sum(retrieved_lengths) / len(retrieved_lengths) if retrieved_lengths else 0.0,
+    }
+
+def main():
+    """メイン実行"""
+    parser = argparse.ArgumentParser(description="SimpleVectorDatabase ranking relevance benchmark")
+    parser.add_argument("files", nargs="*", help="評価に使うPDF/テキスト（省略時はドキュメントフォルダ）")
+    parser.add_argument("--index", help="既存のインデックスディレクトリを使う（filesより優先）")
+    parser.add_argument("--judgments", help="JSONL形式の正解データ {\"query\": ..., \"relevant\": {...}}")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--rankings", nargs="+", default=RANKINGS)
+    args = parser.parse_args()
+    
+    judgments = load_judgments(args.judgments)
+    
+    with tempfile.TemporaryDirectory() as temp_directory:
+        if args.index:
+            vector_db = SimpleVectorDatabase(args.index)
+        else:
+            processor = DocumentProcessor()
+            files = args.files or processor._find_supported_files(Config.DOCUMENT_PATH)
+            if not files:
+                print("No documents found. Pass PDF paths or --index.")
+                return
+            vector_db = SimpleVectorDatabase(temp_directory)
+            vector_db.add_documents(processor.create_documents(files))
+        
+        print(f"{len(vector_db.documents)} chunks, {len(judgments)} queries")
+        header = " ".join(f"{'P@' + str(k):>7}" for k in args.k)
+        print(f"{'ranking':<8} {header} {'MRR':>7} {'avg chars@' + str(min(args.k)):>14}")
+        for ranking in args.rankings:
+            result = evaluate(vector_db, judgments, ranking, args.k)
+            precision = " ".join(f"{result['precision'][k]:>7.3f}" for k in args.k)
+            print(f"{ranking:<8} {precision} {result['mrr']:>7.3f} {result['avg_retrieved_chars']:>14.0f}")
+
+if __name__ == "__main__":
+    main()
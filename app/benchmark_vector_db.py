@@ -0,0 +1,113 @@
+"""
+SimpleVectorDatabase ベンチマーク - 格納方式ごとの速度とメモリ使用量を比較
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from typing import List, Dict
+
+# パス設定
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from langchain.schema import Document
+from models.simple_vector_db import SimpleVectorDatabase
+
+# 計測結果を見やすくするため、各モジュールのINFOログは抑制
+logging.getLogger().setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# 合成コーパス用の語彙（STM32マニュアル頻出語 + ランダム語）
+BASE_TERMS = [
+    "gpio", "uart", "usart", "pwm", "timer", "adc", "dac", "dma", "spi", "i2c", "can",
+    "hal_gpio_writepin", "hal_uart_transmit", "hal_tim_pwm_start", "hal_adc_start",
+    "clock", "interrupt", "nvic", "register", "peripheral", "cubemx", "nucleo",
+    "割り込み", "設定", "クロック", "通信", "初期化", "ピン", "タイマー", "変換"
+]
+
+QUERIES = [
+    "GPIO LED HAL_GPIO_WritePin",
+    "UART 通信 設定 baud",
+    "PWM timer duty HAL_TIM_PWM_Start",
+    "ADC DMA 変換",
+    "割り込み NVIC priority",
+    "SPI I2C peripheral clock",
+]
+
+def build_corpus(num_docs: int, seed: int = 42) -> List[Document]:
+    """Zipf分布に近い語彙分布を持つ合成チャンクを生成"""
+    rng = random.Random(seed)
+    vocabulary = BASE_TERMS + [f"term{i:05d}" for i in range(20000)]
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    
+    documents = []
+    for i in range(num_docs):
+        words = rng.choices(vocabulary, weights=weights, k=rng.randint(60, 160))
+        documents.append(Document(
+            page_content=" ".join(words),
+            metadata={
+                "filename": f"synthetic_{i // 50}.pdf",
+                "category": rng.choice(["hardware", "application_note", "user_manual"]),
+            }
+        ))
+    return documents
+
+def benchmark_backend(backend: str, documents: List[Document], repeat: int) -> Dict:
+    """1つの格納方式について構築時間・メモリ・検索レイテンシを計測"""
+    with tempfile.TemporaryDirectory() as persist_directory:
+        tracemalloc.start()
+        baseline, _ = tracemalloc.get_traced_memory()
+        
+        start = time.perf_counter()
+        vector_db = SimpleVectorDatabase(persist_directory, backend=backend)
+        vector_db.add_documents(documents)
+        vector_db.search_similar_documents(QUERIES[0], k=5)  # 遅延再計算を含める
+        build_seconds = time.perf_counter() - start
+        
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        
+        latencies = []
+        for _ in range(repeat):
+            for query in QUERIES:
+                start = time.perf_counter()
+                vector_db.search_similar_documents(query, k=5, category="hardware")
+                latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        
+        return {
+            "backend": backend,
+            "documents": len(documents),
+            "build_seconds": build_seconds,
+            # ドキュメント本文を含むストア全体の保持メモリ
+            "index_memory_mb": (current - baseline) / (1024 * 1024),
+            "query_p50_ms": latencies[len(latencies) // 2] * 1000,
+            "query_p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        }
+
+def main():
+    """メイン実行"""
+    parser = argparse.ArgumentParser(description="SimpleVectorDatabase backend benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--backends", nargs="+", default=["dict", "sparse"])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    
+    print(f"{'backend':<8} {'docs':>8} {'build[s]':>10} {'memory[MB]':>12} {'p50[ms]':>9} {'p95[ms]':>9}")
+    for size in args.sizes:
+        documents = build_corpus(size)
+        for backend in args.backends:
+            copies = [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in documents]
+            result = benchmark_backend(backend, copies, args.repeat)
+            print(
+                f"{result['backend']:<8} {result['documents']:>8} {result['build_seconds']:>10.2f} "
+                f"{result['index_memory_mb']:>12.1f} {result['query_p50_ms']:>9.2f} {result['query_p95_ms']:>9.2f}"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -56,7 +56,7 @@ class Config:
         env_key = os.getenv("OPENAI_API_KEY", "")
         if env_key:
             return env_key
-            
+        
         # 最後のフォールバック：直接ファイル読み取り
         try:
             secrets_path = os.path.join(os.path.dirname(__file__), "..", ".streamlit", "secrets.toml")
@@ -79,20 +79,75 @@ class Config:
     # ベクトルデータベース設定
     VECTOR_DB_TYPE = "chromadb"  # chromadb or faiss
     VECTOR_DB_PATH = "../data/vector_store"
+    SIMPLE_VECTOR_BACKEND = "dict"  # dict or sparse（SimpleVectorDatabaseの格納方式）
+    SIMPLE_INDEX_WRITE_MODE = "snapshot"  # snapshot（毎回全体を書き直す） or append（バッチごとにセグメント追記）
+    SIMPLE_INDEX_COMPACTION_TRIGGER = 4  # append時、セグメント数がこの値以上でコンパクション
+    SIMPLE_INDEX_SMALL_SEGMENT_DOCS = 2000  # この件数未満のセグメントをマージ対象とする
+    SIMPLE_TOKENIZER = "simple-bigram"  # トークナイザー名（インデックスに記録され、異なる場合は再構築）
+    SIMPLE_TOKEN_INTERNING = False  # Trueで辞書バックエンドのトークン文字列をチャンク間で共有
+    SHARD_MAX_LOADED = 4  # ShardedVectorDatabaseで同時にメモリに置くシャード数（超えたらLRUで解放）
+    SHARD_IDLE_SECONDS = 1800  # この秒数使われていないシャードは解放（0で無効）
+    SIMPLE_RANKING = "tfidf"  # 既定のランキング: tfidf（コサイン類似度） / bm25 / bm25+
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+    BM25_DELTA = 1.0  # BM25+の下限補正
+    HYBRID_FUSION = "rrf"  # ハイブリッド検索の統合方式: rrf（Reciprocal Rank Fusion） / weighted（正規化スコアの加重和）
+    HYBRID_RRF_K = 60
+    HYBRID_LEXICAL_WEIGHT = 1.0
+    HYBRID_SEMANTIC_WEIGHT = 1.0
+    HYBRID_CANDIDATE_MULTIPLIER = 4  # 各ストアからk×この件数の候補を取得して統合
+    HYBRID_SEARCH_TIMEOUT = 10  # 各ストアの検索待ち時間（秒）。超過したストアの結果は使わない
     CHUNK_SIZE = 1000
     CHUNK_OVERLAP = 200
+    CHUNK_STREAM_WINDOW = 8  # ストリーミングチャンク化の作業バッファ（CHUNK_SIZEの倍数）
+    CONTEXT_NEIGHBOR_WINDOW = 0  # 回答生成時にヒットの前後何チャンクを結合するか（0で無効）
+    CONTEXT_TOKEN_BUDGET = 1200  # 回答生成プロンプトに入れる参考文書のトークン数の上限
+    CODE_CONTEXT_TOKEN_BUDGET = 800  # コード生成プロンプトに入れる参考文書のトークン数の上限
+    PROMPT_CACHE_MIN_PREFIX_TOKENS = 1024  # プロバイダーのプロンプトキャッシュが効く固定の先頭部分の最小トークン数
     
     # 埋め込みモデル設定（OpenAI Embeddings使用）
     EMBEDDING_MODEL = "text-embedding-3-small"
+    OFFLINE_EMBEDDING_MODEL = "all-MiniLM-L6-v2"  # オフライン版（sentence-transformers）
+    EMBEDDING_BATCH_SIZE = 64  # エンコーダーに一度に渡すチャンク数
+    EMBEDDING_THREADS = 0  # エンコーダーのCPUスレッド数（0でtorchの既定値）
+    EMBEDDING_CACHE_ENABLED = True
+    EMBEDDING_CACHE_FILE = "embedding_cache.sqlite3"  # 本文ハッシュ -> 埋め込みのキャッシュ（ベクトルDBと同じ場所）
+    COMPACT_VECTOR_DTYPE = "int8"  # CompactVectorDatabaseの格納形式: int8（ベクトルごとのスケール付き） / float16
+    COMPACT_SEARCH_BLOCK = 512  # 検索時にfloat32へ戻して内積を取る行数
+    OFFLINE_EMBEDDING_WARMUP = False  # Trueで作成直後にバックグラウンドでモデルを読み込む（既定は初回の埋め込み計算時）
     
     # LLM設定
     LLM_MODEL = "gpt-3.5-turbo"
     LLM_TEMPERATURE = 0.7
     MAX_TOKENS = 2000
+    ASYNC_MAX_CONCURRENCY = 8  # 非同期APIで同時に実行するLLM呼び出し数
+    ASYNC_LLM_TIMEOUT = 60  # 非同期APIのLLM呼び出しタイムアウト（秒）
+    ASYNC_RETRIEVAL_WORKERS = 4  # 非同期APIで検索を実行するスレッド数
+    BATCH_RETRIEVAL_SIZE = 64  # 一括回答で1回の検索にまとめる質問数
+    
+    # クエリキャッシュ設定（検索結果・回答）
+    QUERY_CACHE_ENABLED = True
+    RETRIEVAL_CACHE_SIZE = 512
+    RETRIEVAL_CACHE_TTL = 3600  # 秒
+    ANSWER_CACHE_SIZE = 256
+    ANSWER_CACHE_TTL = 86400  # 秒
+    ANSWER_CACHE_PERSIST = False  # Trueで回答キャッシュをdata/cacheに保存
+    ANSWER_CACHE_FLUSH_INTERVAL = 5  # 回答キャッシュを保存する間隔（秒、変更があった場合のみ。0で変更のたびに保存）
+    SEMANTIC_CACHE_ENABLED = False  # 言い換えた質問にも回答キャッシュを使う（answer_question）
+    SEMANTIC_CACHE_SIZE = 256
+    SEMANTIC_CACHE_TTL = 86400  # 秒
+    SEMANTIC_CACHE_THRESHOLD = 0.9  # 質問の類似度（埋め込みまたは内容語のコサイン類似度）がこの値以上なら同じ質問とみなす
+    SEMANTIC_CACHE_EMBEDDINGS = True  # オフラインの埋め込みモデルがあれば質問の類似度に使う（なければ内容語）
+    SEMANTIC_CACHE_SHORT_QUESTION_TERMS = 3  # 内容語がこの数以下の質問は内容語が完全一致する場合のみ同じ質問とみなす
     
     # ドキュメント設定
     DOCUMENT_PATH = "../data/documents"
     SUPPORTED_FORMATS = [".pdf", ".txt", ".md"]
+    PDF_EXTRACTION_WORKERS = 0  # PDF抽出のプロセス数（0でCPUコア数、1で逐次処理）
+    PDF_PAGES_PER_TASK = 8  # 1タスクで抽出するページ数
+    PDF_PAGE_TIMEOUT = 30  # 1ページあたりの抽出タイムアウト（秒、0で無制限）
+    PDF_EXTRACTION_START_METHOD = "spawn"  # ワーカープロセスの起動方式（spawn / forkserver。スレッドのあるプロセスでforkは使わない）
+    INGESTION_MANIFEST_FILE = "ingestion_manifest.json"  # 取り込み済みファイルの記録（ベクトルDBと同じ場所）
     
     # マイコン設定
     SUPPORTED_MICROCONTROLLERS = {
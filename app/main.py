@@ -17,7 +17,9 @@ sys.path.insert(0, parent_dir)
 from config import Config
 from models.simple_rag_engine import SimpleRAGEngine
 from models.simple_vector_db import SimpleVectorDatabase
+from models.vector_db_registry import shared_index_registry
 from services.document_processor import DocumentProcessor
+from services.ingestion_manifest import sync_documents
 from services.microcontroller_selector import MicrocontrollerSelector
 from services.code_generator import CodeGenerator
 from services.auth import AuthService
@@ -55,8 +57,6 @@ class STMicroRAGApp:
         if "initialized" not in st.session_state:
             st.session_state.initialized = False
             st.session_state.current_microcontroller = "NUCLEO-F767ZI"
-            st.session_state.vector_db_ready = False
-            st.session_state.documents_processed = False
             st.session_state.messages = []
     
     def initialize_components(self):
@@ -67,21 +67,15 @@ class STMicroRAGApp:
             self.code_generator = CodeGenerator()
             self.document_processor = DocumentProcessor()
             
-            # ベクトルデータベースの初期化（シンプル版）
-            if not st.session_state.vector_db_ready:
-                self.vector_db = SimpleVectorDatabase()
-                self.rag_engine = SimpleRAGEngine(self.vector_db)
-                
-                # ドキュメントブートストラップ
-                self.bootstrap_documents_if_needed()
-                
-                st.session_state.vector_db_ready = True
-            else:
-                self.vector_db = SimpleVectorDatabase()
-                self.rag_engine = SimpleRAGEngine(self.vector_db)
+            # ベクトルデータベースとRAGエンジンはプロセス内で共有（再実行・セッションごとに読み直さない）
+            self.vector_db = shared_index_registry.get_vector_db()
+            self.rag_engine = shared_index_registry.get_rag_engine()
             
-            st.session_state.initialized = True
+            # ドキュメントブートストラップ（共有ストアに対してプロセスで1回だけ。セッションごとには行わない）
+            shared_index_registry.run_once("bootstrap", self.bootstrap_documents_if_needed)
             
+            st.session_state.initialized = True
+        
         except Exception as e:
             logger.error(f"Component initialization failed: {e}")
             st.error(f"システムの初期化に失敗しました: {e}")
@@ -101,16 +95,16 @@ class STMicroRAGApp:
                         st.success("基本文書の初期化が完了しました！")
                     else:
                         logger.warning("Bootstrap partially failed")
-                        
+        
         except Exception as e:
             logger.error(f"Bootstrap failed: {e}")
             # エラーがあっても続行
     
     def process_documents_if_needed(self):
-        """必要に応じてドキュメントを処理"""
-        if st.session_state.documents_processed:
-            return
-        
+        """必要に応じてドキュメントを処理（共有ストアに対してプロセスで1回だけ）"""
+        shared_index_registry.run_once("process_documents", self._process_documents_once)
+    
+    def _process_documents_once(self):
         # ドキュメント処理状況を確認
         collections = self.vector_db.list_collections()
         nucleo_collection = f"microcontroller_nucleo_f767zi"
@@ -118,8 +112,6 @@ class STMicroRAGApp:
         if nucleo_collection not in collections:
             with st.spinner("📚 ドキュメントを処理しています..."):
                 self.process_documents()
-        
-        st.session_state.documents_processed = True
     
     def process_documents(self):
         """利用可能なドキュメントを処理してベクトル化"""
@@ -151,26 +143,25 @@ class STMicroRAGApp:
                         document_files.append(os.path.join(an_folder, file))
             
             if document_files:
-                # ドキュメントを処理
-                documents = self.document_processor.create_documents(
-                    document_files, 
+                # 前回から追加・変更・削除されたファイルのみ反映
+                stats = sync_documents(
+                    document_files,
+                    self.vector_db,
+                    self.document_processor,
                     "NUCLEO-F767ZI"
                 )
                 
-                if documents:
-                    # ベクトルデータベースに追加
-                    success = self.vector_db.add_documents(documents, "NUCLEO-F767ZI")
-                    
-                    if success:
-                        st.success(f"✅ {len(documents)}個のドキュメントチャンクを処理しました")
-                        logger.info(f"Processed {len(document_files)} files into {len(documents)} chunks")
-                    else:
-                        st.warning("ドキュメントの登録に一部失敗しました")
-                else:
+                if stats["new"] or stats["modified"] or stats["deleted"]:
+                    st.success(
+                        f"✅ {stats['new'] + stats['modified']}ファイル（{stats['chunks_added']}個のチャンク）を処理しました"
+                        f"（変更なし: {stats['unchanged']}、削除: {stats['deleted']}）"
+                    )
+                    logger.info(f"Synced {len(document_files)} files: {stats}")
+                elif stats["failed"]:
                     st.warning("ドキュメントからテキストを抽出できませんでした")
             else:
                 st.warning("処理可能なドキュメントが見つかりませんでした")
-                
+        
         except Exception as e:
             logger.error(f"Document processing failed: {e}")
             st.error(f"ドキュメント処理中にエラーが発生しました: {e}")
@@ -237,34 +228,43 @@ class STMicroRAGApp:
             
             # RAGエンジンで回答生成
             with st.chat_message("assistant"):
-                with st.spinner("回答を生成しています..."):
-                    try:
-                        answer_result = self.rag_engine.answer_question(
+                try:
+                    # 検索のみスピナーを表示し、回答本文は生成しながら表示する
+                    with st.spinner("関連ドキュメントを検索しています..."):
+                        answer_result = self.rag_engine.answer_question_stream(
                             user_input, 
                             microcontroller
                         )
-                        
-                        # 回答を表示
-                        answer = answer_result.get("answer", "申し訳ございません。回答を生成できませんでした。")
-                        st.markdown(answer)
-                        
-                        # パフォーマンス指標を表示
-                        render_performance_metrics(answer_result)
-                        
-                        # 参考資料を表示
-                        sources = answer_result.get("sources", [])
-                        if sources:
-                            with st.expander(f"📚 参考資料 ({len(sources)}件)"):
-                                for i, source in enumerate(sources, 1):
-                                    st.write(f"**{i}.** {source.get('filename', '不明')} ({source.get('category', '一般')})")
-                        
-                        # アシスタントメッセージを追加
-                        st.session_state.messages.append({"role": "assistant", "content": answer})
-                        
-                    except Exception as e:
-                        error_msg = f"回答生成中にエラーが発生しました: {e}"
-                        st.error(error_msg)
-                        st.session_state.messages.append({"role": "assistant", "content": error_msg})
+                    
+                    # 回答を表示
+                    stream = answer_result["stream"]
+                    st.write_stream(stream)
+                    answer = stream.text or "申し訳ございません。回答を生成できませんでした。"
+                    answer_result["time_to_first_token"] = stream.time_to_first_token
+                    answer_result["total_time"] = stream.total_time
+                    
+                    # パフォーマンス指標を表示
+                    render_performance_metrics(answer_result)
+                    
+                    # 参考資料を表示
+                    sources = answer_result.get("sources", [])
+                    if sources:
+                        with st.expander(f"📚 参考資料 ({len(sources)}件)"):
+                            for i, source in enumerate(sources, 1):
+                                pages = ""
+                                if "page_start" in source:
+                                    pages = f" p.{source['page_start']}"
+                                    if source["page_end"] != source["page_start"]:
+                                        pages += f"-{source['page_end']}"
+                                st.write(f"**{i}.** {source.get('filename', '不明')}{pages} ({source.get('category', '一般')})")
+                    
+                    # アシスタントメッセージを追加
+                    st.session_state.messages.append({"role": "assistant", "content": answer})
+                
+                except Exception as e:
+                    error_msg = f"回答生成中にエラーが発生しました: {e}"
+                    st.error(error_msg)
+                    st.session_state.messages.append({"role": "assistant", "content": error_msg})
     
     def render_code_generation_tab(self, microcontroller: str):
         """コード生成タブのレンダリング"""
@@ -355,7 +355,7 @@ class STMicroRAGApp:
             
             # メインインターフェースの表示
             self.render_main_interface()
-            
+        
         except Exception as e:
             logger.error(f"Application error: {e}")
             st.error(f"アプリケーションエラー: {e}")
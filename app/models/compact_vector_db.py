@@ -0,0 +1,413 @@
+"""
+省メモリのベクトルデータベース（オフライン版）
+正規化済みの埋め込みをint8（ベクトルごとのスケール付き）またはfloat16のNumPy配列で保持し、
+HNSWを使わずにブロック単位の内積で厳密なtop-kを求める
+"""
+import os
+import json
+import uuid
+import pickle
+import shutil
+import logging
+import numpy as np
+from collections import Counter
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from models.vector_db_offline import LazyEmbeddings, create_offline_embeddings
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# マスクを事前計算するメタデータ項目
+MASK_FIELDS = ("microcontroller", "category", "source")
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """float32の埋め込みを(量子化ベクトル, ベクトルごとのスケール)に変換"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float16":
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+    
+    # int8: 各ベクトルの最大絶対値を127に合わせる
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.rint(vectors / scales[:, None]).clip(-127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+def exact_top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコアの大きい順にk件のインデックス"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+class CompactVectorDatabase:
+    """int8 / float16 の埋め込みで厳密検索するベクトルデータベース
+    
+    OfflineVectorDatabaseと同じメソッドを持ち、置き換えて使える
+    """
+    
+    # バージョンごとのディレクトリに書き、マニフェストの置き換えで切り替える
+    INDEX_DIRECTORY = "compact_index"
+    MANIFEST_FILE = "manifest.json"
+    FORMAT_NAME = "stm32-rag-compact-index"
+    FORMAT_VERSION = 1
+    
+    # 旧形式（ファイルごとに置き換えていたため、途中で失敗すると行数が揃わないことがあった）
+    INDEX_FILE = "compact_vector_db.pkl"
+    VECTORS_FILE = "compact_vectors.npy"
+    SCALES_FILE = "compact_scales.npy"
+    
+    def __init__(self, persist_directory: str = None, dtype: str = None, embedding_model=None):
+        self.persist_directory = persist_directory or Config.VECTOR_DB_PATH
+        self.dtype = dtype or Config.COMPACT_VECTOR_DTYPE
+        if self.dtype not in ("int8", "float16"):
+            raise ValueError(f"Unsupported dtype: {self.dtype}")
+        self.embedding_model = embedding_model or LazyEmbeddings(
+            lambda: create_offline_embeddings(self.persist_directory)
+        )
+        
+        self.contents = []  # List[str]
+        self.metadatas = []  # List[Dict]
+        self.vectors = None  # (N, D) int8 / float16
+        self.scales = np.empty(0, dtype=np.float32)  # (N,)
+        self._masks = None  # 項目 -> 値 -> bool配列（検索時に遅延構築）
+        
+        self._load_index()
+    
+    def __len__(self) -> int:
+        return len(self.contents)
+    
+    def add_documents(self, documents: List["Document"], microcontroller: str = "NUCLEO-F767ZI") -> bool:
+        """ドキュメントをベクトルデータベースに追加"""
+        try:
+            if not documents:
+                logger.warning("No documents to add")
+                return False
+            
+            # マイコン固有のコレクション名を生成
+            collection_name = f"microcontroller_{microcontroller.lower().replace('-', '_')}"
+            
+            # ドキュメントにコレクション情報を追加
+            for doc in documents:
+                doc.metadata["collection"] = collection_name
+                doc.metadata["microcontroller"] = microcontroller
+            
+            embeddings = self.embedding_model.embed_documents([doc.page_content for doc in documents])
+            self.add_embeddings(
+                np.asarray(embeddings, dtype=np.float32),
+                [doc.page_content for doc in documents],
+                [dict(doc.metadata) for doc in documents]
+            )
+            
+            logger.info(f"Added {len(documents)} documents for {microcontroller}")
+            return self._save_index()
+        
+        except Exception as e:
+            logger.error(f"Failed to add documents: {e}")
+            return False
+    
+    def add_embeddings(self, embeddings: np.ndarray, contents: List[str], metadatas: List[Dict]):
+        """計算済みの埋め込みを追加（正規化してから量子化）"""
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        quantized, scales = quantize(embeddings / norms, self.dtype)
+        
+        if self.vectors is None or len(self.vectors) == 0:
+            self.vectors = quantized
+        else:
+            self.vectors = np.concatenate([self.vectors, quantized])
+        self.scales = np.concatenate([self.scales, scales])
+        self.contents.extend(contents)
+        self.metadatas.extend(metadatas)
+        self._masks = None
+    
+    def _build_masks(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """メタデータの値ごとのbool配列を作成（追加・削除後の初回検索時のみ）"""
+        if self._masks is None:
+            masks = {}
+            for field in MASK_FIELDS:
+                rows = {}
+                for doc_id, metadata in enumerate(self.metadatas):
+                    rows.setdefault(metadata.get(field), []).append(doc_id)
+                field_masks = {}
+                for value, doc_ids in rows.items():
+                    mask = np.zeros(len(self.metadatas), dtype=bool)
+                    mask[doc_ids] = True
+                    field_masks[value] = mask
+                masks[field] = field_masks
+            self._masks = masks
+        return self._masks
+    
+    def _filter_mask(self, filters: Dict[str, Optional[str]]) -> Optional[np.ndarray]:
+        """条件に一致する行のマスク（条件なしの場合はNone）"""
+        masks = self._build_masks()
+        result = None
+        for field, value in filters.items():
+            if not value:
+                continue
+            mask = masks[field].get(value)
+            if mask is None:
+                return np.zeros(len(self.metadatas), dtype=bool)
+            result = mask if result is None else result & mask
+        return result
+    
+    def similarity_scores(self, query_vector: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """全ベクトルとのコサイン類似度（ブロックごとにfloat32へ戻して内積）"""
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm > 0:
+            query_vector = query_vector / norm
+        
+        block = Config.COMPACT_SEARCH_BLOCK
+        scores = np.empty(len(self.contents), dtype=np.float32)
+        for start in range(0, len(scores), block):
+            rows = self.vectors[start:start + block]
+            scores[start:start + block] = rows.astype(np.float32) @ query_vector
+        scores *= self.scales
+        
+        if mask is not None:
+            scores[~mask] = -np.inf
+        return scores
+    
+    def search_by_vector(self,
+                         query_vector: np.ndarray,
+                         k: int = 5,
+                         microcontroller: str = None,
+                         category: str = None,
+                         source: str = None) -> List[Tuple[int, float]]:
+        """埋め込みベクトルで検索し、(行番号, 類似度)を返す"""
+        if not self.contents:
+            return []
+        mask = self._filter_mask({"microcontroller": microcontroller, "category": category, "source": source})
+        scores = self.similarity_scores(query_vector, mask)
+        return [
+            (int(doc_id), float(scores[doc_id]))
+            for doc_id in exact_top_k(scores, k) if np.isfinite(scores[doc_id])
+        ]
+    
+    def search_similar_documents(self,
+                               query: str,
+                               k: int = 5,
+                               microcontroller: str = None,
+                               category: str = None,
+                               score_threshold: float = 0.7) -> List[Tuple["Document", float]]:
+        """類似ドキュメントを検索（スコアは距離 = 1 - コサイン類似度）"""
+        try:
+            from langchain.schema import Document
+            
+            if not self.contents:
+                logger.warning("No documents in database")
+                return []
+            
+            query_vector = self.embedding_model.embed_query(query)
+            top = self.search_by_vector(query_vector, k, microcontroller, category)
+            results = [
+                (Document(page_content=self.contents[doc_id], metadata=dict(self.metadatas[doc_id])), 1.0 - similarity)
+                for doc_id, similarity in top if similarity >= score_threshold
+            ]
+            
+            logger.info(f"Found {len(results)} relevant documents for query: {query[:50]}...")
+            return results
+        
+        except Exception as e:
+            logger.error(f"Search failed: {e}")
+            return []
+    
+    def get_relevant_documents(self,
+                             query: str,
+                             k: int = 5,
+                             microcontroller: str = None) -> List["Document"]:
+        """関連ドキュメントを取得（スコアなし）"""
+        results = self.search_similar_documents(query, k, microcontroller)
+        return [doc for doc, score in results]
+    
+    def recall_report(self, float_vectors: np.ndarray, query_vectors: np.ndarray, k: int = 10) -> Dict:
+        """float32の厳密検索に対するrecall@kを計測
+        
+        float_vectorsは格納済みの行と同じ順序の元の埋め込み
+        """
+        float_vectors = np.asarray(float_vectors, dtype=np.float32)
+        float_vectors = float_vectors / np.maximum(np.linalg.norm(float_vectors, axis=1, keepdims=True), 1e-12)
+        
+        recalls = []
+        max_errors = []
+        for query_vector in np.asarray(query_vectors, dtype=np.float32):
+            query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+            exact_scores = float_vectors @ query_vector
+            expected = set(exact_top_k(exact_scores, k).tolist())
+            approx_scores = self.similarity_scores(query_vector)
+            found = set(exact_top_k(approx_scores, k).tolist())
+            recalls.append(len(expected & found) / len(expected) if expected else 1.0)
+            max_errors.append(float(np.abs(approx_scores - exact_scores).max()) if len(exact_scores) else 0.0)
+        
+        return {
+            "dtype": self.dtype,
+            "k": k,
+            "queries": len(recalls),
+            "recall": float(np.mean(recalls)) if recalls else 1.0,
+            "min_recall": float(np.min(recalls)) if recalls else 1.0,
+            "max_score_error": max(max_errors) if max_errors else 0.0,
+            "memory": self.memory_usage(),
+            "float32_bytes": int(float_vectors.nbytes)
+        }
+    
+    def memory_usage(self) -> Dict:
+        """ベクトル部分のメモリ使用量（バイト）"""
+        vector_bytes = int(self.vectors.nbytes) if self.vectors is not None else 0
+        return {"vectors": vector_bytes, "scales": int(self.scales.nbytes), "total": vector_bytes + int(self.scales.nbytes)}
+    
+    def list_sources(self) -> set:
+        """登録済みのソースファイル一覧"""
+        return {metadata.get("source") for metadata in self.metadatas if metadata.get("source")}
+    
+    def delete_documents_by_source(self, sources: List[str], save: bool = True) -> int:
+        """指定したソースファイルのチャンクを削除し、削除件数を返す"""
+        sources = set(sources)
+        keep = np.array([metadata.get("source") not in sources for metadata in self.metadatas], dtype=bool)
+        removed = int(len(keep) - keep.sum())
+        if removed:
+            self.vectors = self.vectors[keep]
+            self.scales = self.scales[keep]
+            self.contents = [content for content, kept in zip(self.contents, keep) if kept]
+            self.metadatas = [metadata for metadata, kept in zip(self.metadatas, keep) if kept]
+            self._masks = None
+            if save:
+                self._save_index()
+        logger.info(f"Deleted {removed} chunks from {len(sources)} sources")
+        return removed
+    
+    def list_collections(self) -> List[str]:
+        """利用可能なコレクションを一覧表示"""
+        return sorted({metadata["collection"] for metadata in self.metadatas if metadata.get("collection")})
+    
+    def get_collection_stats(self, microcontroller: str = None) -> Dict:
+        """コレクションの統計情報を取得"""
+        counts = Counter(metadata.get("microcontroller", "unknown") for metadata in self.metadatas)
+        if microcontroller:
+            counts = Counter({microcontroller: counts.get(microcontroller, 0)})
+        
+        return {
+            f"microcontroller_{mc.lower().replace('-', '_')}": {"document_count": count, "microcontroller": mc}
+            for mc, count in counts.items()
+        }
+    
+    def _save_index(self) -> bool:
+        """ベクトル・スケール・本文とメタデータを新しいバージョンのディレクトリに書き、マニフェストをアトミックに置き換える
+        
+        マニフェストが指すディレクトリは常に揃った状態のため、途中で失敗しても直前の保存内容が読み込まれる
+        """
+        try:
+            index_directory = os.path.join(self.persist_directory, self.INDEX_DIRECTORY)
+            os.makedirs(index_directory, exist_ok=True)
+            name = f"v-{uuid.uuid4().hex[:12]}"
+            final_path = os.path.join(index_directory, name)
+            temp_path = final_path + ".tmp"
+            os.makedirs(temp_path)
+            
+            vectors = self.vectors if self.vectors is not None else np.empty((0, 0), dtype=self.dtype)
+            for filename, array in (("vectors.npy", vectors), ("scales.npy", self.scales)):
+                with open(os.path.join(temp_path, filename), "wb") as f:
+                    np.save(f, array)
+                    f.flush()
+                    os.fsync(f.fileno())
+            with open(os.path.join(temp_path, "data.pkl"), "wb") as f:
+                pickle.dump({"contents": self.contents, "metadatas": self.metadatas}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, final_path)
+            
+            self._write_manifest(index_directory, {"directory": name, "rows": len(self.contents), "dtype": self.dtype})
+            self._remove_old_versions(index_directory, name)
+            return True
+        except Exception as e:
+            logger.error(f"Failed to save compact index: {e}")
+            return False
+    
+    def _write_manifest(self, index_directory: str, manifest: Dict):
+        """マニフェストを一時ファイル経由でアトミックに置き換える"""
+        manifest = dict(manifest, format=self.FORMAT_NAME, version=self.FORMAT_VERSION)
+        manifest_path = os.path.join(index_directory, self.MANIFEST_FILE)
+        temp_path = manifest_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, manifest_path)
+    
+    def _remove_old_versions(self, index_directory: str, live: str):
+        """マニフェストが指していないバージョンと旧形式のファイルを削除"""
+        for name in os.listdir(index_directory):
+            path = os.path.join(index_directory, name)
+            if name == live or not os.path.isdir(path):
+                continue
+            try:
+                shutil.rmtree(path)
+            except OSError as e:
+                # memmap中のファイルが削除できない環境では次回に再試行
+                logger.warning(f"Could not remove old compact index {name}: {e}")
+        
+        for filename in (self.INDEX_FILE, self.VECTORS_FILE, self.SCALES_FILE):
+            path = os.path.join(self.persist_directory, filename)
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"Could not remove legacy compact index file {filename}: {e}")
+    
+    def _load_index(self):
+        """保存済みのインデックスを読み込む（ベクトルはメモリマップで参照、行数が揃わなければ読み込まない）"""
+        index_directory = os.path.join(self.persist_directory, self.INDEX_DIRECTORY)
+        manifest_path = os.path.join(index_directory, self.MANIFEST_FILE)
+        try:
+            if os.path.exists(manifest_path):
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                if manifest.get("format") != self.FORMAT_NAME:
+                    raise ValueError(f"Unknown manifest format: {manifest.get('format')}")
+                version_path = os.path.join(index_directory, manifest["directory"])
+                dtype, expected_rows = manifest["dtype"], manifest["rows"]
+                vectors_path = os.path.join(version_path, "vectors.npy")
+                scales_path = os.path.join(version_path, "scales.npy")
+                data_path = os.path.join(version_path, "data.pkl")
+            elif os.path.exists(os.path.join(self.persist_directory, self.INDEX_FILE)):
+                dtype, expected_rows = None, None
+                vectors_path = os.path.join(self.persist_directory, self.VECTORS_FILE)
+                scales_path = os.path.join(self.persist_directory, self.SCALES_FILE)
+                data_path = os.path.join(self.persist_directory, self.INDEX_FILE)
+            else:
+                return
+            
+            with open(data_path, "rb") as f:
+                data = pickle.load(f)
+            dtype = dtype or data["dtype"]
+            vectors = np.load(vectors_path, mmap_mode="r")
+            scales = np.load(scales_path)
+            contents, metadatas = data["contents"], data["metadatas"]
+            
+            rows = {"vectors": len(vectors), "scales": len(scales), "contents": len(contents), "metadatas": len(metadatas)}
+            if expected_rows is not None:
+                rows["manifest"] = expected_rows
+            if len(set(rows.values())) != 1:
+                raise ValueError(f"Row counts do not match: {rows}")
+            
+            if dtype != self.dtype:
+                logger.warning(f"Compact index dtype is {dtype}, ignoring configured {self.dtype}")
+                self.dtype = dtype
+            self.vectors = vectors if len(vectors) else None
+            self.scales = scales
+            self.contents = contents
+            self.metadatas = metadatas
+            logger.info(f"Loaded compact index: {len(self.contents)} vectors ({self.dtype})")
+        except Exception as e:
+            logger.error(f"Failed to load compact index: {e}")
+            self.contents, self.metadatas = [], []
+            self.vectors, self.scales = None, np.empty(0, dtype=np.float32)
@@ -0,0 +1,181 @@
+"""
+LLMに渡すコンテキストの組み立て
+検索結果をスコア順にトークン予算内へ詰め、隣接チャンクのオーバーラップ部分を除く
+"""
+import re
+import math
+import logging
+from typing import Dict, List, Optional, Tuple
+from langchain.schema import Document
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+
+# トークン数の計算（tiktokenがない環境では近似値）
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def overlap_length(previous: str, text: str, max_overlap: int) -> int:
+    """previousの末尾とtextの先頭が一致する最長の文字数（max_overlap以下）"""
+    for size in range(min(len(previous), len(text), max_overlap), 0, -1):
+        if previous.endswith(text[:size]):
+            return size
+    return 0
+
+class TokenCounter:
+    """プロンプトのトークン数を数える
+    
+    tiktokenがあればモデルのエンコーディングを使い、なければ
+    英数字は4文字で1トークン・日本語などはそれ以外の1文字で1トークンとして近似する（多めに見積もる）
+    """
+    
+    # 英数字の連続 / 空白 / その他の1文字
+    APPROXIMATE_PATTERN = re.compile(r"[A-Za-z0-9_]+|\s+|.", re.S)
+    ASCII_CHARS_PER_TOKEN = 4
+    
+    def __init__(self, model: str = None):
+        self.model = model or Config.LLM_MODEL
+        self._encoding = None
+        if TIKTOKEN_AVAILABLE:
+            try:
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except Exception:
+                try:
+                    self._encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    # エンコーディングのファイルを取得できない環境（オフラインなど）
+                    logger.warning(f"tiktoken encoding unavailable, using approximate token counts: {e}")
+    
+    @property
+    def name(self) -> str:
+        return self._encoding.name if self._encoding is not None else "approximate"
+    
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        
+        tokens = 0
+        for piece in self.APPROXIMATE_PATTERN.findall(text):
+            if piece[0].isspace():
+                continue
+            if piece[0] == "_" or (piece[0].isascii() and piece[0].isalnum()):
+                tokens += math.ceil(len(piece) / self.ASCII_CHARS_PER_TOKEN)
+            else:
+                tokens += 1
+        return tokens
+    
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """先頭からmax_tokens以内に収まる部分を返す"""
+        if max_tokens <= 0:
+            return ""
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            return text if len(tokens) <= max_tokens else self._encoding.decode(tokens[:max_tokens])
+        if self.count(text) <= max_tokens:
+            return text
+        
+        # 収まる最長の文字数を二分探索
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low]
+
+class ContextBuilder:
+    """検索結果からトークン予算内のコンテキストを組み立てる
+    
+    - スコアの高い順に詰め、予算を超えるチャンクは残りの予算に合わせて切り詰める
+    - 同じファイルの採用済みチャンクと重なる先頭・末尾（CHUNK_OVERLAP由来の重複）を除く
+    - 他のチャンクに完全に含まれるチャンクは使わない
+    """
+    
+    # 切り詰めた本文がこれより短くなる場合は入れない
+    MIN_SECTION_TOKENS = 32
+    
+    def __init__(self, token_budget: int = None, counter: TokenCounter = None, max_overlap: int = None):
+        self.token_budget = token_budget or Config.CONTEXT_TOKEN_BUDGET
+        self.counter = counter or TokenCounter()
+        self.max_overlap = max_overlap or Config.CHUNK_OVERLAP
+    
+    def _strip_overlaps(self, text: str, filename: str, packed: List[Tuple[str, str]]) -> Tuple[str, int]:
+        """採用済みの同じファイルのチャンクと重なる部分を除いた本文と除いた文字数"""
+        removed = 0
+        for packed_filename, packed_text in packed:
+            if packed_filename != filename or not text:
+                continue
+            if text in packed_text:
+                return "", removed + len(text)
+            
+            # 採用済みチャンクの直後のチャンク（先頭が重なる）
+            size = overlap_length(packed_text, text, self.max_overlap)
+            if size:
+                text = text[size:]
+                removed += size
+            # 採用済みチャンクの直前のチャンク（末尾が重なる）
+            size = overlap_length(text, packed_text, self.max_overlap)
+            if size:
+                text = text[:-size]
+                removed += size
+        return text, removed
+    
+    def build(self,
+              relevant_docs: List[Tuple[Document, float]],
+              label: str = "文書",
+              max_chunks: Optional[int] = None) -> Tuple[str, Dict]:
+        """(コンテキスト文字列, 使用状況) を返す（relevant_docsは関連度の高い順）"""
+        sections = []
+        packed = []  # (ファイル名, 本文)
+        used_tokens = 0
+        report = {
+            "budget": self.token_budget,
+            "tokenizer": self.counter.name,
+            "chunks_used": 0,
+            "chunks_truncated": 0,
+            "chunks_skipped": 0,
+            "overlap_chars_removed": 0
+        }
+        
+        for doc, score in relevant_docs[:max_chunks] if max_chunks else relevant_docs:
+            filename = doc.metadata.get("filename", "不明")
+            text, removed = self._strip_overlaps(doc.page_content.strip(), filename, packed)
+            report["overlap_chars_removed"] += removed
+            text = text.strip()
+            if not text:
+                report["chunks_skipped"] += 1
+                continue
+            
+            header = f"{label}: {filename}\n内容: "
+            footer = "\n---"
+            overhead = self.counter.count(header) + self.counter.count(footer) + 1  # 区切りの改行
+            available = self.token_budget - used_tokens - overhead
+            tokens = self.counter.count(text)
+            if tokens > available:
+                if available < self.MIN_SECTION_TOKENS:
+                    report["chunks_skipped"] += 1
+                    continue
+                text = self.counter.truncate(text, available)
+                tokens = self.counter.count(text)
+                report["chunks_truncated"] += 1
+            
+            sections.append(header + text + footer)
+            packed.append((filename, doc.page_content))
+            used_tokens += tokens + overhead
+            report["chunks_used"] += 1
+        
+        context = "\n".join(sections)
+        report["context_tokens"] = self.counter.count(context)
+        return context, report
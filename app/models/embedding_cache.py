@@ -0,0 +1,116 @@
+"""
+埋め込みベクトルのキャッシュ
+本文のハッシュとモデル名をキーにsqliteへfloat32のBLOBとして保存し、同じチャンクの再計算を省く
+"""
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+from typing import List, Dict, Iterable
+from langchain.embeddings.base import Embeddings
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def content_hash(text: str) -> str:
+    """チャンク本文のハッシュ"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """(モデル名, 本文ハッシュ) -> 埋め込みベクトル のsqliteテーブル"""
+    
+    # 1回のSQLで問い合わせるハッシュ数（sqliteの変数上限より小さく）
+    QUERY_BATCH = 500
+    
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, hash TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, hash))"
+        )
+        self._connection.commit()
+    
+    def get_many(self, model: str, hashes: Iterable[str]) -> Dict[str, List[float]]:
+        """キャッシュ済みの埋め込みを返す（ハッシュ -> ベクトル）"""
+        hashes = list(set(hashes))
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), self.QUERY_BATCH):
+                batch = hashes[start:start + self.QUERY_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [model] + batch
+                )
+                for text_hash, blob in rows:
+                    found[text_hash] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+    
+    def put_many(self, model: str, items: Dict[str, List[float]]):
+        """埋め込みを保存"""
+        rows = []
+        for text_hash, vector in items.items():
+            array = np.asarray(vector, dtype=np.float32)
+            rows.append((model, text_hash, array.shape[0], array.tobytes()))
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._connection.commit()
+    
+    def count(self, model: str = None) -> int:
+        with self._lock:
+            if model:
+                return self._connection.execute("SELECT COUNT(*) FROM embeddings WHERE model = ?", (model,)).fetchone()[0]
+            return self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+class CachedEmbeddings(Embeddings):
+    """埋め込みモデルのラッパー: キャッシュにないチャンクだけをバッチでエンコードする"""
+    
+    def __init__(self, base: Embeddings, model_name: str, cache: EmbeddingCache = None, batch_size: int = None):
+        self.base = base
+        self.model_name = model_name
+        self.cache = cache
+        self.batch_size = batch_size or Config.EMBEDDING_BATCH_SIZE
+        self.stats = {"hits": 0, "computed": 0}
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [content_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model_name, hashes) if self.cache else {}
+        
+        # 未計算の本文（同じ本文は1回だけ）
+        missing = {}
+        for text_hash, text in zip(hashes, texts):
+            if text_hash not in vectors:
+                missing.setdefault(text_hash, text)
+        self.stats["hits"] += len(texts) - sum(1 for text_hash in hashes if text_hash in missing)
+        
+        missing_hashes = list(missing)
+        for start in range(0, len(missing_hashes), self.batch_size):
+            batch_hashes = missing_hashes[start:start + self.batch_size]
+            embeddings = self.base.embed_documents([missing[text_hash] for text_hash in batch_hashes])
+            computed = dict(zip(batch_hashes, embeddings))
+            vectors.update(computed)
+            if self.cache:
+                self.cache.put_many(self.model_name, computed)
+            self.stats["computed"] += len(batch_hashes)
+        
+        if missing_hashes:
+            logger.info(f"Embedded {len(missing_hashes)} chunks ({len(texts) - len(missing_hashes)} from cache)")
+        return [vectors[text_hash] for text_hash in hashes]
+    
+    def embed_query(self, text: str) -> List[float]:
+        return self.base.embed_query(text)
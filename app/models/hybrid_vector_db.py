@@ -0,0 +1,250 @@
+"""
+ハイブリッド検索（語彙検索 + 埋め込み検索）
+SimpleVectorDatabase（TF-IDF/BM25）とOfflineVectorDatabase（MiniLM + Chroma）を並行して検索し、
+Reciprocal Rank Fusion または重み付きスコアで順位を統合する
+"""
+import logging
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Optional, Tuple
+from langchain.schema import Document
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from models.simple_vector_db import SimpleVectorDatabase
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class HybridVectorDatabase:
+    """語彙検索と埋め込み検索を統合するベクトルデータベース
+    
+    search_similar_documentsは他のベクトルデータベースと同じシグネチャで、
+    返すスコアも距離（小さいほど類似、0〜1）なのでSimpleRAGEngineからそのまま使える
+    """
+    
+    def __init__(self,
+                 lexical_db: SimpleVectorDatabase = None,
+                 semantic_db=None,
+                 fusion: str = None,
+                 lexical_weight: float = None,
+                 semantic_weight: float = None):
+        self.lexical_db = lexical_db or SimpleVectorDatabase()
+        self.semantic_db = semantic_db
+        self.fusion = (fusion or Config.HYBRID_FUSION).lower()
+        self.weights = {
+            "lexical": Config.HYBRID_LEXICAL_WEIGHT if lexical_weight is None else lexical_weight,
+            "semantic": Config.HYBRID_SEMANTIC_WEIGHT if semantic_weight is None else semantic_weight
+        }
+        # 2つのストアを同時に検索するためのスレッド
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hybrid-search")
+    
+    def __getattr__(self, name):
+        # documents・corpus_version・get_neighbor_chunksなどは語彙側ストアに委譲
+        if name == "lexical_db":
+            raise AttributeError(name)
+        return getattr(self.lexical_db, name)
+    
+    def add_documents(self, documents: List[Document], microcontroller: str = "NUCLEO-F767ZI") -> bool:
+        """両方のストアにドキュメントを追加"""
+        success = self.lexical_db.add_documents(documents, microcontroller)
+        if self.semantic_db is not None:
+            # Chroma側でメタデータが書き換えられるため複製を渡す
+            copies = [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in documents]
+            success = self.semantic_db.add_documents(copies, microcontroller) and success
+        return success
+    
+    def delete_documents_by_source(self, sources: List[str], save: bool = True) -> int:
+        """両方のストアから指定ソースのチャンクを削除（件数は語彙側）"""
+        removed = self.lexical_db.delete_documents_by_source(sources, save)
+        if self.semantic_db is not None and hasattr(self.semantic_db, "delete_documents_by_source"):
+            self.semantic_db.delete_documents_by_source(sources, save)
+        return removed
+    
+    def search_similar_documents(self,
+                               query: str,
+                               k: int = 5,
+                               microcontroller: str = None,
+                               category: str = None,
+                               score_threshold: float = 0.1) -> List[Tuple[Document, float]]:
+        """類似ドキュメントを検索（両ストアを並行検索して順位を統合）"""
+        try:
+            candidates = k * Config.HYBRID_CANDIDATE_MULTIPLIER
+            stores = {"lexical": self.lexical_db}
+            if self.semantic_db is not None:
+                stores["semantic"] = self.semantic_db
+            
+            # 閾値は統合後に適用するため、各ストアでは絞り込まない
+            # （語彙側は共通トークンのない文書のみ除外。Chromaの距離は1を超えることがあるため埋め込み側は下限なし）
+            thresholds = {"lexical": 1e-9, "semantic": float("-inf")}
+            futures = {
+                name: self._executor.submit(
+                    store.search_similar_documents, query, candidates, microcontroller, category, thresholds[name]
+                )
+                for name, store in stores.items()
+            }
+            
+            rankings = {}
+            for name, future in futures.items():
+                result = self._wait(name, future)
+                if result is not None:
+                    rankings[name] = result
+            
+            results = self._fuse(rankings, k, score_threshold)
+            logger.info(f"Found {len(results)} relevant documents for query (hybrid {self.fusion}): {query[:50]}...")
+            return results
+        
+        except Exception as e:
+            logger.error(f"Hybrid search failed: {e}")
+            return []
+    
+    def search_similar_documents_batch(self,
+                                       queries: List[str],
+                                       k: int = 5,
+                                       microcontrollers: List[Optional[str]] = None,
+                                       category: str = None,
+                                       score_threshold: float = 0.1) -> List[List[Tuple[Document, float]]]:
+        """複数クエリをまとめて検索（結果はsearch_similar_documentsをクエリごとに呼んだ場合と同じ）
+        
+        語彙側は一括検索、埋め込み側はクエリごとに検索し、クエリごとに順位を統合する
+        """
+        microcontrollers = microcontrollers or [None] * len(queries)
+        try:
+            candidates = k * Config.HYBRID_CANDIDATE_MULTIPLIER
+            lexical_future = self._executor.submit(
+                self.lexical_db.search_similar_documents_batch,
+                queries, candidates, microcontrollers, category, 1e-9
+            )
+            semantic_futures = []
+            if self.semantic_db is not None:
+                semantic_futures = [
+                    self._executor.submit(
+                        self.semantic_db.search_similar_documents,
+                        query, candidates, microcontroller, category, float("-inf")
+                    )
+                    for query, microcontroller in zip(queries, microcontrollers)
+                ]
+            
+            lexical_results = self._wait("lexical", lexical_future, Config.HYBRID_SEARCH_TIMEOUT * max(1, len(queries)))
+            results = []
+            for i in range(len(queries)):
+                rankings = {}
+                if lexical_results is not None:
+                    rankings["lexical"] = lexical_results[i]
+                if semantic_futures:
+                    semantic_result = self._wait("semantic", semantic_futures[i])
+                    if semantic_result is not None:
+                        rankings["semantic"] = semantic_result
+                results.append(self._fuse(rankings, k, score_threshold))
+            
+            logger.info(f"Hybrid batch search: {len(queries)} queries ({self.fusion})")
+            return results
+        
+        except Exception as e:
+            logger.error(f"Hybrid batch search failed: {e}")
+            return [[] for _ in queries]
+    
+    def _wait(self, name: str, future, timeout: float = None):
+        """ストアの検索結果を待つ（タイムアウト・失敗時はNone）"""
+        try:
+            return future.result(timeout=timeout or Config.HYBRID_SEARCH_TIMEOUT)
+        except FutureTimeoutError:
+            logger.warning(f"Hybrid search: {name} store timed out")
+        except Exception as e:
+            logger.warning(f"Hybrid search: {name} store failed: {e}")
+        return None
+    
+    def _fuse(self, rankings: Dict[str, List[Tuple[Document, float]]], k: int,
+              score_threshold: float) -> List[Tuple[Document, float]]:
+        """順位を統合して閾値以上の上位k件を距離（1 - 統合スコア）で返す"""
+        if self.fusion == "weighted":
+            fused = self._fuse_weighted(rankings)
+        else:
+            fused = self._fuse_rrf(rankings)
+        return [(doc, 1.0 - score) for doc, score in fused if score >= score_threshold][:k]
+    
+    def _fuse_rrf(self, rankings: Dict[str, List[Tuple[Document, float]]]) -> List[Tuple[Document, float]]:
+        """Reciprocal Rank Fusion: Σ weight / (RRF_K + 順位)
+        
+        全ストアで1位の場合を1.0として正規化する
+        """
+        rrf_k = Config.HYBRID_RRF_K
+        scores = {}
+        documents = {}
+        for name, results in rankings.items():
+            weight = self.weights[name]
+            for rank, (doc, _) in enumerate(results, start=1):
+                key = self._document_key(doc)
+                documents.setdefault(key, doc)
+                scores[key] = scores.get(key, 0.0) + weight / (rrf_k + rank)
+        
+        max_score = sum(self.weights[name] for name in rankings) / (rrf_k + 1)
+        return self._sorted(scores, documents, max_score)
+    
+    def _fuse_weighted(self, rankings: Dict[str, List[Tuple[Document, float]]]) -> List[Tuple[Document, float]]:
+        """重み付きスコア統合: ストアごとに類似度を0〜1へmin-max正規化して加重和"""
+        scores = {}
+        documents = {}
+        for name, results in rankings.items():
+            if not results:
+                continue
+            # 距離 → 類似度（Chromaの距離は1を超えることがあるため正規化で吸収）
+            similarities = [-distance for _, distance in results]
+            low, high = min(similarities), max(similarities)
+            weight = self.weights[name]
+            for (doc, _), similarity in zip(results, similarities):
+                normalized = (similarity - low) / (high - low) if high > low else 1.0
+                key = self._document_key(doc)
+                documents.setdefault(key, doc)
+                scores[key] = scores.get(key, 0.0) + weight * normalized
+        
+        max_score = sum(self.weights[name] for name in rankings)
+        return self._sorted(scores, documents, max_score)
+    
+    @staticmethod
+    def _sorted(scores: Dict[str, float], documents: Dict[str, Document], max_score: float) -> List[Tuple[Document, float]]:
+        if max_score <= 0:
+            return []
+        ordered = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [(documents[key], score / max_score) for key, score in ordered]
+    
+    @staticmethod
+    def _document_key(doc: Document) -> str:
+        """両ストアで同じチャンクを同一視するためのキー（chunk_idがなければ本文のハッシュ）"""
+        chunk_id = doc.metadata.get("chunk_id")
+        if chunk_id:
+            return f"{doc.metadata.get('source', '')}:{chunk_id}"
+        return hashlib.md5(doc.page_content.encode("utf-8")).hexdigest()
+    
+    def get_relevant_documents(self,
+                             query: str,
+                             k: int = 5,
+                             microcontroller: str = None) -> List[Document]:
+        """関連ドキュメントを取得（スコアなし）"""
+        results = self.search_similar_documents(query, k, microcontroller)
+        return [doc for doc, score in results]
+    
+    def list_collections(self) -> List[str]:
+        collections = list(self.lexical_db.list_collections())
+        if self.semantic_db is not None:
+            collections += [name for name in self.semantic_db.list_collections() if name not in collections]
+        return collections
+
+def create_hybrid_vector_db(persist_directory: str = None,
+                            semantic_directory: str = None,
+                            fusion: str = None) -> HybridVectorDatabase:
+    """ハイブリッドDBを作成（埋め込み側の依存関係がなければ語彙検索のみで動作）"""
+    lexical_db = SimpleVectorDatabase(persist_directory)
+    semantic_db = None
+    try:
+        from models.vector_db_offline import OfflineVectorDatabase, offline_dependencies_available
+        # モデル・Chromaの読み込みは初回検索まで遅延されるため、ここでは依存関係の有無のみ確認
+        if not offline_dependencies_available():
+            raise ImportError("chromadb / sentence-transformers is not installed")
+        semantic_db = OfflineVectorDatabase(semantic_directory)
+    except Exception as e:
+        logger.warning(f"Embedding store unavailable, hybrid search uses lexical results only: {e}")
+    return HybridVectorDatabase(lexical_db, semantic_db, fusion)
@@ -0,0 +1,322 @@
+"""
+SimpleVectorDatabase用のオンディスクインデックス形式
+ドキュメント本文（オフセット表付き）・語彙表・数値配列をセグメントごとに分けて保存し、
+数値配列はnp.memmapで、本文はオフセット指定で遅延読み込みする
+"""
+import os
+import json
+import shutil
+import logging
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+from langchain.schema import Document
+
+try:
+    import numpy as np
+    STORAGE_AVAILABLE = True
+except ImportError:
+    STORAGE_AVAILABLE = False
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FORMAT_NAME = "stm32-rag-simple-index"
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+
+# 旧バージョンのセグメントを現行形式へ変換する関数（version -> upgrader）
+# 形式を変更した場合はここに追加し、FORMAT_VERSIONを上げる
+SEGMENT_UPGRADERS = {}
+
+def compute_tfidf_weights(indptr, indices, counts, lengths, idf):
+    """トークン出現数からL2正規化済みTF-IDF重みと正規化前ノルムを計算"""
+    indptr = np.asarray(indptr, dtype=np.int64)
+    indices = np.asarray(indices)
+    counts = np.asarray(counts, dtype=np.float64)
+    lengths = np.asarray(lengths, dtype=np.float64)
+    num_docs = len(indptr) - 1
+    
+    # tf * idf（tf = 出現数 / チャンクの総トークン数）
+    rows = np.repeat(np.arange(num_docs), np.diff(indptr))
+    data = counts / np.maximum(lengths, 1)[rows] * idf[indices]
+    
+    squared = np.zeros(num_docs, dtype=np.float64)
+    np.add.at(squared, rows, data * data)
+    norms = np.sqrt(squared)
+    inverse = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    data *= inverse[rows]
+    return data, norms
+
+def iter_term_counts(terms: List[str], indptr, indices, counts) -> Iterator[Dict[str, int]]:
+    """CSR形式のトークン出現数を1チャンクずつ辞書で返す"""
+    for doc_id in range(len(indptr) - 1):
+        start, end = int(indptr[doc_id]), int(indptr[doc_id + 1])
+        yield {
+            terms[int(col)]: int(count)
+            for col, count in zip(indices[start:end], counts[start:end])
+        }
+
+def merge_segment_arrays(segments: List["IndexSegment"]):
+    """複数セグメントの語彙を統合し、CSR配列を連結する
+    
+    単一セグメントの場合はmemmapをそのまま返す
+    """
+    if len(segments) == 1:
+        segment = segments[0]
+        return segment.terms, segment.indptr, segment.indices, segment.counts, segment.lengths, segment.df
+    
+    terms = []
+    term_to_col = {}
+    indptr_parts, indices_parts, counts_parts, lengths_parts = [np.zeros(1, dtype=np.int64)], [], [], []
+    df_parts = []
+    offset = 0
+    for segment in segments:
+        remap = np.empty(len(segment.terms), dtype=np.int64)
+        for col, term in enumerate(segment.terms):
+            global_col = term_to_col.get(term)
+            if global_col is None:
+                global_col = len(terms)
+                term_to_col[term] = global_col
+                terms.append(term)
+            remap[col] = global_col
+        
+        indices_parts.append(remap[np.asarray(segment.indices)])
+        indptr_parts.append(np.asarray(segment.indptr[1:], dtype=np.int64) + offset)
+        counts_parts.append(np.asarray(segment.counts))
+        lengths_parts.append(np.asarray(segment.lengths))
+        df_parts.append((remap, np.asarray(segment.df)))
+        offset += int(segment.indptr[-1])
+    
+    df = np.zeros(len(terms), dtype=np.int64)
+    for remap, segment_df in df_parts:
+        np.add.at(df, remap, segment_df)
+    
+    return (
+        terms,
+        np.concatenate(indptr_parts),
+        np.concatenate(indices_parts).astype(np.int32) if indices_parts else np.zeros(0, dtype=np.int32),
+        np.concatenate(counts_parts) if counts_parts else np.zeros(0, dtype=np.int32),
+        np.concatenate(lengths_parts) if lengths_parts else np.zeros(0, dtype=np.int32),
+        df,
+    )
+
+class LazyDocumentList:
+    """セグメントの本文をオフセット指定で読み込むドキュメント列
+    
+    追加されたドキュメントはメモリ上に保持し、保存時に新しいセグメントへ書き出す
+    """
+    
+    def __init__(self, segments: Optional[List["IndexSegment"]] = None):
+        self._segments = segments or []
+        self._starts = []
+        total = 0
+        for segment in self._segments:
+            self._starts.append(total)
+            total += segment.num_docs
+        self._persisted_count = total
+        self._pending = []  # List[Document]
+    
+    def __len__(self) -> int:
+        return self._persisted_count + len(self._pending)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("document index out of range")
+        if index >= self._persisted_count:
+            return self._pending[index - self._persisted_count]
+        
+        position = bisect_right(self._starts, index) - 1
+        return self._segments[position].get_document(index - self._starts[position])
+    
+    def __iter__(self) -> Iterator[Document]:
+        for segment in self._segments:
+            for doc_id in range(segment.num_docs):
+                yield segment.get_document(doc_id)
+        yield from self._pending
+    
+    @property
+    def segments(self) -> List["IndexSegment"]:
+        """永続化済みセグメント（読み取り専用）"""
+        return list(self._segments)
+    
+    @property
+    def pending(self) -> List[Document]:
+        """まだセグメントに書き出していないドキュメント"""
+        return list(self._pending)
+    
+    def append(self, document: Document):
+        self._pending.append(document)
+    
+    def extend(self, documents: List[Document]):
+        self._pending.extend(documents)
+    
+    def metadata(self, index: int) -> Dict:
+        """本文を読まずにメタデータのみ取得"""
+        if index >= self._persisted_count:
+            return self._pending[index - self._persisted_count].metadata
+        position = bisect_right(self._starts, index) - 1
+        return self._segments[position].metadata[index - self._starts[position]]
+
+class IndexSegment:
+    """1つのセグメント（読み取り専用、数値配列はmemmap）"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        
+        with open(os.path.join(path, "header.json"), "r", encoding="utf-8") as f:
+            self.header = json.load(f)
+        self._check_version()
+        
+        self.num_docs = self.header["num_docs"]
+        
+        with open(os.path.join(path, "metadata.json"), "r", encoding="utf-8") as f:
+            self.metadata = json.load(f)
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf-8") as f:
+            self.terms = json.load(f)
+        
+        self.doc_offsets = self._map("doc_offsets.npy")
+        self.indptr = self._map("indptr.npy")
+        self.indices = self._map("indices.npy")
+        self.counts = self._map("counts.npy")
+        self.lengths = self._map("lengths.npy")
+        self.df = self._map("df.npy")
+        self.weights = self._map("weights.npy")
+        self.norms = self._map("norms.npy")
+        
+        text_path = os.path.join(path, "documents.bin")
+        self._text = np.memmap(text_path, dtype=np.uint8, mode="r") if os.path.getsize(text_path) else None
+    
+    def _check_version(self):
+        """形式名とバージョンを確認し、必要なら変換"""
+        if self.header.get("format") != FORMAT_NAME:
+            raise ValueError(f"Unknown index format in {self.path}: {self.header.get('format')}")
+        
+        version = self.header.get("version", 0)
+        if version > FORMAT_VERSION:
+            raise ValueError(f"Index version {version} is newer than supported version {FORMAT_VERSION}")
+        while version < FORMAT_VERSION:
+            upgrader = SEGMENT_UPGRADERS.get(version)
+            if upgrader is None:
+                raise ValueError(f"No upgrader for index version {version}")
+            self.header = upgrader(self.path, self.header)
+            version = self.header["version"]
+    
+    def _map(self, filename: str):
+        return np.load(os.path.join(self.path, filename), mmap_mode="r")
+    
+    def get_document(self, doc_id: int) -> Document:
+        """オフセット表を使ってチャンク本文を読み込む"""
+        start, end = int(self.doc_offsets[doc_id]), int(self.doc_offsets[doc_id + 1])
+        content = bytes(self._text[start:end]).decode("utf-8") if end > start else ""
+        return Document(page_content=content, metadata=self.metadata[doc_id])
+
+def write_segment(directory: str,
+                  name: str,
+                  documents: List[Document],
+                  terms: List[str],
+                  indptr,
+                  indices,
+                  counts,
+                  lengths,
+                  tokenizer: str = None) -> str:
+    """セグメントを一時ディレクトリに書き出し、renameで確定させる（tokenizerは作成に使ったトークナイザーの識別子）"""
+    final_path = os.path.join(directory, name)
+    temp_path = final_path + ".tmp"
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    
+    num_docs = len(documents)
+    counts = np.asarray(counts, dtype=np.int32)
+    lengths = np.asarray(lengths, dtype=np.int32)
+    index_dtype = np.int32 if len(counts) < 2 ** 31 else np.int64
+    indptr = np.asarray(indptr, dtype=index_dtype)
+    indices = np.asarray(indices, dtype=index_dtype)
+    
+    # セグメント内の統計でTF-IDF重みを事前計算（単一セグメント時はそのまま利用）
+    df = np.bincount(indices, minlength=len(terms)).astype(np.int32)
+    idf = np.log(num_docs / np.maximum(df, 1)) if num_docs else np.zeros(len(terms))
+    weights, norms = compute_tfidf_weights(indptr, indices, counts, lengths, idf)
+    
+    # 本文とオフセット表
+    offsets = np.zeros(num_docs + 1, dtype=np.int64)
+    with open(os.path.join(temp_path, "documents.bin"), "wb") as f:
+        for i, doc in enumerate(documents):
+            encoded = doc.page_content.encode("utf-8")
+            f.write(encoded)
+            offsets[i + 1] = offsets[i] + len(encoded)
+    
+    with open(os.path.join(temp_path, "metadata.json"), "w", encoding="utf-8") as f:
+        json.dump([doc.metadata for doc in documents], f, ensure_ascii=False, default=str)
+    with open(os.path.join(temp_path, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(list(terms), f, ensure_ascii=False)
+    
+    for filename, values in [
+        ("doc_offsets.npy", offsets),
+        ("indptr.npy", indptr),
+        ("indices.npy", indices),
+        ("counts.npy", counts),
+        ("lengths.npy", lengths),
+        ("df.npy", df),
+        ("weights.npy", weights),
+        ("norms.npy", norms),
+    ]:
+        np.save(os.path.join(temp_path, filename), values)
+    
+    # ヘッダーは最後に書く（ヘッダーがあれば他のファイルは揃っている）
+    header = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "num_docs": num_docs,
+        "num_terms": len(terms),
+        "nnz": int(len(counts)),
+        "created_at": datetime.now().isoformat(),
+    }
+    if tokenizer:
+        header["tokenizer"] = tokenizer
+    with open(os.path.join(temp_path, "header.json"), "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False, indent=2)
+    
+    os.replace(temp_path, final_path)
+    return final_path
+
+def read_manifest(directory: str) -> Optional[Dict]:
+    """マニフェストを読み込む（存在しない場合はNone）"""
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT_NAME:
+        raise ValueError(f"Unknown manifest format: {manifest.get('format')}")
+    return manifest
+
+def write_manifest(directory: str, manifest: Dict):
+    """マニフェストを一時ファイル経由でアトミックに置き換える"""
+    manifest = dict(manifest, format=FORMAT_NAME, version=FORMAT_VERSION)
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, manifest_path)
+
+def remove_unreferenced_segments(directory: str, manifest: Dict):
+    """マニフェストから参照されていないセグメントを削除"""
+    live = set(manifest.get("segments", []))
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name == MANIFEST_FILE or name in live or not os.path.isdir(path):
+            continue
+        try:
+            shutil.rmtree(path)
+        except OSError as e:
+            # memmap中のファイルが削除できない環境では次回に再試行
+            logger.warning(f"Could not remove old segment {name}: {e}")
@@ -0,0 +1,106 @@
+"""
+列指向のメタデータ索引
+マイコン名・カテゴリ・ファイル名・ファイル形式を整数コードの列で保持し、値ごとの行番号の一覧で絞り込む
+"""
+import logging
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class MetadataIndex:
+    """メタデータ項目ごとに 行 -> 値コード の列と 値コード -> 行 の一覧を持つ索引
+    
+    - 絞り込み: 行ごとの判定は列の整数比較のみ（メタデータ辞書を読まない）
+    - 件数集計: 値ごとの件数を保持しているため値の種類数に比例
+    """
+    
+    FIELDS = ("microcontroller", "category", "filename", "file_type")
+    
+    def __init__(self, fields: Iterable[str] = FIELDS):
+        self.fields = tuple(fields)
+        self.num_rows = 0
+        self.values = {field: [] for field in self.fields}  # コード -> 値
+        self.codes = {field: {} for field in self.fields}  # 値 -> コード
+        self.columns = {field: array("i") for field in self.fields}  # 行 -> コード
+        self.rows = {field: [] for field in self.fields}  # コード -> 行番号の配列
+        self._row_ids = {}  # (項目, 値, ...) -> 一致する行番号の配列（追加時に破棄）
+    
+    def add(self, metadata: Dict):
+        """1行分のメタデータを追加"""
+        row = self.num_rows
+        for field in self.fields:
+            value = metadata.get(field)
+            code = self.codes[field].get(value)
+            if code is None:
+                code = len(self.values[field])
+                self.codes[field][value] = code
+                self.values[field].append(value)
+                self.rows[field].append(array("i"))
+            self.columns[field].append(code)
+            self.rows[field][code].append(row)
+        self.num_rows += 1
+        self._row_ids.clear()
+    
+    def extend(self, metadatas: Iterable[Dict]):
+        for metadata in metadatas:
+            self.add(metadata)
+    
+    def counts(self, field: str) -> Dict[Optional[str], int]:
+        """値ごとの行数（0件の値は除く）"""
+        return {
+            value: len(rows)
+            for value, rows in zip(self.values[field], self.rows[field]) if rows
+        }
+    
+    def conditions(self, filters: Dict[str, Optional[str]]) -> Optional[List]:
+        """絞り込み条件を(列, コード)のリストに変換
+        
+        条件なしの場合は空リスト、存在しない値を指定した場合はNone（一致する行なし）
+        """
+        conditions = []
+        for field, value in filters.items():
+            if not value:
+                continue
+            code = self.codes[field].get(value)
+            if code is None:
+                return None
+            conditions.append((self.columns[field], code))
+        return conditions
+    
+    def matching_rows(self, filters: Dict[str, Optional[str]]) -> List[int]:
+        """条件に一致する行番号（最も件数の少ない値の行だけを走査）"""
+        conditions = self.conditions(filters)
+        if conditions is None:
+            return []
+        if not conditions:
+            return list(range(self.num_rows))
+        
+        candidates = min(
+            (self.rows[field][self.codes[field][value]] for field, value in filters.items() if value),
+            key=len
+        )
+        return [row for row in candidates if all(column[row] == code for column, code in conditions)]
+    
+    def row_ids(self, filters: Dict[str, Optional[str]]):
+        """条件に一致する行番号の昇順配列（条件なしの場合はNone、同じ条件は再利用）
+        
+        NumPyがない環境では行番号のリストを返す
+        """
+        key = tuple(sorted((field, value) for field, value in filters.items() if value))
+        if not key:
+            return None
+        rows = self._row_ids.get(key)
+        if rows is None:
+            rows = self.matching_rows(filters)
+            if NUMPY_AVAILABLE:
+                rows = np.asarray(rows, dtype=np.int64)
+            self._row_ids[key] = rows
+        return rows
@@ -0,0 +1,412 @@
+"""
+RAGエンジン用のクエリキャッシュ
+検索結果と最終回答の2段階キャッシュ（LRU + TTL、コーパスバージョンで自動無効化）
+および言い換えにも当たる質問の類似度ベースの回答キャッシュ
+"""
+import os
+import re
+import math
+import time
+import atexit
+import pickle
+import weakref
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from langchain.schema import Document
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def normalize_query(text: str) -> str:
+    """キャッシュキー用にクエリを正規化（全角/半角・大文字小文字・空白の揺れを吸収）"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return " ".join(text.split())
+
+# 質問の言い回しだけに現れる語（類似度の計算から除く）
+QUESTION_STOPWORDS = ("使い方", "やり方", "仕方", "方法", "手順", "教え", "説明", "質問", "場合", "について")
+_QUESTION_TERM_PATTERN = re.compile(r"[a-z0-9_.+#-]+|[\u30a0-\u30ff]+|[\u4e00-\u9fff々]+")
+_QUESTION_STOPWORD_PATTERN = re.compile("|".join(QUESTION_STOPWORDS))
+
+# 否定の活用語尾（ひらがなを除いても否定の有無は区別する）
+NEGATION_TERM = "<否定>"
+_NEGATION_PATTERN = re.compile(r"ない|なく|なかっ|ません|ずに|ず[、。 ]|ず$|ぬ[、。 ]|ぬ$")
+
+def question_terms(text: str) -> Dict[str, int]:
+    """質問の内容語（英数字の語・カタカナ語・漢字の2文字組）と否定の出現数
+    
+    ひらがな（助詞・活用語尾）と質問の定型語は除くため、
+    「LEDを点滅させたい」と「LED点滅の方法」は同じ語の集合になる。
+    否定（ない・ません・ずなど）はNEGATION_TERMとして残すため、「点灯させない」は「点灯させる」と一致しない
+    """
+    terms = Counter()
+    text = normalize_query(text)
+    negations = len(_NEGATION_PATTERN.findall(text))
+    if negations:
+        terms[NEGATION_TERM] = negations
+    text = _QUESTION_STOPWORD_PATTERN.sub(" ", text)
+    for run in _QUESTION_TERM_PATTERN.findall(text):
+        if run[0].isascii() or "\u30a0" <= run[0] <= "\u30ff" or len(run) == 1:
+            terms[run] += 1
+            continue
+        for i in range(len(run) - 1):
+            terms[run[i:i + 2]] += 1
+    return dict(terms)
+
+def chunk_key(doc: Document) -> str:
+    """チャンクの識別子（chunk_idがなければ本文のハッシュ）"""
+    chunk_id = doc.metadata.get("chunk_id")
+    if chunk_id:
+        return str(chunk_id)
+    return hashlib.md5(doc.page_content.encode("utf-8")).hexdigest()[:16]
+
+# 未保存の変更を終了時に書き出す永続化キャッシュ
+_persistent_caches = weakref.WeakSet()
+
+@atexit.register
+def _flush_persistent_caches():
+    for cache in list(_persistent_caches):
+        cache.flush()
+
+class LRUCache:
+    """件数上限と有効期限付きのスレッドセーフなLRUキャッシュ
+    
+    persist_pathを指定した場合、変更はflush_interval秒ごとにまとめてディスクへ書き出す
+    （0で変更のたびに保存。プロセス終了時には未保存の変更を書き出す）
+    """
+    
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 3600, persist_path: str = None,
+                 flush_interval: float = 5.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()  # key -> (保存時刻, 値)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # 書き出しの直列化
+        self._dirty = False
+        self._flush_timer = None
+        self.hits = 0
+        self.misses = 0
+        self.version = None  # 保存時のコーパスバージョン
+        
+        if persist_path:
+            self._load()
+            _persistent_caches.add(self)
+    
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            stored_at, value = entry
+            if self.ttl_seconds and time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._mark_dirty()
+        
+        if self.persist_path and self.flush_interval <= 0:
+            self.flush()
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._mark_dirty()
+        
+        if self.persist_path and self.flush_interval <= 0:
+            self.flush()
+    
+    def _mark_dirty(self):
+        """未保存の変更を記録し、書き出しのタイマーを1つだけ起動（_lockを保持して呼ぶ）"""
+        if not self.persist_path:
+            return
+        self._dirty = True
+        if self.flush_interval > 0 and self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+    
+    def flush(self):
+        """未保存の変更があればディスクに書き出す"""
+        if not self.persist_path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                data = {"version": self.version, "entries": list(self._entries.items())}
+            
+            if not self._save(data):
+                # 次の変更時または終了時に再試行
+                with self._lock:
+                    self._dirty = True
+    
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+    
+    def _save(self, data: Dict) -> bool:
+        """一時ファイル経由でディスクに保存"""
+        try:
+            os.makedirs(os.path.dirname(self.persist_path), exist_ok=True)
+            temp_path = self.persist_path + ".tmp"
+            with open(temp_path, "wb") as f:
+                pickle.dump(data, f)
+            os.replace(temp_path, self.persist_path)
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to persist cache: {e}")
+            return False
+    
+    def _load(self):
+        try:
+            if os.path.exists(self.persist_path):
+                with open(self.persist_path, "rb") as f:
+                    data = pickle.load(f)
+                self.version = data.get("version")
+                self._entries = OrderedDict(data.get("entries", []))
+                logger.info(f"Loaded {len(self._entries)} cached entries from {self.persist_path}")
+        except Exception as e:
+            logger.warning(f"Failed to load cache: {e}")
+            self._entries = OrderedDict()
+
+class SemanticAnswerCache:
+    """質問の類似度で引く回答キャッシュ（件数上限と有効期限付き）
+    
+    同じスコープ（マイコン名・モデルなど）の保存済み質問のうち、類似度が最も高いものが
+    threshold以上ならその回答を返す。類似度はembedを指定した場合は埋め込みのコサイン類似度、
+    それ以外は内容語ベクトルのコサイン類似度（語ごとの転置リストから候補を引き、全件とは比較しない）。
+    いずれの場合も否定の有無が異なる質問と、内容語がshort_question_terms以下で内容語が完全一致しない質問は一致としない
+    """
+    
+    def __init__(self,
+                 max_entries: int = 256,
+                 ttl_seconds: float = 86400,
+                 threshold: float = 0.9,
+                 vectorize: Callable[[str], Dict[str, float]] = None,
+                 embed: Callable[[str], List[float]] = None,
+                 short_question_terms: int = 3):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.vectorize = vectorize or question_terms
+        self.embed = embed
+        self.short_question_terms = short_question_terms
+        self._entries = OrderedDict()  # 番号 -> (保存時刻, スコープ, 質問, 内容語ベクトル, ノルム, 埋め込み, 埋め込みのノルム, 値)
+        self._postings = {}  # (スコープ, 語) -> 番号の集合
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.version = None  # 保存時のコーパスバージョン
+    
+    def _embed(self, question: str) -> Tuple[Optional[List[float]], float]:
+        """質問の埋め込みとノルム（embedなし・失敗時はNone）"""
+        if self.embed is None:
+            return None, 0.0
+        try:
+            embedding = [float(value) for value in self.embed(question)]
+        except Exception as e:
+            # モデルを読み込めない環境では以降は内容語で比較
+            logger.warning(f"Question embedding unavailable, using content terms for the semantic cache: {e}")
+            self.embed = None
+            return None, 0.0
+        return embedding, math.sqrt(sum(value * value for value in embedding))
+    
+    def _compatible(self, terms: Dict[str, float], entry_terms: Dict[str, float]) -> bool:
+        """否定の有無が同じで、短い質問は内容語が完全一致するか"""
+        if bool(terms.get(NEGATION_TERM)) != bool(entry_terms.get(NEGATION_TERM)):
+            return False
+        content = set(terms) - {NEGATION_TERM}
+        entry_content = set(entry_terms) - {NEGATION_TERM}
+        if min(len(content), len(entry_content)) <= self.short_question_terms:
+            return content == entry_content
+        return True
+    
+    def _similarities(self, scope: Hashable, terms: Dict[str, float], norm: float,
+                      embedding: Optional[List[float]], embedding_norm: float) -> Dict[int, float]:
+        """同じスコープの保存済み質問との類似度（_lockを保持して呼ぶ）"""
+        similarities = {}
+        if embedding is not None and embedding_norm:
+            for entry_id, entry in self._entries.items():
+                if entry[1] != scope or entry[5] is None or not entry[6]:
+                    continue
+                dot_product = sum(a * b for a, b in zip(embedding, entry[5]))
+                similarities[entry_id] = dot_product / (embedding_norm * entry[6])
+            return similarities
+        
+        if norm:
+            for term, weight in terms.items():
+                for entry_id in self._postings.get((scope, term), ()):
+                    entry_terms = self._entries[entry_id][3]
+                    similarities[entry_id] = similarities.get(entry_id, 0.0) + weight * entry_terms[term]
+            for entry_id in similarities:
+                similarities[entry_id] /= norm * self._entries[entry_id][4]
+        return similarities
+    
+    def get(self, question: str, scope: Hashable) -> Optional[Tuple[Any, float, str]]:
+        """類似する質問の(値, 類似度, 保存済みの質問)。見つからなければNone"""
+        terms = self.vectorize(question)
+        norm = math.sqrt(sum(weight * weight for weight in terms.values()))
+        embedding, embedding_norm = self._embed(question)
+        with self._lock:
+            self._expire()
+            best, best_similarity = None, 0.0
+            for entry_id, similarity in self._similarities(scope, terms, norm, embedding, embedding_norm).items():
+                if similarity > best_similarity and self._compatible(terms, self._entries[entry_id][3]):
+                    best, best_similarity = entry_id, similarity
+            
+            if best is None or best_similarity < self.threshold:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(best)
+            self.hits += 1
+            entry = self._entries[best]
+            return entry[7], best_similarity, entry[2]
+    
+    def set(self, question: str, scope: Hashable, value: Any):
+        terms = self.vectorize(question)
+        norm = math.sqrt(sum(weight * weight for weight in terms.values()))
+        if not norm:
+            return
+        embedding, embedding_norm = self._embed(question)
+        
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (time.time(), scope, question, terms, norm, embedding, embedding_norm, value)
+            for term in terms:
+                self._postings.setdefault((scope, term), set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+    
+    def _expire(self):
+        """有効期限切れのエントリを削除（保存順に並んでいるとは限らないため全件確認）"""
+        if not self.ttl_seconds:
+            return
+        now = time.time()
+        for entry_id in [entry_id for entry_id, entry in self._entries.items() if now - entry[0] > self.ttl_seconds]:
+            self._remove(entry_id)
+    
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        scope, terms = entry[1], entry[3]
+        for term in terms:
+            entry_ids = self._postings.get((scope, term))
+            if entry_ids is not None:
+                entry_ids.discard(entry_id)
+                if not entry_ids:
+                    del self._postings[(scope, term)]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._postings.clear()
+    
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "similarity": "embedding" if self.embed is not None else "content_terms",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+class RAGQueryCache:
+    """検索結果キャッシュと回答キャッシュ"""
+    
+    def __init__(self,
+                 retrieval_size: int = 512,
+                 retrieval_ttl: float = 3600,
+                 answer_size: int = 256,
+                 answer_ttl: float = 86400,
+                 answer_persist_path: str = None,
+                 answer_flush_interval: float = 5.0,
+                 semantic_size: int = 0,
+                 semantic_ttl: float = 86400,
+                 semantic_threshold: float = 0.9,
+                 semantic_embed: Callable[[str], List[float]] = None,
+                 semantic_short_question_terms: int = 3):
+        self.retrieval = LRUCache(retrieval_size, retrieval_ttl)
+        self.answers = LRUCache(answer_size, answer_ttl, persist_path=answer_persist_path,
+                                flush_interval=answer_flush_interval)
+        # 言い換えた質問向けの回答キャッシュ（semantic_size=0で無効）
+        self.semantic = None
+        if semantic_size:
+            self.semantic = SemanticAnswerCache(
+                semantic_size, semantic_ttl, semantic_threshold,
+                embed=semantic_embed, short_question_terms=semantic_short_question_terms
+            )
+    
+    def sync_corpus_version(self, corpus_version: str):
+        """コーパスが更新されていればキャッシュを破棄"""
+        for cache in (self.retrieval, self.answers, self.semantic):
+            if cache is None:
+                continue
+            if cache.version != corpus_version:
+                if cache.version is not None:
+                    logger.info("Corpus version changed. Clearing query cache")
+                cache.version = corpus_version
+                cache.clear()
+    
+    def retrieval_key(self,
+                      query: str,
+                      microcontroller: Optional[str],
+                      k: int,
+                      category: Optional[str],
+                      score_threshold: float,
+                      ranking: Optional[str] = None) -> Tuple:
+        return (normalize_query(query), microcontroller, k, category, score_threshold, ranking)
+    
+    def answer_key(self,
+                   kind: str,
+                   question: str,
+                   relevant_docs: List[Tuple[Document, float]],
+                   microcontroller: str,
+                   model: str,
+                   temperature: float) -> Tuple:
+        chunk_ids = tuple(chunk_key(doc) for doc, _ in relevant_docs)
+        return (kind, normalize_query(question), chunk_ids, microcontroller, model, temperature)
+    
+    def flush(self):
+        """永続化している回答キャッシュの未保存の変更を書き出す"""
+        self.answers.flush()
+    
+    def stats(self) -> Dict:
+        return {
+            "retrieval": self.retrieval.stats(),
+            "answers": self.answers.stats(),
+            "semantic": self.semantic.stats() if self.semantic else {}
+        }
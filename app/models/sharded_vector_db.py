@@ -0,0 +1,247 @@
+"""
+マイコンごとにシャード分割したベクトルデータベース
+ボードごとに独立したSimpleVectorDatabase（インデックス・ファイル）を持ち、
+初回利用時に読み込み、使われていないシャードはLRUで解放する
+"""
+import re
+import time
+import uuid
+import logging
+import shutil
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+from langchain.schema import Document
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from models.simple_vector_db import SimpleVectorDatabase
+from utils.helpers import load_json_file, save_json_file
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def shard_directory_name(microcontroller: str) -> str:
+    """マイコン名からシャードのディレクトリ名を作成"""
+    return "microcontroller_" + re.sub(r"[^a-z0-9]+", "_", microcontroller.lower()).strip("_")
+
+class ShardedVectorDatabase:
+    """マイコンごとのシャードを束ねるベクトルデータベース
+    
+    - マイコン指定の検索はそのボードのシャードだけを読み込み・走査する
+    - 件数・ソース一覧はシャード一覧ファイルから返す（シャードを読み込まない）
+    - 1ボードの再構築は他のシャードのファイルに触れない
+    """
+    
+    REGISTRY_FILE = "shards.json"
+    REGISTRY_VERSION = 1
+    
+    def __init__(self, persist_directory: str = None, max_loaded_shards: int = None, idle_seconds: float = None):
+        self.persist_directory = persist_directory or Config.get_vector_db_path()
+        self.shards_directory = os.path.join(self.persist_directory, "shards")
+        self.max_loaded_shards = max_loaded_shards or Config.SHARD_MAX_LOADED
+        self.idle_seconds = Config.SHARD_IDLE_SECONDS if idle_seconds is None else idle_seconds
+        
+        self._lock = threading.RLock()
+        self._loaded = OrderedDict()  # マイコン名 -> SimpleVectorDatabase（末尾が最近使用）
+        self._last_used = {}  # マイコン名 -> 最終使用時刻
+        self.stats = {"loads": 0, "unloads": 0}
+        
+        # シャード一覧: マイコン名 -> {"directory", "documents", "sources": {source: チャンク数}}
+        self.shards = {}
+        self._corpus_version = uuid.uuid4().hex
+        self._load_registry()
+    
+    # シャード一覧の永続化
+    
+    def _registry_path(self) -> str:
+        return os.path.join(self.persist_directory, self.REGISTRY_FILE)
+    
+    def _load_registry(self):
+        data = load_json_file(self._registry_path()) if os.path.exists(self._registry_path()) else None
+        if data and data.get("version") == self.REGISTRY_VERSION:
+            self.shards = data.get("shards", {})
+            self._corpus_version = data.get("corpus_version", self._corpus_version)
+    
+    def _save_registry(self) -> bool:
+        return save_json_file(
+            {"version": self.REGISTRY_VERSION, "corpus_version": self._corpus_version, "shards": self.shards},
+            self._registry_path()
+        )
+    
+    def _update_registry(self, microcontroller: str, vector_db: SimpleVectorDatabase):
+        """シャードの件数・ソースを一覧に反映"""
+        self.shards[microcontroller] = {
+            "directory": shard_directory_name(microcontroller),
+            "documents": len(vector_db.documents),
+            "sources": vector_db.list_sources()
+        }
+        self._corpus_version = uuid.uuid4().hex
+        self._save_registry()
+    
+    # シャードの読み込み・解放
+    
+    def _shard_path(self, microcontroller: str) -> str:
+        return os.path.join(self.shards_directory, shard_directory_name(microcontroller))
+    
+    def shard(self, microcontroller: str, create: bool = False) -> Optional[SimpleVectorDatabase]:
+        """シャードを取得（未読み込みなら読み込み、存在しない場合はcreate=Trueで作成）"""
+        with self._lock:
+            vector_db = self._loaded.get(microcontroller)
+            if vector_db is None:
+                if microcontroller not in self.shards and not create:
+                    return None
+                vector_db = SimpleVectorDatabase(self._shard_path(microcontroller))
+                self._loaded[microcontroller] = vector_db
+                self.stats["loads"] += 1
+                logger.info(f"Loaded shard: {microcontroller} ({len(vector_db.documents)} chunks)")
+            
+            self._loaded.move_to_end(microcontroller)
+            self._last_used[microcontroller] = time.monotonic()
+            self._evict(keep=microcontroller)
+            return vector_db
+    
+    def _evict(self, keep: str = None):
+        """上限を超えた分と一定時間使われていないシャードを解放"""
+        now = time.monotonic()
+        for microcontroller in list(self._loaded):
+            if microcontroller == keep:
+                continue
+            over_capacity = len(self._loaded) > self.max_loaded_shards
+            idle = self.idle_seconds and now - self._last_used.get(microcontroller, now) > self.idle_seconds
+            if over_capacity or idle:
+                self.unload(microcontroller)
+    
+    def unload(self, microcontroller: str):
+        """シャードをメモリから解放（データは保存済み）"""
+        with self._lock:
+            if self._loaded.pop(microcontroller, None) is not None:
+                self._last_used.pop(microcontroller, None)
+                self.stats["unloads"] += 1
+                logger.info(f"Unloaded shard: {microcontroller}")
+    
+    def loaded_shards(self) -> List[str]:
+        with self._lock:
+            return list(self._loaded)
+    
+    # 追加・削除・再構築
+    
+    def add_documents(self, documents: List[Document], microcontroller: str = "NUCLEO-F767ZI") -> bool:
+        """ドキュメントをマイコンのシャードに追加"""
+        with self._lock:
+            vector_db = self.shard(microcontroller, create=True)
+            if not vector_db.add_documents(documents, microcontroller):
+                return False
+            self._update_registry(microcontroller, vector_db)
+            return True
+    
+    def delete_documents_by_source(self, sources: List[str], save: bool = True) -> int:
+        """指定sourceのチャンクを削除（該当ソースを持つシャードのみ読み込む）"""
+        targets = set(sources)
+        removed = 0
+        with self._lock:
+            for microcontroller, info in list(self.shards.items()):
+                if not targets & set(info["sources"]):
+                    continue
+                vector_db = self.shard(microcontroller)
+                removed += vector_db.delete_documents_by_source(list(targets), save)
+                self._update_registry(microcontroller, vector_db)
+        return removed
+    
+    def rebuild_shard(self, microcontroller: str, documents: List[Document]) -> bool:
+        """1ボードのシャードを作り直す（他のシャードには触れない）"""
+        with self._lock:
+            self.unload(microcontroller)
+            shutil.rmtree(self._shard_path(microcontroller), ignore_errors=True)
+            self.shards.pop(microcontroller, None)
+            if not documents:
+                self._corpus_version = uuid.uuid4().hex
+                return self._save_registry()
+            return self.add_documents(documents, microcontroller)
+    
+    # 検索
+    
+    def search_similar_documents(self,
+                               query: str,
+                               k: int = 5,
+                               microcontroller: str = None,
+                               category: str = None,
+                               score_threshold: float = 0.1,
+                               ranking: str = None) -> List[Tuple[Document, float]]:
+        """類似ドキュメントを検索
+        
+        マイコン指定時はそのシャードのみ。未指定時は全シャードを順に検索して距離の小さい順に統合する
+        （IDFはシャードごとに計算されるため、シャードをまたぐスコアは近似的な比較になる）
+        """
+        try:
+            targets = [microcontroller] if microcontroller else list(self.shards)
+            results = []
+            for name in targets:
+                vector_db = self.shard(name)
+                if vector_db is None:
+                    continue
+                results.extend(vector_db.search_similar_documents(
+                    query, k=k, category=category, score_threshold=score_threshold, ranking=ranking
+                ))
+            
+            results.sort(key=lambda item: item[1])
+            return results[:k]
+        
+        except Exception as e:
+            logger.error(f"Search failed: {e}")
+            return []
+    
+    def get_relevant_documents(self,
+                             query: str,
+                             k: int = 5,
+                             microcontroller: str = None) -> List[Document]:
+        """関連ドキュメントを取得"""
+        results = self.search_similar_documents(query, k, microcontroller)
+        return [doc for doc, score in results]
+    
+    def get_neighbor_chunks(self, filename: str, chunk_index: int, window: int = 1) -> List[Document]:
+        """隣接チャンクを取得（そのファイルを持つシャードのみ参照）"""
+        for microcontroller, info in self.shards.items():
+            if any(os.path.basename(source) == filename for source in info["sources"]):
+                neighbors = self.shard(microcontroller).get_neighbor_chunks(filename, chunk_index, window)
+                if neighbors:
+                    return neighbors
+        return []
+    
+    # 一覧・統計（シャードを読み込まない）
+    
+    @property
+    def corpus_version(self) -> str:
+        """いずれかのシャードが変更されると変わる識別子"""
+        return self._corpus_version
+    
+    @property
+    def documents(self) -> range:
+        """全シャードのチャンク数（件数のみ、シャードは読み込まない）"""
+        return range(sum(info["documents"] for info in self.shards.values()))
+    
+    def list_sources(self) -> Dict[str, int]:
+        """登録済みチャンクのsourceごとの件数"""
+        sources = {}
+        for info in self.shards.values():
+            for source, count in info["sources"].items():
+                sources[source] = sources.get(source, 0) + count
+        return sources
+    
+    def list_collections(self) -> List[str]:
+        """利用可能なコレクションを一覧表示"""
+        return [info["directory"] for info in self.shards.values() if info["documents"]]
+    
+    def get_collection_stats(self, microcontroller: str = None) -> Dict:
+        """コレクションの統計情報を取得"""
+        names = [microcontroller] if microcontroller else list(self.shards)
+        return {
+            shard_directory_name(name): {
+                "document_count": self.shards.get(name, {}).get("documents", 0),
+                "microcontroller": name
+            }
+            for name in names
+        }
@@ -1,8 +1,15 @@
 """
 シンプルなRAGエンジン（TF-IDF + テンプレートベース回答生成 + OpenAI統合）
 """
+import asyncio
 import logging
-from typing import List, Dict, Optional, Tuple
+import time
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Callable, Iterator, List, Dict, Optional, Tuple
 from langchain.schema import Document
 from langchain.prompts import PromptTemplate
 
@@ -12,10 +19,13 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from config import Config
 from models.simple_vector_db import SimpleVectorDatabase
+from models.query_cache import RAGQueryCache
+from models.context_builder import ContextBuilder, overlap_length
+from models.prompt_layout import PromptLayout
 
 # OpenAI統合のためのインポート
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
     OPENAI_AVAILABLE = True
 except ImportError:
     OPENAI_AVAILABLE = False
@@ -24,6 +34,39 @@ except ImportError:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class StreamingAnswer:
+    """生成中のトークンを逐次返すイテレータ
+    
+    最初のトークンまでの時間（TTFT）と全体の所要時間を計測し、完了時に全文を保持する
+    """
+    
+    def __init__(self, tokens: Iterator[str], started_at: float = None,
+                 on_complete: Callable[["StreamingAnswer"], None] = None):
+        self._tokens = tokens
+        self._started_at = started_at or time.perf_counter()
+        self._on_complete = on_complete
+        self.text = ""
+        self.result = None  # 完了後の整形済み結果（コード生成時など）
+        self.time_to_first_token = None  # 秒
+        self.total_time = None  # 秒
+    
+    def __iter__(self) -> Iterator[str]:
+        parts = []
+        for token in self._tokens:
+            if not token:
+                continue
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - self._started_at
+            parts.append(token)
+            yield token
+        
+        self.text = "".join(parts)
+        self.total_time = time.perf_counter() - self._started_at
+        if self.time_to_first_token is None:
+            self.time_to_first_token = self.total_time
+        if self._on_complete:
+            self._on_complete(self)
+
 class SimpleRAGEngine:
     """シンプルなRAGエンジン"""
     
@@ -49,9 +92,118 @@ class SimpleRAGEngine:
             self.use_openai = False
             logger.info("Using template-based responses (OpenAI not available)")
         
+        # 検索結果・回答キャッシュ（コーパス更新時に自動で無効化）
+        self.query_cache = None
+        if Config.QUERY_CACHE_ENABLED:
+            persist_path = None
+            if Config.ANSWER_CACHE_PERSIST:
+                persist_path = os.path.join(Config.get_data_path(), "cache", "answer_cache.pkl")
+            self.query_cache = RAGQueryCache(
+                retrieval_size=Config.RETRIEVAL_CACHE_SIZE,
+                retrieval_ttl=Config.RETRIEVAL_CACHE_TTL,
+                answer_size=Config.ANSWER_CACHE_SIZE,
+                answer_ttl=Config.ANSWER_CACHE_TTL,
+                answer_persist_path=persist_path,
+                answer_flush_interval=Config.ANSWER_CACHE_FLUSH_INTERVAL,
+                semantic_size=Config.SEMANTIC_CACHE_SIZE if Config.SEMANTIC_CACHE_ENABLED else 0,
+                semantic_ttl=Config.SEMANTIC_CACHE_TTL,
+                semantic_threshold=Config.SEMANTIC_CACHE_THRESHOLD,
+                semantic_embed=self._semantic_embedder() if Config.SEMANTIC_CACHE_ENABLED else None,
+                semantic_short_question_terms=Config.SEMANTIC_CACHE_SHORT_QUESTION_TERMS
+            )
+        
+        # ストリーミング応答のレイテンシ計測（直近の値のみ保持）
+        self.latency_samples = {
+            "time_to_first_token": deque(maxlen=500),
+            "total_time": deque(maxlen=500)
+        }
+        
+        # トークン予算内でのコンテキスト組み立てと、作成したプロンプトのトークン数（直近の値のみ保持）
+        self.context_builder = ContextBuilder(Config.CONTEXT_TOKEN_BUDGET)
+        self.code_context_builder = ContextBuilder(Config.CODE_CONTEXT_TOKEN_BUDGET, self.context_builder.counter)
+        self.prompt_token_samples = deque(maxlen=500)
+        
+        # マイコンごとに固定のシステムプロンプト（プロンプトキャッシュ用）と、APIが返したトークン使用量の累計
+        self.prompt_layout = PromptLayout(self.context_builder.counter)
+        self.token_usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self._usage_lock = threading.Lock()
+        
+        # 非同期API用: 検索はスレッドで実行し、AsyncOpenAIクライアントと同時実行数の制限はイベントループごとに作成
+        self._retrieval_executor = None
+        self._async_states = weakref.WeakKeyDictionary()
+        
         self._setup_prompts()
         self._setup_templates()
     
+    def _search(self,
+                query: str,
+                k: int,
+                microcontroller: str = None,
+                category: str = None,
+                score_threshold: float = 0.05) -> List[Tuple[Document, float]]:
+        """キャッシュ付きの類似ドキュメント検索"""
+        if self.query_cache is None:
+            return self.vector_db.search_similar_documents(
+                query=query,
+                k=k,
+                microcontroller=microcontroller,
+                category=category,
+                score_threshold=score_threshold
+            )
+        
+        self.query_cache.sync_corpus_version(self._corpus_version())
+        key = self.query_cache.retrieval_key(query, microcontroller, k, category, score_threshold,
+                                             Config.SIMPLE_RANKING)
+        cached = self.query_cache.retrieval.get(key)
+        if cached is not None:
+            return list(cached)
+        
+        results = self.vector_db.search_similar_documents(
+            query=query,
+            k=k,
+            microcontroller=microcontroller,
+            category=category,
+            score_threshold=score_threshold
+        )
+        self.query_cache.retrieval.set(key, list(results))
+        return results
+    
+    def _corpus_version(self) -> str:
+        """ベクトルストアのコーパスバージョン（未対応のストアでは件数で代用）"""
+        version = getattr(self.vector_db, "corpus_version", None)
+        if version is None:
+            version = str(len(getattr(self.vector_db, "documents", [])))
+        return version
+    
+    def _lookup_completion(self, kind: str, question: str, relevant_docs: List[Tuple[Document, float]],
+                           microcontroller: str, temperature: float):
+        """回答キャッシュを参照し、(キー, キャッシュ値またはNone)を返す"""
+        if self.query_cache is None:
+            return None, None
+        
+        self.query_cache.sync_corpus_version(self._corpus_version())
+        key = self.query_cache.answer_key(kind, question, relevant_docs, microcontroller,
+                                          Config.LLM_MODEL, temperature)
+        cached = self.query_cache.answers.get(key)
+        if cached is not None:
+            logger.info(f"Answer cache hit ({kind})")
+        return key, cached
+    
+    def _store_completion(self, key, result):
+        if self.query_cache is not None and key is not None:
+            self.query_cache.answers.set(key, result)
+    
+    def _cached_completion(self, kind: str, question: str, relevant_docs: List[Tuple[Document, float]],
+                           microcontroller: str, temperature: float, generate):
+        """回答キャッシュを参照し、なければgenerate()でLLMを呼び出して保存"""
+        key, cached = self._lookup_completion(kind, question, relevant_docs, microcontroller, temperature)
+        if cached is not None:
+            return cached
+        
+        result = generate()
+        self._store_completion(key, result)
+        return result
+    
     def _setup_prompts(self):
         """プロンプトテンプレートの設定"""
         self.qa_prompt = PromptTemplate(
@@ -386,7 +538,7 @@ void LED_Blink_Example(void)
         HAL_Delay(500);
     }}
 }}""",
-            
+
             "button": """// {microcontroller} ボタン入力サンプル
 #include "main.h"
 
@@ -407,7 +559,7 @@ void Button_Control_Example(void)
         HAL_GPIO_WritePin(GPIOB, GPIO_PIN_0, GPIO_PIN_RESET); // LED消灯
     }}
 }}""",
-            
+
             "pwm": """// {microcontroller} PWM制御サンプル
 #include "main.h"
 
@@ -425,7 +577,7 @@ void PWM_Control_Example(void)
         HAL_Delay(10);
     }}
 }}""",
-            
+
             "uart": """// {microcontroller} UART通信サンプル
 #include "main.h"
 #include <string.h>
@@ -448,7 +600,7 @@ void UART_Communication_Example(void)
         // 受信データの処理をここに記述
     }}
 }}""",
-            
+
             "adc": """// {microcontroller} ADC読み取りサンプル
 #include "main.h"
 
@@ -474,7 +626,7 @@ uint32_t ADC_Read_Example(void)
     HAL_ADC_Stop(&hadc1);
     return adc_value;
 }}""",
-            
+
             "simulink": """// {microcontroller} Simulink自動生成コード例
 /* Simulinkモデルから生成されたC/C++コード */
 #include "rtwtypes.h"
@@ -528,7 +680,7 @@ Simulinkモデル設計のポイント:
 4. ソルバー: Fixed-step discrete
 5. External Mode: リアルタイムモニタリング用
 */""",
-            
+
             "cubemx": """// {microcontroller} CubeMX生成プロジェクト基本構造
 #include "main.h"
 
@@ -586,10 +738,14 @@ CubeMX使用時の注意点:
                        question: str, 
                        microcontroller: str = "NUCLEO-F767ZI",
                        num_docs: int = 5) -> Dict:
-        """質問に対してRAGベースで回答を生成"""
+        """質問に対してRAGベースで回答を生成（言い換えを含む類似の質問は回答キャッシュから返す）"""
         try:
+            cached = self._lookup_semantic_answer(question, microcontroller, num_docs)
+            if cached is not None:
+                return cached
+            
             # 1. 関連ドキュメントを検索
-            relevant_docs = self.vector_db.search_similar_documents(
+            relevant_docs = self._search(
                 query=question,
                 k=num_docs,
                 microcontroller=microcontroller,
@@ -597,15 +753,10 @@ CubeMX使用時の注意点:
             )
             
             if not relevant_docs:
-                return {
-                    "answer": "申し訳ございませんが、関連する情報が見つかりませんでした。質問を言い換えてお試しください。",
-                    "sources": [],
-                    "confidence": 0.0,
-                    "microcontroller": microcontroller
-                }
+                return self.no_context_answer(microcontroller)
             
             # 2. 回答生成
-            answer = self._generate_answer(question, relevant_docs, microcontroller)
+            answer, generated_by = self._generate_answer(question, relevant_docs, microcontroller)
             
             # 3. 信頼度計算
             confidence = self._calculate_confidence(relevant_docs)
@@ -613,14 +764,17 @@ CubeMX使用時の注意点:
             # 4. ソース情報の収集
             sources = self._extract_sources(relevant_docs)
             
-            return {
+            result = {
                 "answer": answer,
                 "sources": sources,
                 "confidence": confidence,
                 "microcontroller": microcontroller,
-                "num_sources": len(relevant_docs)
+                "num_sources": len(relevant_docs),
+                "generated_by": generated_by
             }
-            
+            self._store_semantic_answer(question, microcontroller, num_docs, result)
+            return result
+        
         except Exception as e:
             logger.error(f"Failed to answer question: {e}")
             return {
@@ -630,8 +784,21 @@ CubeMX使用時の注意点:
                 "microcontroller": microcontroller
             }
     
-    def _generate_answer(self, question: str, relevant_docs: List[Tuple[Document, float]], microcontroller: str) -> str:
-        """回答生成（OpenAI API使用可能時はより高品質な回答を生成）"""
+    def no_context_answer(self, microcontroller: str) -> Dict:
+        """関連ドキュメントが見つからなかった質問への回答（LLMは呼び出さない）"""
+        return {
+            "answer": "申し訳ございませんが、関連する情報が見つかりませんでした。質問を言い換えてお試しください。",
+            "sources": [],
+            "confidence": 0.0,
+            "microcontroller": microcontroller
+        }
+    
+    def _generate_answer(self, question: str, relevant_docs: List[Tuple[Document, float]],
+                         microcontroller: str) -> Tuple[str, str]:
+        """回答生成（OpenAI API使用可能時はより高品質な回答を生成）
+        
+        (回答, 生成方式 "openai" / "template") を返す
+        """
         
         # ソース情報を作成
         sources = [doc.metadata.get("filename", "不明") for doc, _ in relevant_docs[:3]]
@@ -640,70 +807,291 @@ CubeMX使用時の注意点:
         # OpenAI APIが利用可能な場合は高品質な回答を生成
         if self.use_openai and self.openai_client and relevant_docs:
             try:
-                return self._generate_openai_answer(question, relevant_docs, microcontroller, source_str)
+                return self._cached_completion(
+                    "answer", question, relevant_docs, microcontroller, Config.LLM_TEMPERATURE,
+                    lambda: self._generate_openai_answer(question, relevant_docs, microcontroller, source_str)
+                ), "openai"
             except Exception as e:
                 logger.error(f"OpenAI API call failed: {e}")
                 logger.info("Falling back to template-based response")
         
         # フォールバック：テンプレートベース回答
-        return self._generate_template_answer(question, relevant_docs, microcontroller, source_str)
+        return self._generate_template_answer(question, relevant_docs, microcontroller, source_str), "template"
+    
+    def _lookup_semantic_answer(self, question: str, microcontroller: str, num_docs: int) -> Optional[Dict]:
+        """類似の質問の回答がキャッシュにあれば返す（"cache"に一致した質問と類似度を付ける）"""
+        if self.query_cache is None or self.query_cache.semantic is None:
+            return None
+        
+        self.query_cache.sync_corpus_version(self._corpus_version())
+        found = self.query_cache.semantic.get(question, self._semantic_scope(microcontroller, num_docs))
+        if found is None:
+            return None
+        
+        result, similarity, cached_question = found
+        logger.info(f"Semantic answer cache hit ({similarity:.2f}): {cached_question[:50]}")
+        return dict(result, cache={"type": "semantic", "similarity": similarity, "question": cached_question})
+    
+    def _store_semantic_answer(self, question: str, microcontroller: str, num_docs: int, result: Dict):
+        """回答を類似質問キャッシュに保存（OpenAI失敗時のテンプレート回答は保存しない）"""
+        if self.query_cache is None or self.query_cache.semantic is None or not result.get("sources"):
+            return
+        if self.use_openai and result.get("generated_by") != "openai":
+            return
+        self.query_cache.semantic.set(question, self._semantic_scope(microcontroller, num_docs), result)
+    
+    def _semantic_embedder(self):
+        """類似質問キャッシュ用の質問の埋め込み関数（オフラインの埋め込みモデルがない環境ではNone）
+        
+        モデルは最初の質問で読み込む
+        """
+        if not Config.SEMANTIC_CACHE_EMBEDDINGS:
+            return None
+        from models.vector_db_offline import LazyEmbeddings, create_offline_embeddings, offline_dependencies_available
+        if not offline_dependencies_available():
+            logger.info("Offline embedding model not installed. Semantic answer cache compares content terms")
+            return None
+        persist_directory = getattr(self.vector_db, "persist_directory", None) or Config.get_vector_db_path()
+        return LazyEmbeddings(lambda: create_offline_embeddings(persist_directory)).embed_query
+    
+    def _semantic_scope(self, microcontroller: str, num_docs: int) -> Tuple:
+        """類似質問キャッシュで比較する範囲（同じマイコン・件数・モデルの回答のみ）"""
+        return (microcontroller, num_docs, Config.LLM_MODEL if self.use_openai else None)
+    
+    def _build_answer_messages(self, question: str, relevant_docs: List[Tuple[Document, float]],
+                               microcontroller: str, source_str: str) -> List[Dict]:
+        """回答生成用のメッセージを構築"""
+        
+        # ヒットしたチャンクの前後を補う（類似検索はやり直さない）
+        relevant_docs = self._expand_context(relevant_docs[:5])
+        
+        # コンテキストを構築（上位5件をスコア順にトークン予算内へ、重複部分は除く）
+        context, context_report = self.context_builder.build(relevant_docs, label="文書", max_chunks=5)
+        
+        # 固定のシステムプロンプト + 質問・参考ドキュメント・コンテキスト（変わる部分は末尾）
+        messages = self.prompt_layout.answer_messages(microcontroller, question, source_str, context)
+        self._record_prompt_tokens("answer", messages, context_report)
+        return messages
+    
+    def _record_prompt_tokens(self, kind: str, messages: List[Dict], context_report: Dict):
+        """作成したプロンプトのトークン数を記録（メッセージごとの書式分は含まない概算）"""
+        prompt_tokens = sum(self.context_builder.counter.count(message["content"]) for message in messages)
+        self.prompt_token_samples.append(prompt_tokens)
+        logger.info(f"Prompt ({kind}): {prompt_tokens} tokens, context {context_report['context_tokens']}"
+                    f"/{context_report['budget']} tokens from {context_report['chunks_used']} chunks "
+                    f"({context_report['overlap_chars_removed']} overlapping chars removed)")
+    
+    def _record_usage(self, usage):
+        """APIの応答のトークン使用量（プロンプトキャッシュに当たったトークン数を含む）を累計"""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        with self._usage_lock:
+            self.token_usage["requests"] += 1
+            self.token_usage["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+            self.token_usage["cached_tokens"] += cached_tokens
+            self.token_usage["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+    
+    def _expand_context(self, relevant_docs: List[Tuple[Document, float]]) -> List[Tuple[Document, float]]:
+        """各ヒットに前後Config.CONTEXT_NEIGHBOR_WINDOW件の隣接チャンクを結合する"""
+        window = Config.CONTEXT_NEIGHBOR_WINDOW
+        if window <= 0 or not hasattr(self.vector_db, "get_neighbor_chunks"):
+            return relevant_docs
+        
+        expanded = []
+        used_chunks = set()
+        for doc, score in relevant_docs:
+            filename = doc.metadata.get("filename")
+            chunk_index = doc.metadata.get("chunk_index")
+            if filename is None or chunk_index is None:
+                expanded.append((doc, score))
+                continue
+            
+            # 他のヒットで使用済みのチャンクは重複させない
+            neighbors = [
+                neighbor for neighbor in self.vector_db.get_neighbor_chunks(filename, chunk_index, window)
+                if neighbor.metadata.get("chunk_id") not in used_chunks
+                or neighbor.metadata.get("chunk_id") == doc.metadata.get("chunk_id")
+            ]
+            if len(neighbors) <= 1:
+                expanded.append((doc, score))
+                used_chunks.add(doc.metadata.get("chunk_id"))
+                continue
+            used_chunks.update(neighbor.metadata.get("chunk_id") for neighbor in neighbors)
+            
+            metadata = dict(doc.metadata, merged_chunks=len(neighbors))
+            pages = [n.metadata[key] for n in neighbors for key in ("page_start", "page_end") if key in n.metadata]
+            if pages:
+                metadata.update(page_start=min(pages), page_end=max(pages))
+            content = self._merge_overlapping([neighbor.page_content for neighbor in neighbors])
+            expanded.append((Document(page_content=content, metadata=metadata), score))
+        
+        return expanded
+    
+    def _merge_overlapping(self, texts: List[str]) -> str:
+        """連続するチャンクをオーバーラップ部分を除いて連結"""
+        merged = texts[0]
+        for text in texts[1:]:
+            overlap = overlap_length(merged, text, Config.CHUNK_OVERLAP)
+            merged += text[overlap:] if overlap else "\n" + text
+        return merged
     
     def _generate_openai_answer(self, question: str, relevant_docs: List[Tuple[Document, float]], 
                                microcontroller: str, source_str: str) -> str:
         """OpenAI APIを使用した高品質回答生成"""
+        messages = self._build_answer_messages(question, relevant_docs, microcontroller, source_str)
         
-        # コンテキストを構築
-        context_parts = []
-        for doc, score in relevant_docs[:5]:  # 上位5件のドキュメントを使用
-            context_parts.append(f"文書: {doc.metadata.get('filename', '不明')}")
-            context_parts.append(f"内容: {doc.page_content[:800]}")  # 長すぎるコンテンツを制限
-            context_parts.append("---")
-        
-        context = "\n".join(context_parts)
-        
-        # プロンプトを構築
-        system_prompt = f"""あなたはSTマイクロエレクトロニクスのマイコン専門アシスタントです。
-マイコン初心者にも分かりやすく、丁寧に日本語で回答してください。
-
-回答する際は以下の点を心がけてください：
-1. 技術用語は初心者にも分かるよう解説を含める
-2. 具体的なサンプルコードを提供する場合は、コメントを充実させる
-3. CubeMXの使用方法は段階的に説明する
-4. 安全性やベストプラクティスも含める
-5. 回答の最後に参考ドキュメントを記載する
-
-対象マイコン: {microcontroller}
-参考ドキュメント: {source_str}"""
-
-        user_prompt = f"""以下のコンテキスト情報を参考にして、質問に答えてください。
-
-【コンテキスト情報】
-{context}
-
-【質問】
-{question}
-
-マイコン初心者にも分かりやすく、実用的で詳しい回答をお願いします。"""
-
         try:
             response = self.openai_client.chat.completions.create(
                 model=Config.LLM_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
+                messages=messages,
                 temperature=Config.LLM_TEMPERATURE,
                 max_tokens=Config.MAX_TOKENS
             )
             
             answer = response.choices[0].message.content
+            self._record_usage(getattr(response, "usage", None))
             logger.info("Generated answer using OpenAI API")
             return answer
-            
+        
         except Exception as e:
             logger.error(f"OpenAI API error: {e}")
             raise
     
+    def _stream_openai_completion(self, messages: List[Dict], temperature: float) -> Iterator[str]:
+        """OpenAI APIのストリーミング応答からトークンを逐次返す"""
+        response = self.openai_client.chat.completions.create(
+            model=Config.LLM_MODEL,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=Config.MAX_TOKENS,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in response:
+            # 使用量は最後のチャンク（choicesが空）で返される
+            if getattr(chunk, "usage", None) is not None:
+                self._record_usage(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    
+    def _stream_tokens(self, kind: str, question: str, relevant_docs: List[Tuple[Document, float]],
+                       microcontroller: str, temperature: float, build_messages: Callable[[], List[Dict]],
+                       fallback: Callable[[], str], outcome: Dict = None) -> Iterator[str]:
+        """キャッシュ→OpenAIストリーミング→テンプレートの順でトークンを返す
+        
+        プロンプトはOpenAIを呼び出すときだけbuild_messages()で作成する（キャッシュ・テンプレートでは作成しない）。
+        outcomeを渡すと生成方式（"openai" / "template" / "interrupted"）を"generated_by"に記録する
+        """
+        outcome = {} if outcome is None else outcome
+        if self.use_openai and self.openai_client and relevant_docs:
+            key, cached = self._lookup_completion(kind, question, relevant_docs, microcontroller, temperature)
+            if cached is not None:
+                outcome["generated_by"] = "openai"
+                yield cached if isinstance(cached, str) else cached.get("raw", "")
+                return
+            
+            parts = []
+            try:
+                for token in self._stream_openai_completion(build_messages(), temperature):
+                    parts.append(token)
+                    yield token
+                full_response = "".join(parts)
+                self._store_completion(key, full_response if kind == "answer"
+                                       else dict(self._split_code_response(full_response, question, microcontroller),
+                                                 raw=full_response))
+                logger.info(f"Streamed {kind} using OpenAI API")
+                outcome["generated_by"] = "openai"
+                return
+            except Exception as e:
+                logger.error(f"OpenAI streaming failed: {e}")
+                if parts:
+                    # 途中まで表示済みの場合はテンプレートに切り替えずに終了
+                    outcome["generated_by"] = "interrupted"
+                    yield "\n\n（回答の生成が途中で中断されました）"
+                    return
+                logger.info("Falling back to template-based response")
+        
+        outcome["generated_by"] = "template"
+        yield fallback()
+    
+    def _record_stream_latency(self, stream: StreamingAnswer):
+        self.latency_samples["time_to_first_token"].append(stream.time_to_first_token)
+        self.latency_samples["total_time"].append(stream.total_time)
+        logger.info(f"Streaming finished: TTFT {stream.time_to_first_token * 1000:.0f}ms, "
+                    f"total {stream.total_time * 1000:.0f}ms")
+    
+    def answer_question_stream(self,
+                               question: str,
+                               microcontroller: str = "NUCLEO-F767ZI",
+                               num_docs: int = 5) -> Dict:
+        """回答をストリーミング生成（ソース・信頼度は先に返し、"stream"から本文を逐次取得）
+        
+        類似の質問の回答がキャッシュにあれば、その回答を1チャンクのストリームとして返す
+        """
+        started_at = time.perf_counter()
+        try:
+            cached = self._lookup_semantic_answer(question, microcontroller, num_docs)
+            if cached is not None:
+                return dict(cached, stream=StreamingAnswer(iter([cached["answer"]]), started_at,
+                                                           self._record_stream_latency))
+            
+            relevant_docs = self._search(
+                query=question,
+                k=num_docs,
+                microcontroller=microcontroller,
+                score_threshold=0.05
+            )
+            
+            if not relevant_docs:
+                message = "申し訳ございませんが、関連する情報が見つかりませんでした。質問を言い換えてお試しください。"
+                return {
+                    "stream": StreamingAnswer(iter([message]), started_at),
+                    "sources": [],
+                    "confidence": 0.0,
+                    "microcontroller": microcontroller
+                }
+            
+            sources = [doc.metadata.get("filename", "不明") for doc, _ in relevant_docs[:3]]
+            source_str = ", ".join(sources) if sources else "関連ドキュメント"
+            
+            outcome = {}
+            tokens = self._stream_tokens(
+                "answer", question, relevant_docs, microcontroller, Config.LLM_TEMPERATURE,
+                lambda: self._build_answer_messages(question, relevant_docs, microcontroller, source_str),
+                lambda: self._generate_template_answer(question, relevant_docs, microcontroller, source_str),
+                outcome
+            )
+            
+            result = {
+                "sources": self._extract_sources(relevant_docs),
+                "confidence": self._calculate_confidence(relevant_docs),
+                "microcontroller": microcontroller,
+                "num_sources": len(relevant_docs)
+            }
+            
+            def on_complete(stream: StreamingAnswer):
+                self._record_stream_latency(stream)
+                # 生成し終えた回答を類似質問キャッシュに保存
+                self._store_semantic_answer(question, microcontroller, num_docs, dict(
+                    result, answer=stream.text, generated_by=outcome.get("generated_by")
+                ))
+            
+            return dict(result, stream=StreamingAnswer(tokens, started_at, on_complete))
+        
+        except Exception as e:
+            logger.error(f"Failed to answer question: {e}")
+            return {
+                "stream": StreamingAnswer(iter([f"エラーが発生しました: {str(e)}"]), started_at),
+                "sources": [],
+                "confidence": 0.0,
+                "microcontroller": microcontroller
+            }
+    
     def _generate_template_answer(self, question: str, relevant_docs: List[Tuple[Document, float]], 
                                  microcontroller: str, source_str: str) -> str:
         """テンプレートベース回答生成（フォールバック）"""
@@ -745,7 +1133,7 @@ CubeMX使用時の注意点:
         try:
             # 1. コード生成に関連するドキュメントを検索
             search_query = f"{request} サンプルコード プログラム 実装"
-            relevant_docs = self.vector_db.search_similar_documents(
+            relevant_docs = self._search(
                 query=search_query,
                 k=num_docs,
                 microcontroller=microcontroller,
@@ -758,7 +1146,10 @@ CubeMX使用時の注意点:
             # 3. コード生成（OpenAI APIまたはテンプレート）
             if self.use_openai and self.openai_client and relevant_docs:
                 try:
-                    result = self._generate_openai_code(request, relevant_docs, microcontroller)
+                    result = dict(self._cached_completion(
+                        "code", request, relevant_docs, microcontroller, 0.3,
+                        lambda: self._generate_openai_code(request, relevant_docs, microcontroller)
+                    ))
                     result["sources"] = sources
                     return result
                 except Exception as e:
@@ -774,7 +1165,7 @@ CubeMX使用時の注意点:
                 "sources": sources,
                 "microcontroller": microcontroller
             }
-            
+        
         except Exception as e:
             logger.error(f"Failed to generate code: {e}")
             return {
@@ -784,83 +1175,110 @@ CubeMX使用時の注意点:
                 "microcontroller": microcontroller
             }
     
+    def _build_code_messages(self, request: str, relevant_docs: List[Tuple[Document, float]],
+                             microcontroller: str) -> List[Dict]:
+        """コード生成用のメッセージを構築"""
+        
+        # コンテキストを構築（上位3件をトークン予算内へ）
+        context, context_report = self.code_context_builder.build(relevant_docs, label="参考文書", max_chunks=3)
+        
+        # 固定のシステムプロンプト + 要求内容・参考情報（変わる部分は末尾）
+        messages = self.prompt_layout.code_messages(microcontroller, request, context)
+        self._record_prompt_tokens("code", messages, context_report)
+        return messages
+    
+    def _split_code_response(self, full_response: str, request: str, microcontroller: str) -> Dict:
+        """レスポンスからコードと説明を分離（簡易的な方法）"""
+        if "```c" in full_response or "```" in full_response:
+            parts = full_response.split("```")
+            if len(parts) >= 3:
+                code = parts[1].replace("c\n", "").strip()
+                explanation = (parts[0] + parts[2]).strip()
+            else:
+                code = full_response
+                explanation = f"{microcontroller}用の{request}に関するサンプルコードです。"
+        else:
+            code = full_response
+            explanation = f"{microcontroller}用の{request}に関するサンプルコードです。"
+        
+        return {
+            "code": code,
+            "explanation": explanation,
+            "microcontroller": microcontroller
+        }
+    
     def _generate_openai_code(self, request: str, relevant_docs: List[Tuple[Document, float]], 
                              microcontroller: str) -> Dict:
         """OpenAI APIを使用した高品質コード生成"""
+        messages = self._build_code_messages(request, relevant_docs, microcontroller)
         
-        # コンテキストを構築
-        context_parts = []
-        for doc, score in relevant_docs[:3]:  # 上位3件のドキュメントを使用
-            context_parts.append(f"参考文書: {doc.metadata.get('filename', '不明')}")
-            context_parts.append(f"内容: {doc.page_content[:600]}")
-            context_parts.append("---")
-        
-        context = "\n".join(context_parts)
-        
-        # コード生成用プロンプト
-        system_prompt = f"""あなたはSTマイクロエレクトロニクスのマイコン開発専門エンジニアです。
-{microcontroller}向けの実用的なサンプルコードを生成してください。
-
-コード生成時の要件：
-1. HALライブラリを使用する
-2. 初心者にも分かりやすいコメントを充実させる
-3. エラーハンドリングを含める
-4. CubeMXで生成される構造に準拠する
-5. 安全性とベストプラクティスを考慮する
-6. 実際に動作する完全なコードを提供する
-
-出力形式：
-- 詳細なコメント付きのCコード
-- 必要な初期設定の説明
-- 使用方法の説明"""
-
-        user_prompt = f"""以下の要求に基づいて、{microcontroller}用のサンプルコードを生成してください。
-
-【要求内容】
-{request}
-
-【参考情報】
-{context}
-
-初心者にも分かりやすく、実際に動作する完全なコードを提供してください。
-コードには詳細なコメントを含め、CubeMXでの設定が必要な部分も説明してください。"""
-
         try:
             response = self.openai_client.chat.completions.create(
                 model=Config.LLM_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
+                messages=messages,
                 temperature=0.3,  # コード生成では低めの温度を使用
                 max_tokens=Config.MAX_TOKENS
             )
             
             full_response = response.choices[0].message.content
+            self._record_usage(getattr(response, "usage", None))
+            result = self._split_code_response(full_response, request, microcontroller)
+            result["raw"] = full_response
             
-            # レスポンスからコードと説明を分離（簡易的な方法）
-            if "```c" in full_response or "```" in full_response:
-                parts = full_response.split("```")
-                if len(parts) >= 3:
-                    code = parts[1].replace("c\n", "").strip()
-                    explanation = (parts[0] + parts[2]).strip()
+            logger.info("Generated code using OpenAI API")
+            return result
+        
+        except Exception as e:
+            logger.error(f"OpenAI code generation error: {e}")
+            raise
+    
+    def generate_code_stream(self,
+                             request: str,
+                             microcontroller: str = "NUCLEO-F767ZI",
+                             num_docs: int = 3) -> Dict:
+        """コードをストリーミング生成（完了後はstream.resultに分離済みのコードと説明が入る）"""
+        started_at = time.perf_counter()
+        try:
+            search_query = f"{request} サンプルコード プログラム 実装"
+            relevant_docs = self._search(
+                query=search_query,
+                k=num_docs,
+                microcontroller=microcontroller,
+                score_threshold=0.05
+            )
+            sources = self._extract_sources(relevant_docs)
+            
+            def on_complete(stream: StreamingAnswer):
+                if self.use_openai and self.openai_client and relevant_docs:
+                    stream.result = self._split_code_response(stream.text, request, microcontroller)
                 else:
-                    code = full_response
-                    explanation = f"{microcontroller}用の{request}に関するサンプルコードです。"
-            else:
-                code = full_response
-                explanation = f"{microcontroller}用の{request}に関するサンプルコードです。"
+                    stream.result = {
+                        "code": stream.text,
+                        "explanation": f"{microcontroller}用の{request}に関するサンプルコードです。\\nCubeMXでの初期設定が必要です。",
+                        "microcontroller": microcontroller
+                    }
+                stream.result["sources"] = sources
+                self._record_stream_latency(stream)
+            
+            tokens = self._stream_tokens(
+                "code", request, relevant_docs, microcontroller, 0.3,
+                lambda: self._build_code_messages(request, relevant_docs, microcontroller),
+                lambda: self._generate_code_template(request, microcontroller)
+            )
             
-            logger.info("Generated code using OpenAI API")
             return {
-                "code": code,
-                "explanation": explanation,
+                "stream": StreamingAnswer(tokens, started_at, on_complete),
+                "sources": sources,
                 "microcontroller": microcontroller
             }
-            
+        
         except Exception as e:
-            logger.error(f"OpenAI code generation error: {e}")
-            raise
+            logger.error(f"Failed to generate code: {e}")
+            return {
+                "stream": StreamingAnswer(iter([f"// エラーが発生しました: {str(e)}"]), started_at),
+                "sources": [],
+                "microcontroller": microcontroller
+            }
     
     def _generate_code_template(self, request: str, microcontroller: str) -> str:
         """コードテンプレート生成"""
@@ -904,7 +1322,7 @@ void {request.replace(' ', '_')}_Example(void)
 3. 上記コードを統合
 4. ビルド・書き込み
 */"""
-    
+
     def search_documentation(self, 
                            query: str, 
                            microcontroller: str = None,
@@ -912,7 +1330,7 @@ void {request.replace(' ', '_')}_Example(void)
                            num_results: int = 10) -> List[Dict]:
         """ドキュメント検索"""
         try:
-            relevant_docs = self.vector_db.search_similar_documents(
+            relevant_docs = self._search(
                 query=query,
                 k=num_results,
                 microcontroller=microcontroller,
@@ -931,7 +1349,7 @@ void {request.replace(' ', '_')}_Example(void)
                 })
             
             return results
-            
+        
         except Exception as e:
             logger.error(f"Documentation search failed: {e}")
             return []
@@ -951,7 +1369,7 @@ void {request.replace(' ', '_')}_Example(void)
             
             # ドキュメントからの詳細情報を検索
             search_query = f"{microcontroller} 仕様 特性 概要"
-            relevant_docs = self.vector_db.search_similar_documents(
+            relevant_docs = self._search(
                 query=search_query,
                 k=3,
                 microcontroller=microcontroller,
@@ -1000,7 +1418,7 @@ void {request.replace(' ', '_')}_Example(void)
                 "sources": sources,
                 "microcontroller": microcontroller
             }
-            
+        
         except Exception as e:
             logger.error(f"Failed to get microcontroller info: {e}")
             return {
@@ -1009,6 +1427,331 @@ void {request.replace(' ', '_')}_Example(void)
                 "sources": []
             }
     
+    # 非同期API（1プロセスで多数の質問を同時に処理する）
+    
+    def _async_state(self) -> Dict:
+        """実行中のイベントループ用のAsyncOpenAIクライアントとセマフォ"""
+        loop = asyncio.get_running_loop()
+        state = self._async_states.get(loop)
+        if state is None:
+            client = None
+            if self.use_openai and self.openai_client:
+                client = AsyncOpenAI(api_key=self.openai_client.api_key)
+            state = {"client": client, "semaphore": asyncio.Semaphore(Config.ASYNC_MAX_CONCURRENCY)}
+            self._async_states[loop] = state
+        return state
+    
+    async def _run_in_executor(self, func, *args, **kwargs):
+        """同期処理（検索など）をスレッドで実行してイベントループを塞がない"""
+        if self._retrieval_executor is None:
+            self._retrieval_executor = ThreadPoolExecutor(
+                max_workers=Config.ASYNC_RETRIEVAL_WORKERS, thread_name_prefix="rag-retrieval"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._retrieval_executor, partial(func, *args, **kwargs))
+    
+    async def _search_async(self, query: str, k: int, microcontroller: str = None,
+                            category: str = None, score_threshold: float = 0.05) -> List[Tuple[Document, float]]:
+        return await self._run_in_executor(
+            self._search, query=query, k=k, microcontroller=microcontroller,
+            category=category, score_threshold=score_threshold
+        )
+    
+    async def _async_completion(self, messages: List[Dict], temperature: float, timeout: float = None) -> str:
+        """AsyncOpenAIでの生成（同時実行数を制限し、タイムアウトで打ち切る）"""
+        state = self._async_state()
+        if state["client"] is None:
+            raise RuntimeError("AsyncOpenAI client is not available")
+        
+        async with state["semaphore"]:
+            response = await asyncio.wait_for(
+                state["client"].chat.completions.create(
+                    model=Config.LLM_MODEL,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=Config.MAX_TOKENS
+                ),
+                timeout=timeout or Config.ASYNC_LLM_TIMEOUT
+            )
+        self._record_usage(getattr(response, "usage", None))
+        return response.choices[0].message.content
+    
+    async def _cached_completion_async(self, kind: str, question: str, relevant_docs: List[Tuple[Document, float]],
+                                       microcontroller: str, temperature: float,
+                                       build_messages: Callable[[], List[Dict]], timeout: float = None):
+        """回答キャッシュを参照し、なければbuild_messages()のプロンプトでAsyncOpenAIから生成して保存"""
+        key, cached = self._lookup_completion(kind, question, relevant_docs, microcontroller, temperature)
+        if cached is not None:
+            return cached
+        
+        full_response = await self._async_completion(build_messages(), temperature, timeout)
+        result = full_response if kind == "answer" else dict(
+            self._split_code_response(full_response, question, microcontroller), raw=full_response
+        )
+        self._store_completion(key, result)
+        return result
+    
+    async def answer_question_async(self,
+                                    question: str,
+                                    microcontroller: str = "NUCLEO-F767ZI",
+                                    num_docs: int = 5,
+                                    timeout: float = None) -> Dict:
+        """answer_questionの非同期版（タイムアウト時はテンプレート回答、キャンセルは呼び出し元に伝播）"""
+        try:
+            cached = self._lookup_semantic_answer(question, microcontroller, num_docs)
+            if cached is not None:
+                return cached
+            
+            relevant_docs = await self._search_async(question, num_docs, microcontroller, score_threshold=0.05)
+            result = await self._answer_from_docs_async(question, relevant_docs, microcontroller, timeout)
+            self._store_semantic_answer(question, microcontroller, num_docs, result)
+            return result
+        
+        except Exception as e:
+            logger.error(f"Failed to answer question: {e}")
+            return {
+                "answer": f"エラーが発生しました: {str(e)}",
+                "sources": [],
+                "confidence": 0.0,
+                "microcontroller": microcontroller
+            }
+    
+    async def _answer_from_docs_async(self,
+                                      question: str,
+                                      relevant_docs: List[Tuple[Document, float]],
+                                      microcontroller: str,
+                                      timeout: float = None) -> Dict:
+        """検索済みのドキュメントから回答を生成（OpenAI→テンプレートの順）"""
+        if not relevant_docs:
+            return self.no_context_answer(microcontroller)
+        
+        sources = [doc.metadata.get("filename", "不明") for doc, _ in relevant_docs[:3]]
+        source_str = ", ".join(sources) if sources else "関連ドキュメント"
+        
+        answer, generated_by = None, "template"
+        if self.use_openai and self.openai_client:
+            try:
+                answer = await self._cached_completion_async(
+                    "answer", question, relevant_docs, microcontroller, Config.LLM_TEMPERATURE,
+                    lambda: self._build_answer_messages(question, relevant_docs, microcontroller, source_str),
+                    timeout
+                )
+                generated_by = "openai"
+            except asyncio.TimeoutError:
+                logger.error("OpenAI API call timed out")
+            except Exception as e:
+                logger.error(f"OpenAI API call failed: {e}")
+        if answer is None:
+            answer = self._generate_template_answer(question, relevant_docs, microcontroller, source_str)
+        
+        return {
+            "answer": answer,
+            "sources": self._extract_sources(relevant_docs),
+            "confidence": self._calculate_confidence(relevant_docs),
+            "microcontroller": microcontroller,
+            "num_sources": len(relevant_docs),
+            "generated_by": generated_by
+        }
+    
+    def search_batch(self,
+                     queries: List[str],
+                     k: int = 5,
+                     microcontrollers: List[Optional[str]] = None,
+                     score_threshold: float = 0.05) -> List[List[Tuple[Document, float]]]:
+        """複数クエリの検索（キャッシュ済みは再利用し、残りはベクトルストアの一括検索に渡す）
+        
+        microcontrollersはクエリごとの絞り込み（Noneで全件）。結果はqueriesと同じ順
+        """
+        microcontrollers = microcontrollers or [None] * len(queries)
+        results = [None] * len(queries)
+        keys = [None] * len(queries)
+        if self.query_cache is not None:
+            self.query_cache.sync_corpus_version(self._corpus_version())
+            for i, (query, microcontroller) in enumerate(zip(queries, microcontrollers)):
+                keys[i] = self.query_cache.retrieval_key(query, microcontroller, k, None, score_threshold,
+                                                         Config.SIMPLE_RANKING)
+                cached = self.query_cache.retrieval.get(keys[i])
+                if cached is not None:
+                    results[i] = list(cached)
+        
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+        
+        # 委譲（__getattr__）で見つかった一括検索は別ストアの検索になり得るため、クラスに定義されたもののみ使う
+        if hasattr(type(self.vector_db), "search_similar_documents_batch"):
+            found = self.vector_db.search_similar_documents_batch(
+                [queries[i] for i in missing],
+                k=k,
+                microcontrollers=[microcontrollers[i] for i in missing],
+                score_threshold=score_threshold
+            )
+        else:
+            found = [
+                self.vector_db.search_similar_documents(
+                    query=queries[i], k=k, microcontroller=microcontrollers[i], score_threshold=score_threshold
+                )
+                for i in missing
+            ]
+        
+        for i, relevant_docs in zip(missing, found):
+            results[i] = relevant_docs
+            if self.query_cache is not None:
+                self.query_cache.retrieval.set(keys[i], list(relevant_docs))
+        return results
+    
+    def openai_batch_request(self,
+                             custom_id: str,
+                             question: str,
+                             relevant_docs: List[Tuple[Document, float]],
+                             microcontroller: str) -> Dict:
+        """OpenAI Batch APIの入力ファイル1行分（/v1/chat/completions）のリクエストを作成
+        
+        relevant_docsが空の質問はリクエストにせず、対話時と同じno_context_answer()を使う（batch_answer.py）
+        """
+        sources = [doc.metadata.get("filename", "不明") for doc, _ in relevant_docs[:3]]
+        source_str = ", ".join(sources) if sources else "関連ドキュメント"
+        return {
+            "custom_id": str(custom_id),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": Config.LLM_MODEL,
+                "messages": self._build_answer_messages(question, relevant_docs, microcontroller, source_str),
+                "temperature": Config.LLM_TEMPERATURE,
+                "max_tokens": Config.MAX_TOKENS
+            }
+        }
+    
+    async def answer_questions_batch_async(self,
+                                           questions: List[Dict],
+                                           num_docs: int = 5,
+                                           timeout: float = None,
+                                           batch_size: int = None) -> AsyncIterator[Dict]:
+        """多数の質問に回答し、完了した順に結果を返す（オフライン評価・一括再実行用）
+        
+        questionsは {"question": ..., "microcontroller": ..., "id": ...} の辞書のリスト。
+        検索はbatch_size件ずつまとめてスレッドで実行し、LLM呼び出しは
+        ASYNC_MAX_CONCURRENCYの同時実行数で次の検索と並行して進める。
+        各結果には入力位置の"index"と段階ごとの所要時間"timings"（秒）を付ける。
+        retrievalは一括検索の按分、generationは空き待ちを含む生成時間、
+        end_to_endはその質問の検索開始から回答完了まで
+        """
+        batch_size = batch_size or Config.BATCH_RETRIEVAL_SIZE
+        completed = asyncio.Queue()
+        
+        async def answer(index: int, item: Dict, relevant_docs: List[Tuple[Document, float]],
+                         retrieval: float, dispatched: float):
+            microcontroller = item.get("microcontroller") or "NUCLEO-F767ZI"
+            started = time.perf_counter()
+            try:
+                result = await self._answer_from_docs_async(item["question"], relevant_docs, microcontroller, timeout)
+            except Exception as e:
+                logger.error(f"Failed to answer question: {e}")
+                result = {
+                    "answer": f"エラーが発生しました: {str(e)}",
+                    "sources": [],
+                    "confidence": 0.0,
+                    "microcontroller": microcontroller
+                }
+            finished = time.perf_counter()
+            result.update(index=index, id=item.get("id", index), question=item["question"],
+                          timings={"retrieval": retrieval, "generation": finished - started,
+                                   "end_to_end": finished - dispatched})
+            await completed.put(result)
+        
+        async def produce():
+            tasks = []
+            try:
+                for start in range(0, len(questions), batch_size):
+                    chunk = questions[start:start + batch_size]
+                    started = time.perf_counter()
+                    found = await self._run_in_executor(
+                        self.search_batch,
+                        [item["question"] for item in chunk],
+                        num_docs,
+                        [item.get("microcontroller") or "NUCLEO-F767ZI" for item in chunk]
+                    )
+                    # 一括検索の所要時間を1問あたりに按分
+                    retrieval = (time.perf_counter() - started) / len(chunk)
+                    for offset, (item, relevant_docs) in enumerate(zip(chunk, found)):
+                        tasks.append(asyncio.create_task(
+                            answer(start + offset, item, relevant_docs, retrieval, started)
+                        ))
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+        
+        producer = asyncio.create_task(produce())
+        try:
+            for _ in range(len(questions)):
+                getter = asyncio.ensure_future(completed.get())
+                await asyncio.wait([getter, producer], return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done() and producer.exception() is not None:
+                    # 検索の失敗などで結果が揃わない場合は例外を伝える
+                    getter.cancel()
+                    raise producer.exception()
+                yield await getter
+            await producer
+        finally:
+            if not producer.done():
+                producer.cancel()
+    
+    async def generate_code_async(self,
+                                  request: str,
+                                  microcontroller: str = "NUCLEO-F767ZI",
+                                  num_docs: int = 3,
+                                  timeout: float = None) -> Dict:
+        """generate_codeの非同期版"""
+        try:
+            search_query = f"{request} サンプルコード プログラム 実装"
+            relevant_docs = await self._search_async(search_query, num_docs, microcontroller, score_threshold=0.05)
+            sources = self._extract_sources(relevant_docs)
+            
+            if self.use_openai and self.openai_client and relevant_docs:
+                try:
+                    result = dict(await self._cached_completion_async(
+                        "code", request, relevant_docs, microcontroller, 0.3,
+                        lambda: self._build_code_messages(request, relevant_docs, microcontroller), timeout
+                    ))
+                    result["sources"] = sources
+                    return result
+                except asyncio.TimeoutError:
+                    logger.error("OpenAI code generation timed out")
+                except Exception as e:
+                    logger.error(f"OpenAI code generation failed: {e}")
+            
+            # フォールバック：テンプレートベースコード生成
+            return {
+                "code": self._generate_code_template(request, microcontroller),
+                "explanation": f"{microcontroller}用の{request}に関するサンプルコードです。\\nCubeMXでの初期設定が必要です。",
+                "sources": sources,
+                "microcontroller": microcontroller
+            }
+        
+        except Exception as e:
+            logger.error(f"Failed to generate code: {e}")
+            return {
+                "code": f"// エラーが発生しました: {str(e)}",
+                "explanation": "コード生成に失敗しました",
+                "sources": [],
+                "microcontroller": microcontroller
+            }
+    
+    async def search_documentation_async(self,
+                                         query: str,
+                                         microcontroller: str = None,
+                                         category: str = None,
+                                         num_results: int = 10) -> List[Dict]:
+        """search_documentationの非同期版（検索はスレッドで実行）"""
+        return await self._run_in_executor(self.search_documentation, query, microcontroller, category, num_results)
+    
+    async def get_microcontroller_info_async(self, microcontroller: str) -> Dict:
+        """get_microcontroller_infoの非同期版（answer_question_asyncとasyncio.gatherで並行実行できる）"""
+        return await self._run_in_executor(self.get_microcontroller_info, microcontroller)
+    
     def _calculate_confidence(self, relevant_docs: List[Tuple[Document, float]]) -> float:
         """回答の信頼度を計算"""
         if not relevant_docs:
@@ -1036,6 +1779,9 @@ void {request.replace(' ', '_')}_Example(void)
                 "relevance": 1.0 - score,
                 "chunk_id": doc.metadata.get("chunk_id", "")
             }
+            if "page_start" in doc.metadata:
+                source_info["page_start"] = doc.metadata["page_start"]
+                source_info["page_end"] = doc.metadata.get("page_end", doc.metadata["page_start"])
             
             # 重複を避ける
             source_key = (source_info["filename"], source_info["chunk_id"])
@@ -1057,5 +1803,42 @@ void {request.replace(' ', '_')}_Example(void)
             "total_documents": len(self.vector_db.documents) if self.vector_db else 0,
             "openai_available": OPENAI_AVAILABLE,
             "openai_configured": bool(Config.get_openai_api_key()),
-            "mode": "OpenAI + Template Fallback" if self.use_openai else "Template-only"
-        }
\ No newline at end of file
+            "mode": "OpenAI + Template Fallback" if self.use_openai else "Template-only",
+            "cache": self.query_cache.stats() if self.query_cache else {},
+            "streaming_latency": self._latency_summary(),
+            "prompt_tokens": self._prompt_token_summary(),
+            "token_usage": self._token_usage_summary()
+        }
+    
+    def _latency_summary(self) -> Dict:
+        """ストリーミング応答のレイテンシ（ミリ秒、p50/p95）"""
+        summary = {"count": len(self.latency_samples["time_to_first_token"])}
+        for name, samples in self.latency_samples.items():
+            values = sorted(samples)
+            if values:
+                summary[f"{name}_p50_ms"] = values[len(values) // 2] * 1000
+                summary[f"{name}_p95_ms"] = values[min(int(len(values) * 0.95), len(values) - 1)] * 1000
+        return summary
+    
+    def _prompt_token_summary(self) -> Dict:
+        """作成したプロンプトのトークン数（平均・p50/p95）"""
+        values = sorted(self.prompt_token_samples)
+        summary = {
+            "count": len(values),
+            "context_budget": self.context_builder.token_budget,
+            "tokenizer": self.context_builder.counter.name
+        }
+        if values:
+            summary["avg"] = sum(values) / len(values)
+            summary["p50"] = values[len(values) // 2]
+            summary["p95"] = values[min(int(len(values) * 0.95), len(values) - 1)]
+        return summary
+    
+    def _token_usage_summary(self) -> Dict:
+        """APIが返したトークン使用量の累計とプロンプトキャッシュのヒット率"""
+        with self._usage_lock:
+            summary = dict(self.token_usage)
+        summary["cached_ratio"] = (
+            summary["cached_tokens"] / summary["prompt_tokens"] if summary["prompt_tokens"] else 0.0
+        )
+        return summary
@@ -6,10 +6,15 @@ import os
 import json
 import logging
 import pickle
-from typing import List, Dict, Optional, Tuple
-from collections import Counter
+from typing import Iterable, List, Dict, Optional, Tuple
+from collections import Counter, defaultdict
+import hashlib
+import heapq
 import math
-import re
+import functools
+import threading
+import uuid
+from contextlib import contextmanager
 
 from langchain.schema import Document
 
@@ -18,55 +23,202 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from config import Config
+from models.sparse_index import SparseTfidfIndex, SPARSE_AVAILABLE
+from models.tokenizer import LEGACY_TOKENIZER_SIGNATURE, TokenTable, get_tokenizer
+from models.metadata_index import MetadataIndex
+from models.index_storage import (
+    MANIFEST_FILE,
+    STORAGE_AVAILABLE,
+    IndexSegment,
+    LazyDocumentList,
+    iter_term_counts,
+    merge_segment_arrays,
+    read_manifest,
+    remove_unreferenced_segments,
+    write_manifest,
+    write_segment,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ReadWriteLock:
+    """読み取りは並行、書き込みは排他のロック（書き込み待ちがあれば新しい読み取りを待たせる）
+    
+    同じスレッドでの読み取りの入れ子と、書き込み中のスレッドからの読み取りは待たずに通す
+    """
+    
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None  # 書き込み中のスレッドID
+        self._writers_waiting = 0
+        self._local = threading.local()
+    
+    @contextmanager
+    def read(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+        
+        with self._condition:
+            while self._writer is not None or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+    
+    @contextmanager
+    def write(self):
+        if self._writer == threading.get_ident():
+            yield
+            return
+        
+        with self._condition:
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = threading.get_ident()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+
+def _reads_index(method):
+    """インデックスを読むメソッド（追加・削除による再構築の途中を参照しないよう読み取りロックを取る）"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._index_lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class SimpleVectorDatabase:
     """シンプルなベクトルデータベース（TF-IDF）"""
     
-    def __init__(self, persist_directory: str = None):
+    def __init__(self, persist_directory: str = None, backend: str = None, write_mode: str = None,
+                 tokenizer: str = None):
         self.persist_directory = persist_directory or Config.get_vector_db_path()
-        self.documents = []  # List[Document]
-        self.tfidf_vectors = []  # List[Dict[str, float]]
+        self.tokenizer = get_tokenizer(tokenizer or Config.SIMPLE_TOKENIZER)
+        # 辞書バックエンドでチャンク間の同じトークン文字列を共有する（疎行列バックエンドは語彙表で共有済み）
+        self.token_table = TokenTable() if Config.SIMPLE_TOKEN_INTERNING else None
+        self.write_mode = write_mode or Config.SIMPLE_INDEX_WRITE_MODE
+        self.backend = backend or Config.SIMPLE_VECTOR_BACKEND
+        if self.backend == "sparse" and not SPARSE_AVAILABLE:
+            logger.warning("numpy/scipy not available. Falling back to dict backend")
+            self.backend = "dict"
+        self.index_directory = os.path.join(self.persist_directory, "simple_index")
+        # マニフェスト更新（追記・コンパクション）とメモリ上のドキュメント列の変更の排他
+        # （追加・削除は保存まで保持し、保存処理の中で再取得するためRLock）
+        self._manifest_lock = threading.RLock()
+        # 検索（読み取り）と追加・削除（メモリ上のインデックスの書き換え）の排他。
+        # 削除はインデックスをその場で作り直すため、共有インスタンスを検索中のセッションに途中の状態を見せない
+        self._index_lock = ReadWriteLock()
+        self._compaction_lock = threading.Lock()  # コンパクションの多重実行防止
+        self._compaction_thread = None
+        self._needs_snapshot = False  # 削除後は追記ではなく全体を書き直す
+        self.documents = LazyDocumentList()  # 本文はオフセット指定で遅延読み込み
         self.vocabulary = set()
         self.idf_scores = {}
         
+        # 増分インデックス用のキャッシュ（再トークン化を避ける）
+        self.doc_term_counts = []  # List[Dict[str, int]] チャンクごとのトークン出現数
+        self.doc_lengths = []  # List[int] チャンクごとの総トークン数
+        self.doc_freq = Counter()  # トークン -> 出現ドキュメント数
+        
+        # 転置インデックス（トークン -> [(doc_id, tf), ...]）と文書ノルム
+        self.postings = defaultdict(list)
+        self.doc_norms = []  # List[float] TF-IDFベクトルのL2ノルム
+        self._weights_dirty = True
+        self._weights_lock = threading.Lock()  # 並行検索時に重みの再計算を1回にまとめる
+        self._tfidf_vectors = None
+        self._bm25_stats = None  # BM25用のIDFと文書長の正規化項（BM25検索時に遅延計算）
+        
+        # 位置の索引（参照時に遅延構築）: (ファイル名, チャンク番号) -> doc_id、(ファイル名, ページ) -> [doc_id, ...]
+        self._chunk_positions = None
+        self._page_positions = None
+        
+        # 列指向のメタデータ索引（参照時に遅延構築、以降は追加分のみ反映）
+        self._metadata_index = None
+        
+        # 疎行列バックエンド（トークン出現数はCSRに格納し、辞書はビューで提供）
+        self.sparse_index = None
+        if self.backend == "sparse":
+            self._reset_sparse_index()
+        
         # ディレクトリ作成
         os.makedirs(self.persist_directory, exist_ok=True)
         
         # 既存データを読み込み
         self._load_data()
+        self._mark_synced()
         
         logger.info(f"Simple vector database initialized at: {self.persist_directory}")
     
+    def _reset_index_state(self):
+        """ドキュメントとインデックスを空の状態に戻す"""
+        self.documents = LazyDocumentList()
+        self.vocabulary = set()
+        self.idf_scores = {}
+        self.doc_term_counts = []
+        self.doc_lengths = []
+        self.doc_freq = Counter()
+        self.postings = defaultdict(list)
+        self.doc_norms = []
+        self._tfidf_vectors = None
+        self._bm25_stats = None
+        self._chunk_positions = None
+        self._page_positions = None
+        self._metadata_index = None
+        if self.sparse_index is not None:
+            self._reset_sparse_index()
+        self._weights_dirty = True
+    
+    def _reset_sparse_index(self):
+        """疎行列インデックスを空の状態で作成"""
+        self.sparse_index = SparseTfidfIndex()
+        self.doc_term_counts = self.sparse_index.term_counts()
+    
+    @property
+    def tfidf_vectors(self) -> List[Dict[str, float]]:
+        """TF-IDFベクトル（辞書形式、参照時に遅延生成）"""
+        self._refresh_weights()
+        if self._tfidf_vectors is None:
+            self._tfidf_vectors = []
+            for token_count, total_tokens in zip(self.doc_term_counts, self.doc_lengths):
+                tf_scores = self._tf_from_counts(token_count, total_tokens)
+                self._tfidf_vectors.append({
+                    token: tf * self.idf_scores.get(token, 0)
+                    for token, tf in tf_scores.items()
+                })
+        return self._tfidf_vectors
+    
     def _tokenize(self, text: str) -> List[str]:
         """テキストをトークン化"""
-        # 簡単な前処理
-        text = text.lower()
-        # 英数字と日本語文字のみを保持
-        text = re.sub(r'[^a-zA-Z0-9\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FAF\s]', ' ', text)
-        # 単語分割（英語）と文字分割（日本語）
-        tokens = []
-        for word in text.split():
-            if re.match(r'^[a-zA-Z0-9]+$', word):
-                # 英数字の場合はそのまま
-                if len(word) > 2:  # 短すぎる単語は除外
-                    tokens.append(word)
-            else:
-                # 日本語の場合は2-gramで分割
-                for i in range(len(word) - 1):
-                    bigram = word[i:i+2]
-                    if len(bigram) == 2:
-                        tokens.append(bigram)
-        
-        return tokens
+        return self.tokenizer.tokenize(text)
     
     def _calculate_tf(self, tokens: List[str]) -> Dict[str, float]:
         """Term Frequency計算"""
-        token_count = Counter(tokens)
-        total_tokens = len(tokens)
-        
+        return self._tf_from_counts(Counter(tokens), len(tokens))
+    
+    def _tf_from_counts(self, token_count: Dict[str, int], total_tokens: int) -> Dict[str, float]:
+        """キャッシュ済みのトークン数からTerm Frequencyを計算"""
         tf_scores = {}
         for token, count in token_count.items():
             tf_scores[token] = count / total_tokens
@@ -74,26 +226,75 @@ class SimpleVectorDatabase:
         return tf_scores
     
     def _calculate_idf(self):
-        """Inverse Document Frequency計算"""
+        """Inverse Document Frequency計算（文書頻度キャッシュから算出）"""
         doc_count = len(self.documents)
+        self.idf_scores = {}
         if doc_count == 0:
             return
         
-        # 各トークンが出現するドキュメント数をカウント
-        token_doc_count = Counter()
+        for token, count in self.doc_freq.items():
+            self.idf_scores[token] = math.log(doc_count / count)
+    
+    def _refresh_weights(self):
+        """追加後に初めて参照されたタイミングでIDFと文書ノルムを再計算
         
-        for doc in self.documents:
-            tokens = set(self._tokenize(doc.page_content))
-            for token in tokens:
-                token_doc_count[token] += 1
+        並行して検索された場合も計算は1回だけで、完了までは他のスレッドを待たせる
+        """
+        if not self._weights_dirty:
+            return
         
-        # IDF計算
-        self.idf_scores = {}
-        for token, count in token_doc_count.items():
-            self.idf_scores[token] = math.log(doc_count / count)
+        with self._weights_lock:
+            if not self._weights_dirty:
+                return
+            
+            self._calculate_idf()
+            self._tfidf_vectors = None
+            self._bm25_stats = None
+            
+            if self.sparse_index is not None:
+                self.sparse_index.refresh(self.idf_scores)
+                self.doc_norms = self.sparse_index.norms
+            else:
+                idf_scores = self.idf_scores
+                doc_norms = []
+                for token_count, total_tokens in zip(self.doc_term_counts, self.doc_lengths):
+                    squared = 0.0
+                    for token, count in token_count.items():
+                        weight = count / total_tokens * idf_scores.get(token, 0)
+                        squared += weight * weight
+                    doc_norms.append(math.sqrt(squared))
+                self.doc_norms = doc_norms
+            
+            self._weights_dirty = False
+    
+    def _index_document(self, doc: Document):
+        """1チャンク分のトークン数・文書頻度・ポスティングを更新"""
+        tokens = self._tokenize(doc.page_content)
+        token_count = Counter(tokens)
+        if self.token_table is not None:
+            intern = self.token_table.intern
+            token_count = {intern(token): count for token, count in token_count.items()}
+        self._index_term_counts(dict(token_count), len(tokens))
+    
+    def _index_term_counts(self, token_count: Dict[str, int], total_tokens: int):
+        """トークン数から文書頻度・ポスティング（または疎行列）を更新"""
+        doc_id = len(self.doc_lengths)
+        
+        self.doc_lengths.append(total_tokens)
+        self.doc_freq.update(token_count.keys())
+        self.vocabulary.update(token_count.keys())
+        
+        if self.sparse_index is not None:
+            self.sparse_index.add_document(token_count, total_tokens)
+            return
+        
+        self.doc_term_counts.append(token_count)
+        for token, count in token_count.items():
+            self.postings[token].append((doc_id, count / total_tokens))
     
     def _calculate_tfidf_vector(self, tokens: List[str]) -> Dict[str, float]:
         """TF-IDFベクトル計算"""
+        self._refresh_weights()
         tf_scores = self._calculate_tf(tokens)
         tfidf_vector = {}
         
@@ -125,88 +326,402 @@ class SimpleVectorDatabase:
     
     def add_documents(self, documents: List[Document], microcontroller: str = "NUCLEO-F767ZI") -> bool:
         """ドキュメントを追加"""
-        try:
-            if not documents:
-                logger.warning("No documents to add")
-                return False
-            
-            # メタデータにマイコン情報を追加
-            for doc in documents:
-                doc.metadata["microcontroller"] = microcontroller
-            
-            # ドキュメントを追加
-            self.documents.extend(documents)
-            
-            # 語彙を更新
-            for doc in documents:
-                tokens = self._tokenize(doc.page_content)
-                self.vocabulary.update(tokens)
-            
-            # IDF再計算
-            self._calculate_idf()
-            
-            # 全ドキュメントのTF-IDFベクトルを再計算
-            self.tfidf_vectors = []
-            for doc in self.documents:
-                tokens = self._tokenize(doc.page_content)
-                tfidf_vector = self._calculate_tfidf_vector(tokens)
-                self.tfidf_vectors.append(tfidf_vector)
-            
-            # データを保存
-            self._save_data()
-            
-            logger.info(f"Added {len(documents)} documents for {microcontroller}")
-            logger.info(f"Total documents: {len(self.documents)}")
-            logger.info(f"Vocabulary size: {len(self.vocabulary)}")
+        with self._manifest_lock, self._index_lock.write():
+            try:
+                if not documents:
+                    logger.warning("No documents to add")
+                    return False
+                
+                # メタデータにマイコン情報を追加
+                for doc in documents:
+                    doc.metadata["microcontroller"] = microcontroller
+                
+                # ドキュメントを追加（新しいバッチ分だけトークン化）
+                first_doc_id = len(self.documents)
+                self.documents.extend(documents)
+                for doc in documents:
+                    self._index_document(doc)
+                if self._chunk_positions is not None:
+                    for doc_id, doc in enumerate(documents, first_doc_id):
+                        self._register_position(doc_id, doc.metadata)
+                if self._metadata_index is not None:
+                    self._metadata_index.extend(doc.metadata for doc in documents)
+                
+                # IDFと重みはクエリ時に遅延再計算
+                self._weights_dirty = True
+                self._corpus_version = uuid.uuid4().hex
+                
+                # データを保存
+                self._save_data()
+                
+                logger.info(f"Added {len(documents)} documents for {microcontroller}")
+                logger.info(f"Total documents: {len(self.documents)}")
+                logger.info(f"Vocabulary size: {len(self.vocabulary)}")
+                
+                return True
             
-            return True
+            except Exception as e:
+                logger.error(f"Failed to add documents: {e}")
+                return False
+    
+    @_reads_index
+    def list_sources(self) -> Dict[str, int]:
+        """登録済みチャンクのsource（元ファイルパス）ごとの件数"""
+        return dict(Counter(
+            metadata["source"] for metadata in self._iter_metadata() if metadata.get("source")
+        ))
+    
+    def delete_documents_by_source(self, sources: List[str], save: bool = True) -> int:
+        """指定したsourceのチャンクを削除して削除件数を返す
+        
+        残りのチャンクはキャッシュ済みのトークン数から再索引する（再トークン化しない）
+        """
+        with self._manifest_lock, self._index_lock.write():
+            try:
+                targets = set(sources)
+                keep = [
+                    doc_id for doc_id, metadata in enumerate(self._iter_metadata())
+                    if metadata.get("source") not in targets
+                ]
+                removed = len(self.documents) - len(keep)
+                if removed == 0:
+                    return 0
+                
+                documents = [self.documents[doc_id] for doc_id in keep]
+                term_counts = [dict(self.doc_term_counts[doc_id]) for doc_id in keep]
+                lengths = [self.doc_lengths[doc_id] for doc_id in keep]
+                
+                self._reset_index_state()
+                self.documents.extend(documents)
+                for token_count, total_tokens in zip(term_counts, lengths):
+                    self._index_term_counts(token_count, total_tokens)
+                
+                self._corpus_version = uuid.uuid4().hex
+                self._needs_snapshot = True
+                
+                if save:
+                    self._save_data()
+                
+                logger.info(f"Deleted {removed} documents from {len(targets)} sources")
+                return removed
             
-        except Exception as e:
-            logger.error(f"Failed to add documents: {e}")
-            return False
+            except Exception as e:
+                logger.error(f"Failed to delete documents: {e}")
+                return 0
+    
+    def reload(self):
+        """メモリ上の未保存の変更を破棄し、ディスク上のインデックスを読み直す（取り込み失敗時の巻き戻し用）"""
+        with self._manifest_lock, self._index_lock.write():
+            self._reset_index_state()
+            self._needs_snapshot = False
+            self._load_data()
+            self._mark_synced()
+            logger.info(f"Reloaded {len(self.documents)} documents from disk")
     
+    @_reads_index
     def search_similar_documents(self, 
                                query: str, 
                                k: int = 5, 
                                microcontroller: str = None,
                                category: str = None,
-                               score_threshold: float = 0.1) -> List[Tuple[Document, float]]:
-        """類似ドキュメントを検索"""
+                               score_threshold: float = 0.1,
+                               ranking: str = None) -> List[Tuple[Document, float]]:
+        """類似ドキュメントを検索
+        
+        rankingは"tfidf"（コサイン類似度）・"bm25"・"bm25+"。省略時はConfig.SIMPLE_RANKING
+        """
         try:
             if not self.documents:
                 logger.warning("No documents in database")
                 return []
             
+            ranking = (ranking or Config.SIMPLE_RANKING).lower()
+            if ranking in ("bm25", "bm25+"):
+                top = self._search_bm25(query, k, microcontroller, category, score_threshold, plus=ranking == "bm25+")
+                results = [(self.documents[doc_id], 1.0 - similarity) for doc_id, similarity in top]
+                logger.info(f"Found {len(results)} relevant documents for query ({ranking}): {query[:50]}...")
+                return results
+            
             # クエリのTF-IDFベクトル計算
             query_tokens = self._tokenize(query)
             query_vector = self._calculate_tfidf_vector(query_tokens)
+            query_norm = math.sqrt(sum(val ** 2 for val in query_vector.values()))
+            if query_norm == 0:
+                return []
+            
+            if self.sparse_index is not None:
+                top = self._search_sparse(query_vector, k, microcontroller, category, score_threshold)
+                results = [(self.documents[doc_id], 1.0 - similarity) for doc_id, similarity in top]
+                logger.info(f"Found {len(results)} relevant documents for query: {query[:50]}...")
+                return results
             
-            # 各ドキュメントとの類似度計算
-            similarities = []
-            for i, (doc, doc_vector) in enumerate(zip(self.documents, self.tfidf_vectors)):
-                # フィルター適用
-                if microcontroller and doc.metadata.get("microcontroller") != microcontroller:
+            # 絞り込み条件に一致するドキュメントのポスティングだけを使う
+            postings = self._filtered_postings(query_vector, microcontroller, category)
+            
+            # クエリトークンを含むドキュメントのみ内積を累積
+            dot_products = defaultdict(float)
+            for token, query_weight in query_vector.items():
+                if query_weight == 0:
                     continue
-                if category and doc.metadata.get("category") != category:
+                idf = self.idf_scores.get(token, 0)
+                for doc_id, tf in postings.get(token, ()):
+                    dot_products[doc_id] += query_weight * tf * idf
+            
+            # 各候補との類似度計算
+            candidates = []
+            for doc_id, dot_product in dot_products.items():
+                doc_norm = self.doc_norms[doc_id]
+                if doc_norm == 0:
                     continue
                 
-                similarity = self._cosine_similarity(query_vector, doc_vector)
+                similarity = dot_product / (query_norm * doc_norm)
                 if similarity >= score_threshold:
-                    similarities.append((doc, 1.0 - similarity))  # スコアを距離に変換
+                    candidates.append((similarity, doc_id))
             
-            # 類似度でソート（スコアが小さいほど類似度が高い）
-            similarities.sort(key=lambda x: x[1])
+            # ヒープで上位k件を選択（同点は登録順）
+            top = heapq.nlargest(k, candidates, key=lambda x: (x[0], -x[1]))
             
-            # 上位k件を返す
-            results = similarities[:k]
+            # スコアを距離に変換（スコアが小さいほど類似度が高い）
+            results = [(self.documents[doc_id], 1.0 - similarity) for similarity, doc_id in top]
             
             logger.info(f"Found {len(results)} relevant documents for query: {query[:50]}...")
             return results
-            
+        
         except Exception as e:
             logger.error(f"Search failed: {e}")
             return []
     
+    @_reads_index
+    def search_similar_documents_batch(self,
+                                       queries: List[str],
+                                       k: int = 5,
+                                       microcontrollers: List[Optional[str]] = None,
+                                       category: str = None,
+                                       score_threshold: float = 0.1,
+                                       ranking: str = None) -> List[List[Tuple[Document, float]]]:
+        """複数クエリをまとめて検索（結果はsearch_similar_documentsをクエリごとに呼んだ場合と同じ）
+        
+        microcontrollersはクエリごとの絞り込み（Noneで全件）。
+        疎行列バックエンドではクエリを行列にまとめて1回の疎行列積でスコアを計算し、
+        辞書バックエンドではクエリごとに検索する
+        """
+        microcontrollers = microcontrollers or [None] * len(queries)
+        if self.sparse_index is None or not self.documents:
+            return [
+                self.search_similar_documents(query, k, microcontroller, category, score_threshold, ranking)
+                for query, microcontroller in zip(queries, microcontrollers)
+            ]
+        
+        try:
+            ranking = (ranking or Config.SIMPLE_RANKING).lower()
+            row_sets = [self._metadata_rows(microcontroller, category) for microcontroller in microcontrollers]
+            
+            if ranking in ("bm25", "bm25+"):
+                stats = self._ensure_bm25_stats()
+                delta = Config.BM25_DELTA if ranking == "bm25+" else 0.0
+                query_counts = [
+                    Counter(token for token in self._tokenize(query) if token in stats["idf"])
+                    for query in queries
+                ]
+                max_scores = [
+                    sum(count * stats["idf"][token] * (stats["k1"] + 1.0 + delta) for token, count in counts.items())
+                    for counts in query_counts
+                ]
+                tops = self.sparse_index.search_bm25_many(
+                    query_counts, stats, delta, max_scores, k, row_sets, score_threshold
+                )
+            else:
+                query_vectors = [self._calculate_tfidf_vector(self._tokenize(query)) for query in queries]
+                tops = self.sparse_index.search_many(query_vectors, k, row_sets, score_threshold)
+            
+            logger.info(f"Batch search: {len(queries)} queries ({ranking})")
+            return [
+                [(self.documents[doc_id], 1.0 - similarity) for doc_id, similarity in top]
+                for top in tops
+            ]
+        
+        except Exception as e:
+            logger.error(f"Batch search failed: {e}")
+            return [[] for _ in queries]
+    
+    def _search_sparse(self,
+                       query_vector: Dict[str, float],
+                       k: int,
+                       microcontroller: str = None,
+                       category: str = None,
+                       score_threshold: float = 0.1) -> List[Tuple[int, float]]:
+        """疎行列バックエンドでの検索（絞り込み条件に一致する行の部分行列×ベクトル + argpartition）"""
+        rows = self._metadata_rows(microcontroller, category)
+        return self.sparse_index.search(query_vector, k, rows, score_threshold)
+    
+    def _ensure_metadata_index(self) -> MetadataIndex:
+        """メタデータ索引を構築（初回参照時のみ全メタデータを走査）"""
+        metadata_index = self._metadata_index
+        if metadata_index is None:
+            # 構築し終えてから公開（並行検索で途中の索引を参照しない）
+            metadata_index = MetadataIndex()
+            metadata_index.extend(self._iter_metadata())
+            self._metadata_index = metadata_index
+        return metadata_index
+    
+    def _metadata_rows(self, microcontroller: str = None, category: str = None):
+        """メタデータ条件に一致する行番号の昇順配列（条件なしの場合はNone）"""
+        if not microcontroller and not category:
+            return None
+        return self._ensure_metadata_index().row_ids({"microcontroller": microcontroller, "category": category})
+    
+    def _filtered_postings(self, tokens: Iterable[str], microcontroller: str = None, category: str = None):
+        """クエリトークンのポスティングを絞り込み条件に一致するドキュメントだけに限定（条件なしの場合は全体）
+        
+        一致する行がポスティングの合計より少なければ、その行のトークン数から直接組み立てる
+        """
+        if not microcontroller and not category:
+            return self.postings
+        
+        rows = self._ensure_metadata_index().matching_rows({"microcontroller": microcontroller, "category": category})
+        tokens = [token for token in tokens if token in self.postings]
+        if len(rows) < sum(len(self.postings[token]) for token in tokens):
+            postings = {token: [] for token in tokens}
+            for doc_id in rows:
+                token_count = self.doc_term_counts[doc_id]
+                total_tokens = self.doc_lengths[doc_id]
+                for token in tokens:
+                    count = token_count.get(token)
+                    if count:
+                        postings[token].append((doc_id, count / total_tokens))
+            return postings
+        
+        row_set = set(rows)
+        return {
+            token: [posting for posting in self.postings[token] if posting[0] in row_set]
+            for token in tokens
+        }
+    
+    def _ensure_bm25_stats(self) -> Dict:
+        """BM25のIDF・平均文書長・文書ごとの長さ正規化項を計算（追加後の初回のみ）"""
+        self._refresh_weights()
+        if self._bm25_stats is not None:
+            return self._bm25_stats
+        
+        k1, b = Config.BM25_K1, Config.BM25_B
+        doc_count = len(self.doc_lengths)
+        avgdl = (sum(self.doc_lengths) / doc_count) if doc_count else 0.0
+        
+        # 負にならない形のIDF（log(1 + (N - df + 0.5) / (df + 0.5))）
+        idf = {
+            token: math.log(1.0 + (doc_count - df + 0.5) / (df + 0.5))
+            for token, df in self.doc_freq.items()
+        }
+        length_norms = [k1 * (1.0 - b + b * length / avgdl) if avgdl else k1 for length in self.doc_lengths]
+        
+        self._bm25_stats = {"idf": idf, "avgdl": avgdl, "length_norms": length_norms, "k1": k1, "b": b}
+        return self._bm25_stats
+    
+    def _search_bm25(self,
+                     query: str,
+                     k: int,
+                     microcontroller: str = None,
+                     category: str = None,
+                     score_threshold: float = 0.1,
+                     plus: bool = False) -> List[Tuple[int, float]]:
+        """BM25（plus=TrueでBM25+）で上位k件の(doc_id, 正規化スコア)を返す
+        
+        スコアはクエリが取りうる最大値（出現数→∞）で割って0〜1に正規化する
+        """
+        stats = self._ensure_bm25_stats()
+        k1 = stats["k1"]
+        delta = Config.BM25_DELTA if plus else 0.0
+        
+        query_counts = Counter(token for token in self._tokenize(query) if token in stats["idf"])
+        max_score = sum(
+            count * stats["idf"][token] * (k1 + 1.0 + delta)
+            for token, count in query_counts.items()
+        )
+        if max_score == 0:
+            return []
+        
+        if self.sparse_index is not None:
+            rows = self._metadata_rows(microcontroller, category)
+            return self.sparse_index.search_bm25(
+                query_counts, stats, delta, max_score, k, rows, score_threshold
+            )
+        
+        # 絞り込み条件に一致するドキュメントのポスティングのみ走査（postingsのtfと文書長から出現数を復元）
+        postings = self._filtered_postings(query_counts, microcontroller, category)
+        scores = defaultdict(float)
+        doc_lengths = self.doc_lengths
+        length_norms = stats["length_norms"]
+        for token, query_count in query_counts.items():
+            weight = query_count * stats["idf"][token]
+            for doc_id, tf in postings.get(token, ()):
+                frequency = tf * doc_lengths[doc_id]
+                scores[doc_id] += weight * (frequency * (k1 + 1.0) / (frequency + length_norms[doc_id]) + delta)
+        
+        candidates = []
+        for doc_id, score in scores.items():
+            similarity = score / max_score
+            if similarity >= score_threshold:
+                candidates.append((similarity, doc_id))
+        
+        top = heapq.nlargest(k, candidates, key=lambda x: (x[0], -x[1]))
+        return [(doc_id, similarity) for similarity, doc_id in top]
+    
+    def _iter_metadata(self):
+        """本文を読み込まずに全チャンクのメタデータを返す"""
+        for doc_id in range(len(self.documents)):
+            yield self.documents.metadata(doc_id)
+    
+    def _ensure_position_index(self):
+        """チャンク番号・ページから doc_id を引く索引を構築（初回参照時のみ全メタデータを走査）"""
+        if self._chunk_positions is not None:
+            return
+        chunk_positions = {}
+        page_positions = defaultdict(list)
+        for doc_id, metadata in enumerate(self._iter_metadata()):
+            self._register_position(doc_id, metadata, chunk_positions, page_positions)
+        self._page_positions = page_positions
+        self._chunk_positions = chunk_positions
+    
+    def _register_position(self, doc_id: int, metadata: Dict, chunk_positions: Dict = None, page_positions: Dict = None):
+        chunk_positions = self._chunk_positions if chunk_positions is None else chunk_positions
+        page_positions = self._page_positions if page_positions is None else page_positions
+        filename = metadata.get("filename")
+        if filename is None:
+            return
+        if "chunk_index" in metadata:
+            chunk_positions[(filename, metadata["chunk_index"])] = doc_id
+        page_start = metadata.get("page_start")
+        if page_start is not None:
+            for page in range(page_start, metadata.get("page_end", page_start) + 1):
+                page_positions[(filename, page)].append(doc_id)
+    
+    @_reads_index
+    def get_chunk(self, filename: str, chunk_index: int) -> Optional[Document]:
+        """ファイル名とチャンク番号でチャンクを取得"""
+        self._ensure_position_index()
+        doc_id = self._chunk_positions.get((filename, chunk_index))
+        return self.documents[doc_id] if doc_id is not None else None
+    
+    @_reads_index
+    def get_neighbor_chunks(self, filename: str, chunk_index: int, window: int = 1) -> List[Document]:
+        """前後window件の隣接チャンクを（中心のチャンクを含めて）文書内の順に取得"""
+        self._ensure_position_index()
+        neighbors = []
+        for index in range(chunk_index - window, chunk_index + window + 1):
+            doc_id = self._chunk_positions.get((filename, index))
+            if doc_id is not None:
+                neighbors.append(self.documents[doc_id])
+        return neighbors
+    
+    @_reads_index
+    def get_page_range(self, filename: str, page_start: int, page_end: int = None) -> List[Document]:
+        """指定ページ範囲（1始まり、両端を含む）にかかるチャンクを文書内の順に取得"""
+        self._ensure_position_index()
+        doc_ids = set()
+        for page in range(page_start, (page_end or page_start) + 1):
+            doc_ids.update(self._page_positions.get((filename, page), ()))
+        return [self.documents[doc_id] for doc_id in sorted(doc_ids)]
+    
     def get_relevant_documents(self, 
                              query: str, 
                              k: int = 5,
@@ -215,22 +730,20 @@ class SimpleVectorDatabase:
         results = self.search_similar_documents(query, k, microcontroller)
         return [doc for doc, score in results]
     
+    @_reads_index
     def list_collections(self) -> List[str]:
         """利用可能なコレクションを一覧表示"""
-        microcontrollers = set()
-        for doc in self.documents:
-            mc = doc.metadata.get("microcontroller")
-            if mc:
-                microcontrollers.add(f"microcontroller_{mc.lower().replace('-', '_')}")
-        return list(microcontrollers)
+        microcontrollers = self._ensure_metadata_index().counts("microcontroller")
+        return [f"microcontroller_{mc.lower().replace('-', '_')}" for mc in microcontrollers if mc]
     
+    @_reads_index
     def get_collection_stats(self, microcontroller: str = None) -> Dict:
-        """コレクションの統計情報を取得"""
+        """コレクションの統計情報を取得（メタデータ索引の件数を参照）"""
         stats = {}
+        microcontroller_counts = self._ensure_metadata_index().counts("microcontroller")
         
         if microcontroller:
-            count = sum(1 for doc in self.documents 
-                       if doc.metadata.get("microcontroller") == microcontroller)
+            count = microcontroller_counts.get(microcontroller, 0)
             collection_name = f"microcontroller_{microcontroller.lower().replace('-', '_')}"
             stats[collection_name] = {
                 "document_count": count,
@@ -238,12 +751,8 @@ class SimpleVectorDatabase:
             }
         else:
             # 全てのマイコンの統計
-            microcontroller_counts = Counter()
-            for doc in self.documents:
-                mc = doc.metadata.get("microcontroller", "unknown")
-                microcontroller_counts[mc] += 1
-            
             for mc, count in microcontroller_counts.items():
+                mc = mc or "unknown"
                 collection_name = f"microcontroller_{mc.lower().replace('-', '_')}"
                 stats[collection_name] = {
                     "document_count": count,
@@ -252,48 +761,328 @@ class SimpleVectorDatabase:
         
         return stats
     
+    def storage_signature(self) -> Optional[Tuple]:
+        """ディスク上のインデックスの識別子（マニフェストまたはpickleのinode・更新時刻・サイズ）"""
+        for path in (os.path.join(self.index_directory, MANIFEST_FILE),
+                     os.path.join(self.persist_directory, "simple_vector_db.pkl")):
+            try:
+                stat = os.stat(path)
+                return (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                continue
+        return None
+    
+    def _mark_synced(self, content_changed: bool = True):
+        """ディスクと同期した時点の識別子を記録し、内容が変わった場合はコーパスバージョンを更新"""
+        self.loaded_signature = self.storage_signature()
+        if content_changed:
+            if self.loaded_signature is not None:
+                self._corpus_version = hashlib.md5(repr(self.loaded_signature).encode()).hexdigest()
+            else:
+                self._corpus_version = uuid.uuid4().hex
+    
+    @property
+    def corpus_version(self) -> str:
+        """コーパス内容のバージョン（追加・再読み込みのたびに変わる。キャッシュ無効化に使用）"""
+        return self._corpus_version
+    
+    def has_external_changes(self) -> bool:
+        """他プロセス等によりディスク上のインデックスが更新されたかどうか"""
+        return self.storage_signature() != self.loaded_signature
+    
     def _save_data(self):
         """データを保存"""
         try:
-            data = {
-                "documents": [(doc.page_content, doc.metadata) for doc in self.documents],
-                "tfidf_vectors": self.tfidf_vectors,
-                "vocabulary": list(self.vocabulary),
-                "idf_scores": self.idf_scores
-            }
-            
-            with open(os.path.join(self.persist_directory, "simple_vector_db.pkl"), "wb") as f:
-                pickle.dump(data, f)
+            if STORAGE_AVAILABLE:
+                self._save_index()
+            else:
+                self._save_pickle()
+            self._mark_synced()
             
             logger.info("Data saved successfully")
-            
+        
         except Exception as e:
             logger.error(f"Failed to save data: {e}")
     
+    def _save_pickle(self):
+        """旧形式（単一pickle）で保存（numpy未導入時のフォールバック）"""
+        data = {
+            "tokenizer": self.tokenizer.signature,
+            "documents": [(doc.page_content, doc.metadata) for doc in self.documents],
+            "doc_term_counts": list(self.doc_term_counts),
+            "doc_lengths": self.doc_lengths
+        }
+        
+        with open(os.path.join(self.persist_directory, "simple_vector_db.pkl"), "wb") as f:
+            pickle.dump(data, f)
+    
+    def _term_count_arrays(self, start: int = 0):
+        """トークン出現数をCSR形式の配列（語彙, indptr, indices, counts）で取得
+        
+        startを指定するとそのチャンク以降のみを対象にする（追記用）
+        """
+        if self.sparse_index is not None and start == 0:
+            index = self.sparse_index
+            return index.terms, index.indptr, index.indices, index.counts
+        
+        terms = []
+        term_to_col = {}
+        indptr, indices, counts = [0], [], []
+        for doc_id in range(start, len(self.doc_lengths)):
+            for token, count in self.doc_term_counts[doc_id].items():
+                col = term_to_col.get(token)
+                if col is None:
+                    col = len(terms)
+                    term_to_col[token] = col
+                    terms.append(token)
+                indices.append(col)
+                counts.append(count)
+            indptr.append(len(indices))
+        return terms, indptr, indices, counts
+    
+    def _next_segment_name(self, manifest: Dict) -> Tuple[str, int]:
+        """マニフェストの世代番号から新しいセグメント名を払い出す"""
+        generation = manifest["generation"] + 1
+        return f"seg-{generation:06d}", generation
+    
+    def _save_index(self):
+        """セグメント形式で保存"""
+        os.makedirs(self.index_directory, exist_ok=True)
+        if self.write_mode == "append" and not self._needs_snapshot:
+            self._append_segment()
+            self._maybe_compact()
+        else:
+            self._write_snapshot()
+            self._needs_snapshot = False
+    
+    def _write_snapshot(self):
+        """全体を新しい世代の単一セグメントとして書き出してからマニフェストを切り替え"""
+        with self._manifest_lock:
+            manifest = read_manifest(self.index_directory) or {"generation": 0, "segments": []}
+            name, generation = self._next_segment_name(manifest)
+            
+            terms, indptr, indices, counts = self._term_count_arrays()
+            write_segment(self.index_directory, name, self.documents, terms,
+                          indptr, indices, counts, self.doc_lengths, self.tokenizer.signature)
+            
+            manifest = {"generation": generation, "segments": [name]}
+            write_manifest(self.index_directory, manifest)
+            
+            # 本文の参照先を新しいセグメントへ切り替えてから旧世代を削除
+            self.documents = LazyDocumentList([IndexSegment(os.path.join(self.index_directory, name))])
+            remove_unreferenced_segments(self.index_directory, manifest)
+    
+    def _append_segment(self):
+        """未保存のバッチだけを不変セグメントとして追記（書き込み量はバッチに比例）"""
+        with self._manifest_lock:
+            pending = self.documents.pending
+            if not pending:
+                return
+            
+            manifest = read_manifest(self.index_directory) or {"generation": 0, "segments": []}
+            name, generation = self._next_segment_name(manifest)
+            
+            start = len(self.documents) - len(pending)
+            terms, indptr, indices, counts = self._term_count_arrays(start)
+            write_segment(self.index_directory, name, pending, terms,
+                          indptr, indices, counts, self.doc_lengths[start:], self.tokenizer.signature)
+            
+            # マニフェストのrenameで追記を確定（途中で落ちても旧マニフェストは無傷）
+            manifest = {"generation": generation, "segments": manifest["segments"] + [name]}
+            write_manifest(self.index_directory, manifest)
+            
+            segment = IndexSegment(os.path.join(self.index_directory, name))
+            self.documents = LazyDocumentList(self.documents.segments + [segment])
+    
+    def _maybe_compact(self):
+        """小さなセグメントが溜まっていればバックグラウンドでコンパクション"""
+        if len(self.documents.segments) < Config.SIMPLE_INDEX_COMPACTION_TRIGGER:
+            return
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+        
+        self._compaction_thread = threading.Thread(target=self.compact, name="simple-index-compaction", daemon=True)
+        self._compaction_thread.start()
+    
+    def compact(self) -> bool:
+        """連続する小さなセグメントを1つにマージしてマニフェストを差し替える
+        
+        マージ結果はチャンクの並び順を保つため、メモリ上のdoc_idはそのまま有効
+        """
+        if not self._compaction_lock.acquire(blocking=False):
+            return False
+        try:
+            with self._manifest_lock:
+                manifest = read_manifest(self.index_directory)
+                if not manifest:
+                    return False
+                run = self._find_compaction_run(manifest["segments"])
+                if len(run) < 2:
+                    return False
+                # 世代番号を先に確保して、並行する追記と名前が衝突しないようにする
+                name, generation = self._next_segment_name(manifest)
+                write_manifest(self.index_directory, dict(manifest, generation=generation))
+                self._mark_synced(content_changed=False)
+            
+            # 不変セグメントの読み取りとマージはロック外で実行
+            segments = [IndexSegment(os.path.join(self.index_directory, n)) for n in run]
+            terms, indptr, indices, counts, lengths, _ = merge_segment_arrays(segments)
+            write_segment(self.index_directory, name, LazyDocumentList(segments), terms,
+                          indptr, indices, counts, lengths, self.tokenizer.signature)
+            merged = IndexSegment(os.path.join(self.index_directory, name))
+            
+            with self._manifest_lock:
+                manifest = read_manifest(self.index_directory)
+                live = manifest["segments"]
+                position = live.index(run[0])
+                if live[position:position + len(run)] != run:
+                    logger.warning("Segments changed during compaction. Discarding merged segment")
+                    remove_unreferenced_segments(self.index_directory, manifest)
+                    return False
+                
+                manifest = dict(manifest, segments=live[:position] + [name] + live[position + len(run):])
+                write_manifest(self.index_directory, manifest)
+                self._mark_synced(content_changed=False)
+                
+                # メモリ上のドキュメント列も同じ並びのまま差し替え
+                current = self.documents
+                replaced = []
+                for segment in current.segments:
+                    name_of = os.path.basename(segment.path)
+                    if name_of == run[0]:
+                        replaced.append(merged)
+                    elif name_of not in run:
+                        replaced.append(segment)
+                documents = LazyDocumentList(replaced)
+                documents.extend(current.pending)
+                self.documents = documents
+                
+                remove_unreferenced_segments(self.index_directory, manifest)
+            
+            logger.info(f"Compacted {len(run)} segments into {name}")
+            return True
+        
+        except Exception as e:
+            logger.error(f"Compaction failed: {e}")
+            return False
+        finally:
+            self._compaction_lock.release()
+    
+    def _find_compaction_run(self, names: List[str]) -> List[str]:
+        """マージ対象となる連続した小さなセグメントの最長列を探す"""
+        best, current = [], []
+        for name in names:
+            try:
+                segment = IndexSegment(os.path.join(self.index_directory, name))
+                small = segment.num_docs < Config.SIMPLE_INDEX_SMALL_SEGMENT_DOCS
+            except Exception:
+                small = False
+            if small:
+                current.append(name)
+                if len(current) > len(best):
+                    best = list(current)
+            else:
+                current = []
+        return best
+    
     def _load_data(self):
         """データを読み込み"""
         try:
+            manifest = read_manifest(self.index_directory) if STORAGE_AVAILABLE else None
+            if manifest:
+                for attempt in range(3):
+                    try:
+                        self._load_index(manifest)
+                        break
+                    except FileNotFoundError:
+                        # 読み込み中にコンパクションで旧セグメントが消えた場合は最新のマニフェストで再試行
+                        if attempt == 2:
+                            raise
+                        manifest = read_manifest(self.index_directory)
+                logger.info(f"Loaded {len(self.documents)} documents from index")
+                return
+            
             data_file = os.path.join(self.persist_directory, "simple_vector_db.pkl")
             if os.path.exists(data_file):
                 with open(data_file, "rb") as f:
                     data = pickle.load(f)
                 
                 # ドキュメント復元
-                self.documents = [
+                self.documents = LazyDocumentList()
+                self.documents.extend([
                     Document(page_content=content, metadata=metadata)
                     for content, metadata in data.get("documents", [])
-                ]
+                ])
                 
-                self.tfidf_vectors = data.get("tfidf_vectors", [])
-                self.vocabulary = set(data.get("vocabulary", []))
-                self.idf_scores = data.get("idf_scores", {})
+                if "doc_term_counts" in data and data.get("tokenizer", LEGACY_TOKENIZER_SIGNATURE) == self.tokenizer.signature:
+                    for token_count, total_tokens in zip(data["doc_term_counts"], data["doc_lengths"]):
+                        self._index_term_counts(token_count, total_tokens)
+                else:
+                    # 旧形式（TF-IDFベクトルのみ）または別トークナイザーからの移行：一度だけトークン化
+                    for doc in self.documents:
+                        self._index_document(doc)
+                self._weights_dirty = True
                 
                 logger.info(f"Loaded {len(self.documents)} documents from cache")
-            
+                
+                # pickleからセグメント形式へ移行
+                if STORAGE_AVAILABLE and self.documents:
+                    self._save_index()
+                    logger.info("Migrated simple_vector_db.pkl to segment index format")
+        
         except Exception as e:
             logger.warning(f"Failed to load existing data: {e}")
             # 新規データベースとして初期化
-            self.documents = []
-            self.tfidf_vectors = []
-            self.vocabulary = set()
-            self.idf_scores = {}
\ No newline at end of file
+            self._reset_index_state()
+    
+    def _load_index(self, manifest: Dict):
+        """マニフェストに記載されたセグメントを読み込む（数値配列はmemmap）"""
+        segments = [
+            IndexSegment(os.path.join(self.index_directory, name))
+            for name in manifest.get("segments", [])
+        ]
+        self.documents = LazyDocumentList(segments)
+        self._chunk_positions = None
+        self._page_positions = None
+        self._metadata_index = None
+        if not segments:
+            return
+        
+        # 別のトークナイザーで作成されたインデックスは本文から再トークン化して書き直す
+        signatures = {segment.header.get("tokenizer", LEGACY_TOKENIZER_SIGNATURE) for segment in segments}
+        if signatures != {self.tokenizer.signature}:
+            logger.info(f"Index was built with {sorted(signatures)}. Re-tokenizing with {self.tokenizer.signature}")
+            for doc in self.documents:
+                self._index_document(doc)
+            self._weights_dirty = True
+            self._needs_snapshot = True
+            self._save_index()
+            return
+        
+        terms, indptr, indices, counts, lengths, df = merge_segment_arrays(segments)
+        
+        if self.sparse_index is None:
+            # 辞書バックエンドはポスティングを再構築
+            for token_count, total_tokens in zip(iter_term_counts(terms, indptr, indices, counts), lengths):
+                self._index_term_counts(token_count, int(total_tokens))
+            self._weights_dirty = True
+            return
+        
+        # 単一セグメントなら保存済みの重みをそのまま疎行列として使う
+        single = segments[0] if len(segments) == 1 else None
+        self.sparse_index = SparseTfidfIndex.from_arrays(
+            terms, indptr, indices, counts, lengths,
+            weights=single.weights if single else None,
+            norms=single.norms if single else None
+        )
+        self.doc_term_counts = self.sparse_index.term_counts()
+        self.doc_lengths = lengths.tolist()
+        self.doc_freq = Counter(dict(zip(terms, df.tolist())))
+        self.vocabulary = set(terms)
+        
+        if single:
+            self._calculate_idf()
+            self.doc_norms = single.norms
+            self._weights_dirty = False
+        else:
+            self._weights_dirty = True
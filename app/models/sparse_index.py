@@ -0,0 +1,327 @@
+"""
+TF-IDFストアの疎行列バックエンド（scipy CSR + NumPy）
+語彙→列番号の対応表とL2正規化済みのTF-IDF行列を保持する
+"""
+import math
+import logging
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+    from scipy import sparse
+    SPARSE_AVAILABLE = True
+except ImportError:
+    SPARSE_AVAILABLE = False
+
+from models.index_storage import compute_tfidf_weights
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class SparseTermCounts:
+    """CSRに格納したトークン出現数を辞書のリストとして参照するビュー"""
+    
+    def __init__(self, index: "SparseTfidfIndex"):
+        self._index = index
+    
+    def __len__(self) -> int:
+        return len(self._index.indptr) - 1
+    
+    def __getitem__(self, doc_id: int) -> Dict[str, int]:
+        if doc_id < 0:
+            doc_id += len(self)
+        start, end = self._index.indptr[doc_id], self._index.indptr[doc_id + 1]
+        terms = self._index.terms
+        return {
+            terms[int(self._index.indices[i])]: int(self._index.counts[i])
+            for i in range(int(start), int(end))
+        }
+    
+    def __iter__(self) -> Iterator[Dict[str, int]]:
+        for doc_id in range(len(self)):
+            yield self[doc_id]
+
+class SparseTfidfIndex:
+    """疎行列によるTF-IDFインデックス"""
+    
+    def __init__(self):
+        if not SPARSE_AVAILABLE:
+            raise ImportError("numpy and scipy are required for the sparse backend")
+        
+        self.term_to_col = {}  # トークン -> 列番号
+        self.terms = []  # 列番号 -> トークン
+        
+        # 生のトークン出現数（CSR形式、追記のみ）
+        self.indptr = array("q", [0])
+        self.indices = array("i")
+        self.counts = array("i")
+        self.lengths = array("i")
+        
+        self.matrix = None  # L2正規化済みTF-IDF行列
+        self.idf = None
+        self.norms = None  # 正規化前のL2ノルム
+        self._bm25 = None  # (パラメータ, BM25重み行列)
+    
+    @classmethod
+    def from_arrays(cls,
+                    terms: List[str],
+                    indptr,
+                    indices,
+                    counts,
+                    lengths,
+                    weights=None,
+                    norms=None) -> "SparseTfidfIndex":
+        """保存済みの配列（memmap可）からインデックスを復元"""
+        index = cls()
+        index.terms = list(terms)
+        index.term_to_col = {term: col for col, term in enumerate(index.terms)}
+        index.indptr, index.indices, index.counts, index.lengths = indptr, indices, counts, lengths
+        
+        # 事前計算済みの重みがあればコピーせずにそのまま行列として使う
+        if weights is not None:
+            index.matrix = sparse.csr_matrix(
+                (weights, indices, indptr),
+                shape=(len(indptr) - 1, len(index.terms)),
+                copy=False
+            )
+            index.norms = norms
+        return index
+    
+    @property
+    def num_docs(self) -> int:
+        return len(self.indptr) - 1
+    
+    def _thaw(self):
+        """memmapの読み取り専用配列を追記可能なバッファへ変換"""
+        if isinstance(self.indices, array):
+            return
+        
+        buffers = []
+        for typecode, values in [("q", self.indptr), ("i", self.indices), ("i", self.counts), ("i", self.lengths)]:
+            buffer = array(typecode)
+            buffer.frombytes(np.asarray(values, dtype=np.int64 if typecode == "q" else np.int32).tobytes())
+            buffers.append(buffer)
+        self.indptr, self.indices, self.counts, self.lengths = buffers
+    
+    def add_document(self, token_count: Dict[str, int], total_tokens: int):
+        """1チャンク分のトークン出現数を追記"""
+        self._thaw()
+        for token, count in token_count.items():
+            col = self.term_to_col.get(token)
+            if col is None:
+                col = len(self.terms)
+                self.term_to_col[token] = col
+                self.terms.append(token)
+            self.indices.append(col)
+            self.counts.append(count)
+        self.indptr.append(len(self.indices))
+        self.lengths.append(total_tokens)
+        self.matrix = None
+        self._bm25 = None
+    
+    def refresh(self, idf_scores: Dict[str, float]):
+        """IDFを反映して行列を再構築（トークン化は行わない）"""
+        num_terms = len(self.terms)
+        self.idf = np.fromiter(
+            (idf_scores.get(term, 0.0) for term in self.terms),
+            dtype=np.float64,
+            count=num_terms
+        )
+        
+        indptr = np.asarray(self.indptr, dtype=np.int64)
+        indices = np.asarray(self.indices, dtype=np.int32)
+        data, norms = compute_tfidf_weights(indptr, indices, self.counts, self.lengths, self.idf)
+        
+        self.matrix = sparse.csr_matrix(
+            (data, indices.copy(), indptr.copy()),
+            shape=(self.num_docs, num_terms)
+        )
+        self.norms = norms
+        self._bm25 = None
+    
+    def _bm25_matrix(self, stats: Dict, delta: float):
+        """BM25の項ごとの重み行列（IDF込み、BM25+のdeltaを含む）をパラメータごとに1度だけ構築"""
+        key = (id(stats), delta)
+        if self._bm25 is not None and self._bm25[0] == key:
+            return self._bm25[1]
+        
+        indptr = np.asarray(self.indptr, dtype=np.int64)
+        indices = np.asarray(self.indices, dtype=np.int32)
+        counts = np.asarray(self.counts, dtype=np.float64)
+        idf = np.fromiter(
+            (stats["idf"].get(term, 0.0) for term in self.terms),
+            dtype=np.float64,
+            count=len(self.terms)
+        )
+        length_norms = np.asarray(stats["length_norms"], dtype=np.float64)
+        rows = np.repeat(np.arange(self.num_docs), np.diff(indptr))
+        
+        k1 = stats["k1"]
+        data = idf[indices] * (counts * (k1 + 1.0) / (counts + length_norms[rows]) + delta)
+        matrix = sparse.csr_matrix(
+            (data, indices.copy(), indptr.copy()),
+            shape=(self.num_docs, len(self.terms))
+        )
+        self._bm25 = (key, matrix)
+        return matrix
+    
+    def search_bm25(self,
+                    query_counts: Dict[str, int],
+                    stats: Dict,
+                    delta: float,
+                    max_score: float,
+                    k: int,
+                    rows=None,
+                    score_threshold: float = 0.0) -> List[Tuple[int, float]]:
+        """BM25スコア（max_scoreで正規化）の上位k件の(doc_id, スコア)を返す
+        
+        rowsを指定した場合はその行（昇順の文書番号）だけのスコアを計算する
+        """
+        if k <= 0 or max_score <= 0 or (rows is not None and len(rows) == 0):
+            return []
+        
+        query = np.zeros(len(self.terms), dtype=np.float64)
+        for token, count in query_counts.items():
+            col = self.term_to_col.get(token)
+            if col is not None:
+                query[col] = count
+        
+        scores = (self._rows(self._bm25_matrix(stats, delta), rows) @ query) / max_score
+        return self._top_k(scores, k, rows, score_threshold)
+    
+    def _query_matrix(self, queries: List[Dict[str, float]], scales=None):
+        """クエリごとの{トークン: 重み}を行とする疎行列（scalesで行ごとに倍率を掛ける）"""
+        rows, cols, data = [], [], []
+        for row, query in enumerate(queries):
+            scale = 1.0 if scales is None else scales[row]
+            for token, weight in query.items():
+                col = self.term_to_col.get(token)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+                    data.append(weight * scale)
+        return sparse.csr_matrix((data, (rows, cols)), shape=(len(queries), len(self.terms)))
+    
+    def _top_k_many(self,
+                    matrix,
+                    queries,
+                    k: int,
+                    row_sets: Optional[List] = None,
+                    score_threshold: float = 0.0,
+                    block_size: int = 32,
+                    divisors: Optional[List[float]] = None) -> List[List[Tuple[int, float]]]:
+        """文書行列×クエリ行列をblock_size件ずつ計算し、クエリごとに上位k件を選択
+        
+        1ブロックの密なスコア行列は 文書数×block_size のため、ブロック単位でメモリを抑える。
+        row_setsはクエリごとの対象行（Noneで全件）で、同じ対象行のクエリをまとめて
+        その行だけの部分行列で計算する。divisorsを指定した場合はクエリごとのスコアをその値で割る
+        """
+        results = [[] for _ in range(queries.shape[0])]
+        groups = {}  # 対象行 -> (対象行, クエリ番号のリスト)
+        for query_id in range(queries.shape[0]):
+            rows = row_sets[query_id] if row_sets is not None else None
+            if rows is not None and len(rows) == 0:
+                continue
+            if divisors is not None and divisors[query_id] <= 0:
+                continue
+            groups.setdefault(id(rows), (rows, []))[1].append(query_id)
+        
+        for rows, query_ids in groups.values():
+            group_matrix = self._rows(matrix, rows)
+            for start in range(0, len(query_ids), block_size):
+                block = query_ids[start:start + block_size]
+                scores = (group_matrix @ queries[block].T).toarray()
+                for offset, query_id in enumerate(block):
+                    column = scores[:, offset]
+                    if divisors is not None:
+                        column = column / divisors[query_id]
+                    results[query_id] = self._top_k(column, k, rows, score_threshold)
+        return results
+    
+    def search_many(self,
+                    query_vectors: List[Dict[str, float]],
+                    k: int,
+                    row_sets: Optional[List] = None,
+                    score_threshold: float = 0.0,
+                    block_size: int = 32) -> List[List[Tuple[int, float]]]:
+        """複数クエリのコサイン類似度上位k件（クエリごとの行列×ベクトルを疎行列積にまとめる）"""
+        if self.matrix is None or k <= 0:
+            return [[] for _ in query_vectors]
+        
+        scales = []
+        for query_vector in query_vectors:
+            query_norm = math.sqrt(sum(
+                weight * weight for token, weight in query_vector.items() if token in self.term_to_col
+            ))
+            scales.append(1.0 / query_norm if query_norm else 0.0)
+        queries = self._query_matrix(query_vectors, scales)
+        return self._top_k_many(self.matrix, queries, k, row_sets, score_threshold, block_size)
+    
+    def search_bm25_many(self,
+                         query_counts: List[Dict[str, int]],
+                         stats: Dict,
+                         delta: float,
+                         max_scores: List[float],
+                         k: int,
+                         row_sets: Optional[List] = None,
+                         score_threshold: float = 0.0,
+                         block_size: int = 32) -> List[List[Tuple[int, float]]]:
+        """複数クエリのBM25上位k件（search_bm25の一括版、スコアはクエリごとのmax_scoreで正規化）"""
+        if k <= 0:
+            return [[] for _ in query_counts]
+        
+        queries = self._query_matrix(query_counts)
+        return self._top_k_many(
+            self._bm25_matrix(stats, delta), queries, k, row_sets, score_threshold, block_size, divisors=max_scores
+        )
+    
+    def term_counts(self) -> SparseTermCounts:
+        """トークン出現数の辞書ビュー"""
+        return SparseTermCounts(self)
+    
+    def search(self,
+               query_vector: Dict[str, float],
+               k: int,
+               rows=None,
+               score_threshold: float = 0.0) -> List[Tuple[int, float]]:
+        """クエリとのコサイン類似度で上位k件の(doc_id, 類似度)を返す
+        
+        rowsを指定した場合はその行（昇順の文書番号）だけのスコアを計算する
+        """
+        if self.matrix is None or k <= 0 or (rows is not None and len(rows) == 0):
+            return []
+        
+        query = np.zeros(len(self.terms), dtype=np.float64)
+        for token, weight in query_vector.items():
+            col = self.term_to_col.get(token)
+            if col is not None:
+                query[col] = weight
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            return []
+        
+        # 疎行列×ベクトル1回でスコアを計算
+        scores = self._rows(self.matrix, rows) @ (query / query_norm)
+        return self._top_k(scores, k, rows, score_threshold)
+    
+    def _rows(self, matrix, rows):
+        """対象行だけの部分行列（rowsがNoneなら行列全体）"""
+        return matrix if rows is None else matrix[rows]
+    
+    def _top_k(self, scores, k: int, rows, score_threshold: float) -> List[Tuple[int, float]]:
+        """スコア配列から上位k件を選択（argpartition + 同点は登録順）
+        
+        rowsを指定した場合、scoresはその行の部分行列のスコアで、結果は元の文書番号に戻す
+        """
+        candidates = np.flatnonzero((scores >= score_threshold) & (scores > 0))
+        if len(candidates) > k:
+            # k番目と同点の候補は全て残す（argpartitionは同点のどれを選ぶか不定のため）
+            kth_score = -np.partition(-scores[candidates], k - 1)[k - 1]
+            candidates = candidates[scores[candidates] >= kth_score]
+        
+        # 類似度の降順、同点は登録順
+        order = np.lexsort((candidates, -scores[candidates]))[:k]
+        candidates = candidates[order]
+        doc_ids = candidates if rows is None else np.asarray(rows)[candidates]
+        return [(int(doc_id), float(scores[position])) for doc_id, position in zip(doc_ids, candidates)]
@@ -0,0 +1,93 @@
+"""
+SimpleVectorDatabase用のトークナイザー
+英数字の単語と日本語の2-gramを1回の走査で生成する（正規表現は事前コンパイル）
+"""
+import re
+import logging
+from typing import Iterable, List, Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class TokenTable:
+    """トークンとIDの対応表（同じトークン文字列を1つのオブジェクトに集約する）"""
+    
+    def __init__(self, tokens: Optional[Iterable[str]] = None):
+        self.token_to_id = {}
+        self.tokens = []
+        for token in tokens or ():
+            self.id(token)
+    
+    def __len__(self) -> int:
+        return len(self.tokens)
+    
+    def id(self, token: str) -> int:
+        """トークンのIDを返す（未登録なら追加）"""
+        token_id = self.token_to_id.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.token_to_id[token] = token_id
+            self.tokens.append(token)
+        return token_id
+    
+    def ids(self, tokens: Iterable[str]) -> List[int]:
+        return [self.id(token) for token in tokens]
+    
+    def intern(self, token: str) -> str:
+        """登録済みの同じ文字列オブジェクトを返す"""
+        return self.tokens[self.id(token)]
+    
+    def token(self, token_id: int) -> str:
+        return self.tokens[token_id]
+
+class BigramTokenizer:
+    """英数字は単語単位（3文字以上）、それ以外の日本語を含む語は文字2-gramに分割
+    
+    記号を空白に置換してから空白で分割する従来の処理と同じトークン列を返す
+    """
+    
+    name = "simple-bigram"
+    version = 1
+    
+    # 英数字・ひらがな・カタカナ・漢字の連続（従来の「記号を空白に置換して分割」した単語に一致）
+    WORD_PATTERN = re.compile(r'[a-zA-Z0-9\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FAF]+')
+    MIN_ASCII_LENGTH = 3
+    
+    @property
+    def signature(self) -> str:
+        """インデックスに記録する識別子（名前とバージョン）"""
+        return f"{self.name}:{self.version}"
+    
+    def tokenize(self, text: str) -> List[str]:
+        """テキストをトークン化"""
+        tokens = []
+        min_length = self.MIN_ASCII_LENGTH
+        for word in self.WORD_PATTERN.findall(text.lower()):
+            if word.isascii():
+                # 英数字の場合はそのまま（短すぎる単語は除外）
+                if len(word) >= min_length:
+                    tokens.append(word)
+            else:
+                # 日本語を含む場合は2-gramで分割
+                tokens.extend([word[i:i + 2] for i in range(len(word) - 1)])
+        return tokens
+    
+    def tokenize_ids(self, text: str, table: TokenTable) -> List[int]:
+        """テキストをトークンIDの列に変換"""
+        return table.ids(self.tokenize(text))
+
+# 利用可能なトークナイザー（名前 -> クラス）
+TOKENIZERS = {
+    BigramTokenizer.name: BigramTokenizer,
+}
+
+# 記録のない旧インデックスを作成したトークナイザー
+LEGACY_TOKENIZER_SIGNATURE = "simple-bigram:1"
+
+def get_tokenizer(name: str = None):
+    """名前からトークナイザーを作成（不明な名前は既定のトークナイザーにフォールバック）"""
+    tokenizer_class = TOKENIZERS.get(name or BigramTokenizer.name)
+    if tokenizer_class is None:
+        logger.warning(f"Unknown tokenizer: {name}. Falling back to {BigramTokenizer.name}")
+        tokenizer_class = BigramTokenizer
+    return tokenizer_class()
@@ -1,18 +1,15 @@
 """
 ベクトルデータベース管理クラス（オフライン版）
 OpenAI API不要でsentence-transformersを使用
+
+chromadb・langchain・sentence-transformersの読み込みは初回利用時まで遅らせる
+（統計・コレクション一覧ではモデルを読み込まず、埋め込みモデルは最初の埋め込み計算時に読み込む）
 """
 import os
 import logging
-from typing import List, Dict, Optional, Tuple
-import chromadb
-from chromadb.config import Settings
-from langchain.schema import Document
-from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-
-# HuggingFace Embeddings (オフライン)
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import threading
+import importlib.util
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
 
 import os
 import sys
@@ -20,56 +17,156 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from config import Config
 
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# オフライン検索に必要なパッケージ（import せずに有無だけを確認する）
+REQUIRED_PACKAGES = ["chromadb", "sentence_transformers", "langchain_community"]
+
+def offline_dependencies_available() -> bool:
+    """オフライン版の依存パッケージがインストールされているか"""
+    return all(importlib.util.find_spec(name) is not None for name in REQUIRED_PACKAGES)
+
+def create_offline_embeddings(persist_directory: str):
+    """sentence-transformersの埋め込みモデルを作成（埋め込みキャッシュ付き）"""
+    try:
+        # HuggingFace Embeddings (オフライン)
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        from models.embedding_cache import EmbeddingCache, CachedEmbeddings
+        
+        if Config.EMBEDDING_THREADS > 0:
+            try:
+                import torch
+                torch.set_num_threads(Config.EMBEDDING_THREADS)
+            except ImportError:
+                pass
+        
+        # 軽量なHugging Face モデルを使用
+        model_name = Config.OFFLINE_EMBEDDING_MODEL
+        encoder = HuggingFaceEmbeddings(
+            model_name=model_name,  # 軽量で高性能
+            model_kwargs={'device': 'cpu'},
+            encode_kwargs={'normalize_embeddings': True, 'batch_size': Config.EMBEDDING_BATCH_SIZE}
+        )
+        
+        # 本文ハッシュ単位でキャッシュし、再取り込み時は変更されたチャンクだけをエンコード
+        cache = None
+        if Config.EMBEDDING_CACHE_ENABLED:
+            cache = EmbeddingCache(os.path.join(persist_directory, Config.EMBEDDING_CACHE_FILE))
+        logger.info(f"Offline embedding model initialized: {model_name}")
+        return CachedEmbeddings(encoder, model_name, cache)
+    except Exception as e:
+        logger.error(f"Failed to initialize embedding model: {e}")
+        raise
+
+class LazyEmbeddings:
+    """最初の埋め込み計算時にモデルを読み込む埋め込み関数（Chromaにはこれを渡す）"""
+    
+    def __init__(self, loader):
+        self._loader = loader
+        self._model = None
+        self._lock = threading.Lock()
+    
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+    
+    def load(self):
+        """モデルを読み込む（複数スレッドから呼ばれても1回だけ）"""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._loader()
+        return self._model
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.load().embed_documents(texts)
+    
+    def embed_query(self, text: str) -> List[float]:
+        return self.load().embed_query(text)
+
 class OfflineVectorDatabase:
     """ベクトルデータベース管理クラス（オフライン版）"""
     
-    def __init__(self, persist_directory: str = None):
+    def __init__(self, persist_directory: str = None, warm_up: bool = None):
         self.persist_directory = persist_directory or Config.VECTOR_DB_PATH
-        self.embedding_model = None
-        self.vector_store = None
-        self.client = None
-        self._initialize_embedding_model()
-        self._initialize_vector_store()
+        self.embedding_cache = None
+        self.embedding_model = LazyEmbeddings(self._load_embedding_model)
+        self._client = None
+        self._vector_store = None
+        self._store_lock = threading.Lock()
+        
+        if Config.OFFLINE_EMBEDDING_WARMUP if warm_up is None else warm_up:
+            self.warm_up()
     
-    def _initialize_embedding_model(self):
+    def warm_up(self, background: bool = True):
+        """埋め込みモデルとベクトルストアを事前に読み込む（既定はバックグラウンドスレッド）"""
+        def load():
+            try:
+                self.embedding_model.load()
+                self.vector_store
+                logger.info("Offline embedding model warmed up")
+            except Exception as e:
+                logger.error(f"Warm-up failed: {e}")
+        
+        if not background:
+            load()
+            return None
+        thread = threading.Thread(target=load, name="offline-embedding-warmup", daemon=True)
+        thread.start()
+        return thread
+    
+    def _load_embedding_model(self):
         """軽量な埋め込みモデルの初期化"""
-        try:
-            # 軽量なHugging Face モデルを使用
-            self.embedding_model = HuggingFaceEmbeddings(
-                model_name="all-MiniLM-L6-v2",  # 軽量で高性能
-                model_kwargs={'device': 'cpu'},
-                encode_kwargs={'normalize_embeddings': True}
-            )
-            logger.info(f"Offline embedding model initialized: all-MiniLM-L6-v2")
-        except Exception as e:
-            logger.error(f"Failed to initialize embedding model: {e}")
-            raise
+        model = create_offline_embeddings(self.persist_directory)
+        self.embedding_cache = model.cache
+        return model
+    
+    @property
+    def client(self):
+        """ChromaDBクライアント（初回参照時に作成）"""
+        if self._client is None:
+            with self._store_lock:
+                if self._client is None:
+                    import chromadb
+                    
+                    # ディレクトリが存在しない場合は作成
+                    os.makedirs(self.persist_directory, exist_ok=True)
+                    self._client = chromadb.PersistentClient(path=self.persist_directory)
+        return self._client
+    
+    @property
+    def vector_store(self):
+        """ベクトルストア（初回参照時に作成。埋め込みモデルはまだ読み込まない）"""
+        if self._vector_store is None:
+            client = self.client
+            with self._store_lock:
+                if self._vector_store is None:
+                    self._vector_store = self._initialize_vector_store(client)
+        return self._vector_store
     
-    def _initialize_vector_store(self):
+    def _initialize_vector_store(self, client):
         """ベクトルストアの初期化"""
         try:
-            # ディレクトリが存在しない場合は作成
-            os.makedirs(self.persist_directory, exist_ok=True)
-            
-            # ChromaDBクライアントの初期化
-            self.client = chromadb.PersistentClient(path=self.persist_directory)
+            from langchain_community.vectorstores import Chroma
             
             # Langchain Chromaの初期化
-            self.vector_store = Chroma(
+            vector_store = Chroma(
                 persist_directory=self.persist_directory,
                 embedding_function=self.embedding_model,
-                client=self.client
+                client=client
             )
             
             logger.info(f"Vector store initialized at: {self.persist_directory}")
+            return vector_store
         except Exception as e:
             logger.error(f"Failed to initialize vector store: {e}")
             raise
     
-    def add_documents(self, documents: List[Document], microcontroller: str = "NUCLEO-F767ZI") -> bool:
+    def add_documents(self, documents: List["Document"], microcontroller: str = "NUCLEO-F767ZI") -> bool:
         """ドキュメントをベクトルデータベースに追加"""
         try:
             if not documents:
@@ -92,17 +189,43 @@ class OfflineVectorDatabase:
             
             logger.info(f"Added {len(documents)} documents for {microcontroller}")
             return True
-            
+        
         except Exception as e:
             logger.error(f"Failed to add documents: {e}")
             return False
     
+    def list_sources(self) -> set:
+        """登録済みのソースファイル一覧"""
+        try:
+            metadatas = self.vector_store.get(include=["metadatas"])["metadatas"]
+            return {metadata.get("source") for metadata in metadatas if metadata and metadata.get("source")}
+        except Exception as e:
+            logger.error(f"Failed to list sources: {e}")
+            return set()
+    
+    def delete_documents_by_source(self, sources: List[str], save: bool = True) -> int:
+        """指定したソースファイルのチャンクを削除し、削除件数を返す
+        
+        埋め込みキャッシュは残すため、内容の変わらないチャンクは再登録時にエンコードされない
+        """
+        try:
+            ids = self.vector_store.get(where={"source": {"$in": list(sources)}}, include=[])["ids"]
+            if ids:
+                self.vector_store.delete(ids=ids)
+                if save:
+                    self.vector_store.persist()
+            logger.info(f"Deleted {len(ids)} chunks from {len(sources)} sources")
+            return len(ids)
+        except Exception as e:
+            logger.error(f"Failed to delete documents: {e}")
+            return 0
+    
     def search_similar_documents(self, 
                                query: str, 
                                k: int = 5, 
                                microcontroller: str = None,
                                category: str = None,
-                               score_threshold: float = 0.7) -> List[Tuple[Document, float]]:
+                               score_threshold: float = 0.7) -> List[Tuple["Document", float]]:
         """類似ドキュメントを検索"""
         try:
             # フィルター条件の構築
@@ -133,7 +256,7 @@ class OfflineVectorDatabase:
             
             logger.info(f"Found {len(filtered_results)} relevant documents for query: {query[:50]}...")
             return filtered_results
-            
+        
         except Exception as e:
             logger.error(f"Search failed: {e}")
             return []
@@ -141,7 +264,7 @@ class OfflineVectorDatabase:
     def get_relevant_documents(self, 
                              query: str, 
                              k: int = 5,
-                             microcontroller: str = None) -> List[Document]:
+                             microcontroller: str = None) -> List["Document"]:
         """関連ドキュメントを取得（スコアなし）"""
         results = self.search_similar_documents(query, k, microcontroller)
         return [doc for doc, score in results]
@@ -178,7 +301,7 @@ class OfflineVectorDatabase:
                     logger.warning(f"Could not get stats for {collection_name}: {e}")
             
             return stats
-            
+        
         except Exception as e:
             logger.error(f"Failed to get collection stats: {e}")
             return {}
\ No newline at end of file
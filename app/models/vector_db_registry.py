@@ -0,0 +1,92 @@
+"""
+プロセス内で共有するベクトルデータベース・RAGエンジンのレジストリ
+Streamlitの再実行やセッションごとにインデックスを読み直さず、1プロセス1インスタンスで共有する
+"""
+import threading
+import logging
+from typing import Callable, Dict, Optional
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from models.simple_vector_db import SimpleVectorDatabase
+from models.simple_rag_engine import SimpleRAGEngine
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class SharedIndexRegistry:
+    """永続化ディレクトリごとにSimpleVectorDatabaseとSimpleRAGEngineを1つだけ保持"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vector_dbs = {}  # persist_directory -> SimpleVectorDatabase
+        self._rag_engines = {}  # persist_directory -> SimpleRAGEngine
+        self._task_lock = threading.Lock()  # 初期化タスク（ブートストラップ・同期）の実行中は他のセッションを待たせる
+        self._completed_tasks = set()  # (persist_directory, タスク名)
+    
+    def _key(self, persist_directory: Optional[str]) -> str:
+        return os.path.abspath(persist_directory or Config.get_vector_db_path())
+    
+    def get_vector_db(self, persist_directory: str = None) -> SimpleVectorDatabase:
+        """共有インスタンスを取得（ディスク上のインデックスが更新されていれば新しいスナップショットに差し替え）"""
+        key = self._key(persist_directory)
+        
+        with self._lock:
+            vector_db = self._vector_dbs.get(key)
+            if vector_db is None:
+                vector_db = SimpleVectorDatabase(key)
+                self._vector_dbs[key] = vector_db
+                logger.info(f"Loaded shared vector database: {key}")
+            elif vector_db.has_external_changes():
+                # 読み込み済みのインスタンスを使用中のセッションはそのまま旧スナップショットを参照できる
+                vector_db = SimpleVectorDatabase(key)
+                self._vector_dbs[key] = vector_db
+                engine = self._rag_engines.get(key)
+                if engine is not None:
+                    engine.vector_db = vector_db
+                logger.info(f"Swapped in new index snapshot: {key}")
+            
+            return vector_db
+    
+    def get_rag_engine(self, persist_directory: str = None) -> SimpleRAGEngine:
+        """共有RAGエンジンを取得（OpenAIクライアントもプロセス内で1つ）"""
+        vector_db = self.get_vector_db(persist_directory)
+        key = self._key(persist_directory)
+        
+        with self._lock:
+            engine = self._rag_engines.get(key)
+            if engine is None:
+                engine = SimpleRAGEngine(vector_db)
+                self._rag_engines[key] = engine
+            return engine
+    
+    def run_once(self, task: str, func: Callable[[], None], persist_directory: str = None) -> bool:
+        """永続化ディレクトリごとに1プロセスで1回だけfuncを実行し、実行した場合はTrueを返す
+        
+        同時に呼ばれた場合は実行中のタスクの完了を待つ。funcが例外を送出した場合は未完了のまま（次回再実行）
+        """
+        key = (self._key(persist_directory), task)
+        if key in self._completed_tasks:
+            return False
+        
+        with self._task_lock:
+            if key in self._completed_tasks:
+                return False
+            func()
+            self._completed_tasks.add(key)
+            logger.info(f"Completed {task} for {key[0]}")
+            return True
+    
+    def stats(self) -> Dict:
+        """保持しているインスタンスの概要"""
+        with self._lock:
+            return {
+                key: {"documents": len(vector_db.documents), "has_engine": key in self._rag_engines}
+                for key, vector_db in self._vector_dbs.items()
+            }
+
+# プロセス全体で共有するレジストリ
+shared_index_registry = SharedIndexRegistry()
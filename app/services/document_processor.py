@@ -4,8 +4,14 @@ PDFやテキストファイルからテキストを抽出し、チャンク化
 """
 import os
 import re
+import bisect
+import signal
 import logging
-from typing import List, Dict, Optional
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 from pathlib import Path
 
 import PyPDF2
@@ -22,10 +28,160 @@ from config import Config
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# テキストクリーニング用の正規表現（ワーカープロセスでも共有）
+_NEWLINE_PATTERN = re.compile(r'\r\n|\r')
+_SPACES_PATTERN = re.compile(r' +')
+_BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+_INVALID_CHARS_PATTERN = re.compile(r'[^\w\s\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FAF\u3400-\u4DBF\u002D\u002E\u0028\u0029\u003A\u003B\u002C\u0021\u003F\u300C\u300D\u3001\u3002\u30FB\u002F\u005C\u0040\u0023\u0024\u0025\u005E\u0026\u002A\u002B\u003D\u007B\u007D\u005B\u005D\u007C\u003C\u003E\u007E\u0060\u0027\u0022]')
+
+class PageTimeoutError(Exception):
+    """1ページの抽出が制限時間を超えた"""
+
+def clean_text(text: str) -> str:
+    """テキストのクリーニング"""
+    if not text:
+        return ""
+    
+    # 改行の正規化
+    text = _NEWLINE_PATTERN.sub('\n', text)
+    
+    # 余分な空白の削除
+    text = _SPACES_PATTERN.sub(' ', text)
+    
+    # 余分な改行の削除（3つ以上の連続改行を2つに）
+    text = _BLANK_LINES_PATTERN.sub('\n\n', text)
+    
+    # 文字化けの可能性がある文字の除去
+    text = _INVALID_CHARS_PATTERN.sub(' ', text)
+    
+    return text.strip()
+
+def _raise_page_timeout(signum, frame):
+    raise PageTimeoutError("page extraction timed out")
+
+def count_pdf_pages(pdf_path: str) -> int:
+    """PDFのページ数を取得（本文は読み込まない）"""
+    with open(pdf_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+def iter_pdf_pages(pdf_path: str,
+                   start: int = 0,
+                   end: Optional[int] = None,
+                   page_timeout: float = 0,
+                   engine: str = "pdfplumber") -> Iterator[Tuple[int, str]]:
+    """指定範囲のページを1ページずつ抽出し、(ページ番号, クリーニング済みテキスト)を返す
+    
+    page_timeoutはSIGALRMで実現するため、利用できない環境やメインスレッド以外では無視される
+    （DocumentProcessorはその場合もワーカープロセスのメインスレッドで抽出してタイムアウトを効かせる）。
+    """
+    use_alarm = (page_timeout > 0 and hasattr(signal, "SIGALRM")
+                 and threading.current_thread() is threading.main_thread())
+    previous_handler = signal.signal(signal.SIGALRM, _raise_page_timeout) if use_alarm else None
+    
+    def extract(page_num: int, page) -> str:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, page_timeout)
+        try:
+            return clean_text(page.extract_text() or "")
+        except PageTimeoutError:
+            logger.warning(f"Page {page_num + 1} of {pdf_path} timed out after {page_timeout}s")
+        except Exception as e:
+            logger.warning(f"Page {page_num + 1} processing failed: {e}")
+        finally:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        return ""
+    
+    try:
+        if engine == "pdfplumber":
+            with pdfplumber.open(pdf_path) as pdf:
+                for page_num in range(start, min(end or len(pdf.pages), len(pdf.pages))):
+                    page = pdf.pages[page_num]
+                    page_text = extract(page_num, page)
+                    # レイアウト解析結果のキャッシュを解放してメモリをページ単位に抑える
+                    page.close()
+                    yield page_num, page_text
+        else:
+            with open(pdf_path, 'rb') as file:
+                pdf_reader = PyPDF2.PdfReader(file)
+                for page_num in range(start, min(end or len(pdf_reader.pages), len(pdf_reader.pages))):
+                    yield page_num, extract(page_num, pdf_reader.pages[page_num])
+    finally:
+        if use_alarm:
+            signal.signal(signal.SIGALRM, previous_handler)
+
+def extract_pdf_pages(pdf_path: str,
+                      start: int,
+                      end: Optional[int],
+                      page_timeout: float = 0,
+                      engine: str = "pdfplumber") -> List[Tuple[int, str]]:
+    """指定範囲のページをまとめて抽出（プロセスプールのワーカー用）
+    
+    ワーカープロセスではタスクがメインスレッドで実行されるため、page_timeoutが有効
+    """
+    return list(iter_pdf_pages(pdf_path, start, end, page_timeout, engine))
+
+def iter_pdf_pages_with_fallback(pdf_path: str, page_timeout: float = 0) -> Iterator[Tuple[int, str]]:
+    """pdfplumberでページを返し、1ページもテキストが取れなければPyPDF2で再抽出"""
+    has_text = False
+    for page_num, page_text in iter_pdf_pages(pdf_path, page_timeout=page_timeout):
+        has_text = has_text or bool(page_text)
+        yield page_num, page_text
+    
+    if not has_text:
+        yield from iter_pdf_pages(pdf_path, page_timeout=page_timeout, engine="pypdf2")
+
+# チャンク化の際のページ間の区切り（ページ番号はメタデータに持たせる）
+PAGE_SEPARATOR = "\n"
+
+def join_pages(pages: Iterable[Tuple[Optional[int], str]]) -> str:
+    """ページ区切りを付けて連結"""
+    return "".join(page_marker(page_num) + page_text for page_num, page_text in pages if page_text).strip()
+
+def page_marker(page_num: Optional[int]) -> str:
+    """ページ区切り（テキストファイルなどページのない入力では空）"""
+    return f"\n--- Page {page_num + 1} ---\n" if page_num is not None else ""
+
+class PageRangeScheduler:
+    """ページ範囲タスクを先頭から順に、先読み数を制限してプロセスプールへ投入する
+    
+    結果は投入順に取り出すため、並列抽出でもページ順を保ったまま逐次処理できる
+    """
+    
+    def __init__(self, executor: ProcessPoolExecutor, tasks: List[Tuple[str, int, Optional[int]]],
+                 page_timeout: float, max_pending: int):
+        self.executor = executor
+        self.tasks = tasks  # (パス, 開始ページ, 終了ページ)
+        self.page_timeout = page_timeout
+        self.max_pending = max(1, max_pending)
+        self._pending = deque()  # (タスク番号, Future)
+        self._next_task = 0
+    
+    def _fill(self, first: int):
+        # 読み飛ばされたタスクは投入しない
+        self._next_task = max(self._next_task, first)
+        while self._next_task < len(self.tasks) and len(self._pending) < self.max_pending:
+            path, start, end = self.tasks[self._next_task]
+            future = self.executor.submit(extract_pdf_pages, path, start, end, self.page_timeout)
+            self._pending.append((self._next_task, future))
+            self._next_task += 1
+    
+    def results(self, first: int, last: int) -> Iterator[Tuple[int, str]]:
+        """タスク番号first〜last-1の抽出結果をページ順に返す"""
+        for task_id in range(first, last):
+            self._fill(task_id)
+            while self._pending and self._pending[0][0] < task_id:
+                self._pending.popleft()[1].cancel()
+            _, future = self._pending.popleft()
+            yield from future.result()
+
 class DocumentProcessor:
     """ドキュメント処理クラス"""
     
-    def __init__(self):
+    def __init__(self, workers: int = None, page_timeout: float = None):
+        # ワーカー数が1以下なら従来どおり逐次処理
+        self.workers = workers if workers is not None else (Config.PDF_EXTRACTION_WORKERS or os.cpu_count() or 1)
+        self.page_timeout = page_timeout if page_timeout is not None else Config.PDF_PAGE_TIMEOUT
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=Config.CHUNK_SIZE,
             chunk_overlap=Config.CHUNK_OVERLAP,
@@ -36,38 +192,169 @@ class DocumentProcessor:
     def extract_text_from_pdf(self, pdf_path: str) -> str:
         """PDFからテキストを抽出"""
         try:
-            text = ""
-            
-            # pdfplumberを使用（表やレイアウトを考慮）
-            with pdfplumber.open(pdf_path) as pdf:
-                for page_num, page in enumerate(pdf.pages):
-                    try:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += f"\n--- Page {page_num + 1} ---\n"
-                            text += page_text
-                    except Exception as e:
-                        logger.warning(f"Page {page_num + 1} processing failed: {e}")
-                        
-            # フォールバック: PyPDF2を使用
-            if not text.strip():
-                with open(pdf_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    for page_num, page in enumerate(pdf_reader.pages):
-                        try:
-                            page_text = page.extract_text()
-                            if page_text:
-                                text += f"\n--- Page {page_num + 1} ---\n"
-                                text += page_text
-                        except Exception as e:
-                            logger.warning(f"Page {page_num + 1} processing failed: {e}")
-            
-            return self._clean_text(text)
-            
+            # pdfplumberを使用（表やレイアウトを考慮）、テキストが取れなければPyPDF2
+            return join_pages(iter_pdf_pages_with_fallback(pdf_path, self.page_timeout))
+        
         except Exception as e:
             logger.error(f"PDF processing failed for {pdf_path}: {e}")
             return ""
     
+    def iter_file_pages(self, file_paths: List[str]) -> Iterator[Tuple[str, Iterator[Tuple[Optional[int], str]]]]:
+        """ファイルごとに(パス, ページのイテレータ)を入力順に返す
+        
+        PDFはワーカー数が2以上ならファイル・ページ範囲単位でプロセスプールに分散する。
+        ページのイテレータは次のファイルに進む前に読み切ること
+        """
+        pdf_paths = [path for path in file_paths if Path(path).suffix.lower() == '.pdf']
+        executor = None
+        if pdf_paths and (self.workers > 1 or self._needs_worker_timeout()):
+            try:
+                executor = self._create_executor()
+            except Exception as e:
+                logger.warning(f"Parallel PDF extraction unavailable, falling back to serial mode: {e}")
+        
+        if executor is None:
+            for file_path in file_paths:
+                yield file_path, self._iter_pages(file_path)
+            return
+        
+        with executor:
+            ranges = self._plan_page_ranges(executor, pdf_paths)
+            tasks = [task for path in pdf_paths for task in ranges[path]]
+            # 先読みはワーカー数の2倍まで（抽出済みページが溜まりすぎないようにする）
+            scheduler = PageRangeScheduler(executor, tasks, self.page_timeout, self.workers * 2)
+            logger.info(f"Extracting {len(pdf_paths)} PDFs with {max(1, self.workers)} worker processes")
+            
+            first = 0
+            for file_path in file_paths:
+                if file_path not in ranges:
+                    yield file_path, self._iter_pages(file_path)
+                    continue
+                last = first + len(ranges[file_path])
+                yield file_path, self._iter_parallel_pages(file_path, scheduler, first, last)
+                first = last
+    
+    def _needs_worker_timeout(self) -> bool:
+        """ページのタイムアウトをメインスレッド以外のためこのスレッドで設定できない（ワーカープロセスで抽出する）か"""
+        return (self.page_timeout > 0 and hasattr(signal, "SIGALRM")
+                and threading.current_thread() is not threading.main_thread())
+    
+    def _create_executor(self) -> ProcessPoolExecutor:
+        """PDF抽出用のプロセスプール
+        
+        Streamlitなどスレッドを持つプロセスからforkするとロックを保持したまま複製されるため、
+        Config.PDF_EXTRACTION_START_METHOD（既定はspawn）で起動する。
+        逐次処理の設定でも、タイムアウトが必要な場合は1プロセスで抽出する
+        """
+        return ProcessPoolExecutor(
+            max_workers=max(1, self.workers),
+            mp_context=multiprocessing.get_context(Config.PDF_EXTRACTION_START_METHOD)
+        )
+    
+    def _plan_page_ranges(self, executor: ProcessPoolExecutor, pdf_paths: List[str]) -> Dict[str, List[Tuple]]:
+        """ページ数を並列に取得してページ範囲タスクに分割"""
+        pages_per_task = max(1, Config.PDF_PAGES_PER_TASK)
+        page_counts = {path: executor.submit(count_pdf_pages, path) for path in pdf_paths}
+        
+        ranges = {}
+        for path, future in page_counts.items():
+            try:
+                num_pages = future.result()
+                ranges[path] = [(path, start, min(start + pages_per_task, num_pages))
+                                for start in range(0, num_pages, pages_per_task)]
+            except Exception as e:
+                # ページ数が取れない場合はファイル全体を1タスクとして処理
+                logger.warning(f"Failed to read page count of {path}: {e}")
+                ranges[path] = [(path, 0, None)]
+        return ranges
+    
+    def _iter_parallel_pages(self, pdf_path: str, scheduler: PageRangeScheduler,
+                             first: int, last: int) -> Iterator[Tuple[int, str]]:
+        has_text = False
+        next_page = 0
+        try:
+            for page_num, page_text in scheduler.results(first, last):
+                has_text = has_text or bool(page_text)
+                next_page = page_num + 1
+                yield page_num, page_text
+        except Exception as e:
+            # ワーカーが落ちた場合などは残りのページをこのプロセスで抽出
+            logger.warning(f"Parallel extraction failed for {pdf_path}, continuing serially: {e}")
+            for page_num, page_text in iter_pdf_pages(pdf_path, next_page, page_timeout=self.page_timeout):
+                has_text = has_text or bool(page_text)
+                yield page_num, page_text
+        
+        if not has_text:
+            yield from iter_pdf_pages(pdf_path, page_timeout=self.page_timeout, engine="pypdf2")
+    
+    def _iter_pages(self, file_path: str) -> Iterator[Tuple[Optional[int], str]]:
+        """1ファイル分のページを逐次抽出（PDF以外はファイル全体を1ページとして返す）"""
+        if Path(file_path).suffix.lower() == '.pdf':
+            try:
+                yield from iter_pdf_pages_with_fallback(file_path, self.page_timeout)
+            except Exception as e:
+                logger.error(f"PDF processing failed for {file_path}: {e}")
+        else:
+            yield None, self.extract_text_from_file(file_path)
+    
+    def iter_chunks(self, pages: Iterable[Tuple[Optional[int], str]]) -> Iterator[Tuple[str, Optional[int], Optional[int]]]:
+        """ページを順に受け取り、(チャンク, 開始ページ, 終了ページ)を返す（ページ番号は1始まり）
+        
+        ページ区切りは本文に含めず、バッファ内の各ページの開始位置から範囲を求める。
+        作業バッファはCHUNK_SIZE×CHUNK_STREAM_WINDOW程度に保たれ、文書全体を保持しない。
+        バッファを分割したら最後のチャンク（後続ページと続く可能性がある）の先頭から持ち越す
+        """
+        window = Config.CHUNK_SIZE * max(2, Config.CHUNK_STREAM_WINDOW)
+        buffer = ""
+        offsets, page_nums = [], []  # バッファ内のページ開始位置とページ番号
+        
+        def split_buffer():
+            # 分割結果とバッファ内の開始位置（チャンクは前から順に重なりながら並ぶ）
+            chunks = self.text_splitter.split_text(buffer)
+            positions, cursor = [], 0
+            for chunk in chunks:
+                position = buffer.find(chunk, cursor)
+                if position < 0:
+                    position = cursor
+                positions.append(position)
+                cursor = position + 1
+            return chunks, positions
+        
+        def page_span(position: int, length: int) -> Tuple[Optional[int], Optional[int]]:
+            first = page_nums[bisect.bisect_right(offsets, position) - 1]
+            last = page_nums[bisect.bisect_right(offsets, position + length - 1) - 1]
+            if first is None:
+                return None, None
+            return first + 1, last + 1
+        
+        for page_num, page_text in pages:
+            if not page_text:
+                continue
+            if buffer:
+                buffer += PAGE_SEPARATOR
+            offsets.append(len(buffer))
+            page_nums.append(page_num)
+            buffer += page_text
+            if len(buffer) < window:
+                continue
+            
+            chunks, positions = split_buffer()
+            if len(chunks) < 2:
+                continue
+            for chunk, position in zip(chunks[:-1], positions[:-1]):
+                yield (chunk,) + page_span(position, len(chunk))
+            
+            # 持ち越し分に合わせてページ開始位置をずらす
+            carry = positions[-1]
+            first = bisect.bisect_right(offsets, carry) - 1
+            buffer = buffer[carry:]
+            offsets = [0] + [offset - carry for offset in offsets[first + 1:]]
+            page_nums = page_nums[first:]
+        
+        if buffer.strip():
+            for chunk, position in zip(*split_buffer()):
+                yield (chunk,) + page_span(position, len(chunk))
+    
     def extract_text_from_file(self, file_path: str) -> str:
         """ファイルからテキストを抽出"""
         file_extension = Path(file_path).suffix.lower()
@@ -87,40 +374,20 @@ class DocumentProcessor:
     
     def _clean_text(self, text: str) -> str:
         """テキストのクリーニング"""
-        if not text:
-            return ""
-        
-        # 改行の正規化
-        text = re.sub(r'\r\n|\r', '\n', text)
-        
-        # 余分な空白の削除
-        text = re.sub(r' +', ' ', text)
-        
-        # 余分な改行の削除（3つ以上の連続改行を2つに）
-        text = re.sub(r'\n{3,}', '\n\n', text)
-        
-        # 文字化けの可能性がある文字の除去
-        text = re.sub(r'[^\w\s\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FAF\u3400-\u4DBF\u002D\u002E\u0028\u0029\u003A\u003B\u002C\u0021\u003F\u300C\u300D\u3001\u3002\u30FB\u002F\u005C\u0040\u0023\u0024\u0025\u005E\u0026\u002A\u002B\u003D\u007B\u007D\u005B\u005D\u007C\u003C\u003E\u007E\u0060\u0027\u0022]', ' ', text)
-        
-        return text.strip()
+        return clean_text(text)
     
     def create_documents(self, file_paths: List[str], microcontroller: str = "NUCLEO-F767ZI") -> List[Document]:
-        """ファイルリストからDocumentオブジェクトを作成"""
+        """ファイルリストからDocumentオブジェクトを作成（ページ単位で抽出・チャンク化）"""
         documents = []
         
-        for file_path in file_paths:
+        for file_path, pages in self.iter_file_pages(file_paths):
             try:
-                text = self.extract_text_from_file(file_path)
-                if not text:
-                    continue
-                
                 # ファイル情報をメタデータに追加
                 metadata = {
                     "source": file_path,
                     "filename": os.path.basename(file_path),
                     "microcontroller": microcontroller,
                     "file_type": Path(file_path).suffix.lower(),
-                    "char_count": len(text)
                 }
                 
                 # ファイルタイプ別の追加メタデータ
@@ -137,33 +404,48 @@ class DocumentProcessor:
                 else:
                     metadata["category"] = "general"
                 
-                # テキストをチャンクに分割
-                chunks = self.text_splitter.split_text(text)
+                # 抽出済みの文字数を数えながらページを流す
+                char_count = 0
                 
-                # 各チャンクをDocumentオブジェクトに変換
-                for i, chunk in enumerate(chunks):
+                def counted(pages):
+                    nonlocal char_count
+                    for page_num, page_text in pages:
+                        if page_text:
+                            char_count += len(page_text) + (len(PAGE_SEPARATOR) if char_count else 0)
+                        yield page_num, page_text
+                
+                # ページを順にチャンク化し、各チャンクをDocumentオブジェクトに変換
+                file_documents = []
+                for i, (chunk, page_start, page_end) in enumerate(self.iter_chunks(counted(pages))):
                     if chunk.strip():  # 空でないチャンクのみ追加
                         chunk_metadata = metadata.copy()
                         chunk_metadata.update({
                             "chunk_index": i,
                             "chunk_id": f"{os.path.basename(file_path)}_{i}"
                         })
+                        if page_start is not None:
+                            chunk_metadata.update({"page_start": page_start, "page_end": page_end})
                         
-                        documents.append(Document(
+                        file_documents.append(Document(
                             page_content=chunk,
                             metadata=chunk_metadata
                         ))
                 
-                logger.info(f"Processed {file_path}: {len(chunks)} chunks created")
+                if not file_documents:
+                    continue
+                for doc in file_documents:
+                    doc.metadata["char_count"] = char_count
+                documents.extend(file_documents)
                 
+                logger.info(f"Processed {file_path}: {len(file_documents)} chunks created")
+            
             except Exception as e:
                 logger.error(f"Error processing {file_path}: {e}")
         
         logger.info(f"Total documents created: {len(documents)}")
         return documents
     
-    def process_directory(self, directory_path: str, microcontroller: str = "NUCLEO-F767ZI") -> List[Document]:
-        """ディレクトリ内のサポートされているファイルをすべて処理"""
+    def _find_supported_files(self, directory_path: str) -> List[str]:
         file_paths = []
         
         for root, dirs, files in os.walk(directory_path):
@@ -172,7 +454,16 @@ class DocumentProcessor:
                     file_paths.append(os.path.join(root, file))
         
         logger.info(f"Found {len(file_paths)} supported files in {directory_path}")
-        return self.create_documents(file_paths, microcontroller)
+        return file_paths
+    
+    def process_directory(self, directory_path: str, microcontroller: str = "NUCLEO-F767ZI") -> List[Document]:
+        """ディレクトリ内のサポートされているファイルをすべて処理"""
+        return self.create_documents(self._find_supported_files(directory_path), microcontroller)
+    
+    def sync_directory(self, directory_path: str, vector_db, microcontroller: str = "NUCLEO-F767ZI") -> Dict:
+        """ディレクトリとベクトルストアを差分同期（変更・追加・削除されたファイルのみ反映）"""
+        from services.ingestion_manifest import sync_documents
+        return sync_documents(self._find_supported_files(directory_path), vector_db, self, microcontroller)
     
     def get_document_summary(self, documents: List[Document]) -> Dict:
         """ドキュメントの要約統計を取得"""
@@ -0,0 +1,174 @@
+"""
+インクリメンタル取り込みサービス
+ファイルのハッシュを記録し、変更のあったファイルだけを再抽出・再索引する
+"""
+import os
+import logging
+from datetime import datetime
+from typing import List, Dict, Optional
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from utils.helpers import calculate_file_hash, load_json_file, save_json_file
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class IngestionManifest:
+    """取り込み済みファイルの記録（パス -> ハッシュ・更新時刻・サイズ・チャンク数）"""
+    
+    VERSION = 1
+    
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.files = {}
+        
+        data = load_json_file(manifest_path) if os.path.exists(manifest_path) else None
+        if data and data.get("version") == self.VERSION:
+            self.files = data.get("files", {})
+    
+    def save(self) -> bool:
+        return save_json_file({"version": self.VERSION, "files": self.files}, self.manifest_path)
+    
+    def check(self, file_path: str) -> Dict:
+        """ファイルの状態を判定（"new" / "unchanged" / "modified"）
+        
+        更新時刻とサイズが記録と一致すればハッシュ計算を省略する
+        """
+        stat = os.stat(file_path)
+        entry = self.files.get(file_path)
+        result = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "hash": None}
+        
+        if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            result.update(status="unchanged", hash=entry["hash"])
+            return result
+        
+        result["hash"] = calculate_file_hash(file_path)
+        if entry is None:
+            result["status"] = "new"
+        elif result["hash"] is not None and entry["hash"] == result["hash"]:
+            # touchされただけ（内容は同じ）
+            result["status"] = "unchanged"
+        else:
+            result["status"] = "modified"
+        return result
+    
+    def record(self, file_path: str, state: Dict, num_chunks: int, microcontroller: str):
+        self.files[file_path] = {
+            "hash": state["hash"],
+            "mtime_ns": state["mtime_ns"],
+            "size": state["size"],
+            "chunks": num_chunks,
+            "microcontroller": microcontroller,
+            "indexed_at": datetime.now().isoformat()
+        }
+    
+    def remove(self, file_path: str):
+        self.files.pop(file_path, None)
+
+def sync_documents(file_paths: List[str],
+                   vector_db,
+                   document_processor,
+                   microcontroller: str = "NUCLEO-F767ZI",
+                   manifest_path: Optional[str] = None) -> Dict:
+    """ファイル群とベクトルストアを同期し、処理結果の件数を返す
+    
+    - 未変更のファイル: スキップ（ベクトルストアにチャンクがなければ新規として登録）
+    - 変更されたファイル: 古いチャンクを削除して再登録
+    - 削除されたファイル: チャンクを削除
+    
+    マニフェストは削除と登録の両方が成功した場合のみ保存し、失敗した場合はベクトルストアを
+    ディスク上の状態に読み直す（reloadを持つストアのみ）
+    """
+    manifest = IngestionManifest(
+        manifest_path or os.path.join(vector_db.persist_directory, Config.INGESTION_MANIFEST_FILE)
+    )
+    stats = {"new": 0, "modified": 0, "unchanged": 0, "deleted": 0, "failed": 0, "chunks_added": 0, "chunks_removed": 0}
+    
+    # 1. 変更判定（mtime・サイズ → ハッシュの順）
+    indexed_sources = vector_db.list_sources()
+    changed = {}
+    for file_path in file_paths:
+        try:
+            state = manifest.check(file_path)
+        except OSError as e:
+            logger.warning(f"Cannot stat {file_path}: {e}")
+            stats["failed"] += 1
+            continue
+        
+        if state["status"] == "unchanged" and file_path not in indexed_sources:
+            # マニフェストにはあるがストアにチャンクがない（ストアの作り直し・保存失敗など）
+            logger.info(f"{file_path} is recorded in the manifest but not indexed. Re-indexing")
+            state["status"] = "new"
+        
+        if state["status"] == "unchanged":
+            stats["unchanged"] += 1
+            # touchのみの場合も更新時刻を記録して次回はハッシュ計算を省略
+            entry = manifest.files[file_path]
+            entry["mtime_ns"], entry["size"] = state["mtime_ns"], state["size"]
+        else:
+            changed[file_path] = state
+    
+    deleted = [
+        file_path for file_path, entry in manifest.files.items()
+        if entry.get("microcontroller") == microcontroller and not os.path.exists(file_path)
+    ]
+    
+    # 2. 新規・変更ファイルのみ抽出
+    documents = document_processor.create_documents(list(changed), microcontroller) if changed else []
+    chunk_counts = {}
+    for doc in documents:
+        chunk_counts[doc.metadata["source"]] = chunk_counts.get(doc.metadata["source"], 0) + 1
+    
+    # 3. 古いチャンクを削除（マニフェスト導入前に登録済みの新規ファイル分も含む）
+    stale_sources = [path for path in list(changed) + deleted if path in indexed_sources]
+    if stale_sources:
+        # 続けて追加する場合は保存を1回にまとめる
+        stats["chunks_removed"] = vector_db.delete_documents_by_source(stale_sources, save=not documents)
+        remaining_sources = vector_db.list_sources()
+        if any(path in remaining_sources for path in stale_sources):
+            return _abort_sync(vector_db, stats, changed, "Failed to delete outdated chunks")
+    
+    # 4. 登録
+    if documents and not vector_db.add_documents(documents, microcontroller):
+        return _abort_sync(vector_db, stats, changed, "Failed to add documents")
+    
+    # 5. 削除・登録とも成功した場合のみマニフェストを更新
+    for file_path in deleted:
+        manifest.remove(file_path)
+        stats["deleted"] += 1
+    
+    for file_path, state in changed.items():
+        if file_path in chunk_counts:
+            stats[state["status"]] += 1
+            manifest.record(file_path, state, chunk_counts[file_path], microcontroller)
+        else:
+            # テキストが取れなかったファイルは次回も再試行する
+            stats["failed"] += 1
+            manifest.remove(file_path)
+    stats["chunks_added"] = len(documents)
+    
+    manifest.save()
+    logger.info(
+        f"Ingestion sync: {stats['new']} new, {stats['modified']} modified, "
+        f"{stats['unchanged']} unchanged, {stats['deleted']} deleted, {stats['failed']} failed"
+    )
+    return stats
+
+def _abort_sync(vector_db, stats: Dict, changed: Dict, message: str) -> Dict:
+    """マニフェストを保存せずに同期を中断し、ベクトルストアの未保存の変更を破棄"""
+    logger.error(f"{message}. Ingestion manifest is not updated")
+    reload = getattr(vector_db, "reload", None)
+    if reload is not None:
+        try:
+            reload()
+        except Exception as e:
+            logger.error(f"Failed to reload vector database after sync failure: {e}")
+    else:
+        logger.warning("Vector database cannot be reloaded. Unsaved deletions may remain in memory")
+    stats["failed"] += len(changed)
+    stats["chunks_removed"] = 0
+    return stats
@@ -0,0 +1,44 @@
+"""
+OpenAI Batch API用の入力ファイルに、関連ドキュメントのない質問のリクエストを含めないことの確認
+"""
+import io
+import os
+import sys
+import json
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.schema import Document
+
+from config import Config
+from models.simple_vector_db import SimpleVectorDatabase
+from models.simple_rag_engine import SimpleRAGEngine
+from batch_answer import write_openai_batch
+
+TEXTS = [
+    "GPIOの出力設定でLEDを点灯させる",
+    "UARTで文字列を送信する方法",
+    "ADCでアナログ電圧を読み取る",
+]
+
+def test_openai_batch_skips_questions_without_documents(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "ANSWER_CACHE_PERSIST", False)
+    db = SimpleVectorDatabase(str(tmp_path))
+    db.add_documents([
+        Document(page_content=text, metadata={"source": f"doc{i}.txt", "chunk_id": f"c{i}", "filename": f"doc{i}.txt"})
+        for i, text in enumerate(TEXTS)
+    ])
+    engine = SimpleRAGEngine(db, use_openai=False)
+    questions = [{"question": "UARTで送信する方法", "id": "q1"}, {"question": "天気予報を教えて", "id": "q2"}]
+    
+    output, fallback_output = io.StringIO(), io.StringIO()
+    args = SimpleNamespace(batch_size=None, num_docs=3)
+    written, skipped = write_openai_batch(engine, questions, output, args, fallback_output)
+    
+    requests = [json.loads(line) for line in output.getvalue().splitlines()]
+    fallbacks = [json.loads(line) for line in fallback_output.getvalue().splitlines()]
+    assert (written, skipped) == (1, 1)
+    assert [request["custom_id"] for request in requests] == ["q1"]
+    assert [fallback["id"] for fallback in fallbacks] == ["q2"]
+    assert fallbacks[0]["answer"] == engine.no_context_answer("NUCLEO-F767ZI")["answer"]
+    assert fallbacks[0]["sources"] == []
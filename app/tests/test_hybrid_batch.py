@@ -0,0 +1,61 @@
+"""
+ハイブリッドストアの一括検索がクエリごとの検索（埋め込み検索 + 順位統合）と同じ結果になることの確認
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.schema import Document
+
+from models.simple_vector_db import SimpleVectorDatabase
+from models.hybrid_vector_db import HybridVectorDatabase
+from models.simple_rag_engine import SimpleRAGEngine
+
+TEXTS = [
+    "GPIOの出力設定でLEDを点灯させる",
+    "UARTで文字列を送信する方法",
+    "タイマー割り込みでLEDを点滅させる",
+    "ADCでアナログ電圧を読み取る",
+    "PWMでモーターの速度を制御する",
+    "DMAでUARTの受信データを転送する",
+]
+
+class ReversedSemanticStore:
+    """語彙側と異なる順位を返す埋め込み側の代用（登録順の逆順）"""
+    
+    def __init__(self, documents):
+        self.documents = documents
+    
+    def search_similar_documents(self, query, k=5, microcontroller=None, category=None, score_threshold=0.0):
+        return [(doc, 0.1 * rank) for rank, doc in enumerate(reversed(self.documents[:k]))]
+
+def make_hybrid(tmp_path):
+    documents = [
+        Document(page_content=text, metadata={"source": f"doc{i}.txt", "chunk_id": f"c{i}", "filename": f"doc{i}.txt"})
+        for i, text in enumerate(TEXTS)
+    ]
+    lexical_db = SimpleVectorDatabase(str(tmp_path))
+    lexical_db.add_documents([Document(page_content=d.page_content, metadata=dict(d.metadata)) for d in documents])
+    return HybridVectorDatabase(lexical_db, ReversedSemanticStore(documents), fusion="rrf")
+
+def keys(results):
+    return [(doc.metadata["chunk_id"], round(score, 9)) for doc, score in results]
+
+def test_batch_search_fuses_semantic_results(tmp_path):
+    hybrid = make_hybrid(tmp_path)
+    queries = ["LEDを点灯", "UARTの送信", "ADCの電圧"]
+    
+    batch = hybrid.search_similar_documents_batch(queries, k=4, score_threshold=0.0)
+    single = [hybrid.search_similar_documents(query, k=4, score_threshold=0.0) for query in queries]
+    lexical_only = [hybrid.lexical_db.search_similar_documents(query, k=4, score_threshold=0.0) for query in queries]
+    
+    assert [keys(result) for result in batch] == [keys(result) for result in single]
+    assert [keys(result) for result in batch] != [keys(result) for result in lexical_only]
+
+def test_engine_search_batch_matches_per_query_search(tmp_path):
+    engine = SimpleRAGEngine(make_hybrid(tmp_path), use_openai=False)
+    queries = ["LEDを点灯", "UARTの送信"]
+    
+    batch = engine.search_batch(queries, k=3, score_threshold=0.0)
+    single = [engine.vector_db.search_similar_documents(query, k=3, score_threshold=0.0) for query in queries]
+    assert [keys(result) for result in batch] == [keys(result) for result in single]
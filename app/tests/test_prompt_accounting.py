@@ -0,0 +1,68 @@
+"""
+テンプレート回答・キャッシュ済み回答のストリーミングではプロンプトを作成・計上しないことの確認
+"""
+import os
+import sys
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.schema import Document
+
+from config import Config
+from models.simple_vector_db import SimpleVectorDatabase
+from models.simple_rag_engine import SimpleRAGEngine
+
+TEXTS = [
+    "GPIOの出力設定でLEDを点灯させる",
+    "UARTで文字列を送信する方法",
+    "タイマー割り込みでLEDを点滅させる",
+    "ADCでアナログ電圧を読み取る",
+]
+
+class FakeCompletions:
+    """ストリーミング応答を返すOpenAIクライアントの代用"""
+    
+    def __init__(self):
+        self.calls = 0
+    
+    def create(self, **kwargs):
+        self.calls += 1
+        
+        def chunks():
+            for token in ["GPIOを", "出力に設定します。"]:
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))], usage=None)
+            yield SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=100, completion_tokens=2,
+                                                                    prompt_tokens_details=None))
+        return chunks()
+
+def make_engine(tmp_path, monkeypatch, openai: bool) -> SimpleRAGEngine:
+    monkeypatch.setattr(Config, "ANSWER_CACHE_PERSIST", False)
+    db = SimpleVectorDatabase(str(tmp_path))
+    db.add_documents([
+        Document(page_content=text, metadata={"source": f"doc{i}.txt", "chunk_id": f"c{i}", "filename": f"doc{i}.txt"})
+        for i, text in enumerate(TEXTS)
+    ])
+    engine = SimpleRAGEngine(db, use_openai=False)
+    if openai:
+        engine.use_openai = True
+        engine.openai_client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+    return engine
+
+def test_template_stream_records_no_prompt_tokens(tmp_path, monkeypatch):
+    engine = make_engine(tmp_path, monkeypatch, openai=False)
+    
+    answer = engine.answer_question_stream("LEDを点灯させる方法")
+    code = engine.generate_code_stream("LEDを点灯させる")
+    assert "".join(answer["stream"]) and "".join(code["stream"])
+    assert list(engine.prompt_token_samples) == []
+
+def test_cached_stream_records_no_prompt_tokens(tmp_path, monkeypatch):
+    engine = make_engine(tmp_path, monkeypatch, openai=True)
+    
+    first = "".join(engine.answer_question_stream("LEDを点灯させる方法")["stream"])
+    assert len(engine.prompt_token_samples) == 1
+    
+    second = "".join(engine.answer_question_stream("LEDを点灯させる方法")["stream"])
+    assert second == first
+    assert engine.openai_client.chat.completions.calls == 1
+    assert len(engine.prompt_token_samples) == 1
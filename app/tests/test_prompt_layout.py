@@ -0,0 +1,26 @@
+"""
+システムプロンプト（固定の先頭部分）がプロンプトキャッシュの最小トークン数以上で、質問によって変わらないことの確認
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from models.prompt_layout import PromptLayout
+
+def test_system_prompts_reach_cacheable_prefix_length():
+    layout = PromptLayout()
+    for microcontroller in Config.SUPPORTED_MICROCONTROLLERS:
+        for kind in ("answer", "code"):
+            prompt = layout.system_prompt(kind, microcontroller)
+            assert layout.counter.count(prompt) >= Config.PROMPT_CACHE_MIN_PREFIX_TOKENS
+            assert microcontroller in prompt
+
+def test_question_and_context_only_change_the_last_message():
+    layout = PromptLayout()
+    first = layout.answer_messages("NUCLEO-F767ZI", "LEDを点灯させる方法", "doc0.txt", "GPIOの出力設定")
+    second = layout.answer_messages("NUCLEO-F767ZI", "UARTで送信する方法", "doc1.txt", "USART3の設定")
+    
+    assert first[0] == second[0]
+    assert first[-1]["content"].endswith("GPIOの出力設定")
+    assert first[-1] != second[-1]
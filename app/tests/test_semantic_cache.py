@@ -0,0 +1,51 @@
+"""
+類似質問キャッシュが否定の異なる質問や内容語の異なる短い質問を同じ質問とみなさないことの確認
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.query_cache import NEGATION_TERM, SemanticAnswerCache, question_terms
+
+SCOPE = ("STM32F4",)
+
+def test_question_terms_keep_negation():
+    assert NEGATION_TERM not in question_terms("LEDを点灯させる方法")
+    assert NEGATION_TERM in question_terms("LEDを点灯させない方法")
+    assert NEGATION_TERM in question_terms("割り込みを使わずにLEDを点灯させる")
+    assert NEGATION_TERM in question_terms("LEDが点灯しません")
+
+def test_negated_paraphrase_does_not_hit():
+    cache = SemanticAnswerCache(threshold=0.9)
+    cache.set("LEDを点灯させる方法", SCOPE, "answer")
+    
+    assert cache.get("LEDを点灯させない方法", SCOPE) is None
+    assert cache.get("LEDを点灯させる方法は？", SCOPE)[0] == "answer"
+
+def test_short_question_requires_same_content_terms():
+    cache = SemanticAnswerCache(threshold=0.5)
+    cache.set("LEDを点灯させる方法", SCOPE, "answer")
+    
+    # 内容語の一部が一致しても、短い質問では別の質問
+    assert cache.get("LEDを点滅させる方法", SCOPE) is None
+    assert cache.get("LEDを点灯させるには", SCOPE)[0] == "answer"
+
+def test_embedding_similarity_still_checks_negation():
+    # 埋め込みモデルが否定を区別しない場合でも否定の有無で一致としない
+    cache = SemanticAnswerCache(threshold=0.9, embed=lambda question: [1.0, 0.0])
+    cache.set("UARTで文字列を送信する方法", SCOPE, "answer")
+    
+    assert cache.get("UARTで文字列を送信しない方法", SCOPE) is None
+    value, similarity, question = cache.get("UARTで文字列を送信するやり方", SCOPE)
+    assert (value, question) == ("answer", "UARTで文字列を送信する方法")
+    assert cache.stats()["similarity"] == "embedding"
+
+def test_embedding_failure_falls_back_to_content_terms():
+    def broken_embed(question):
+        raise OSError("model not found")
+    
+    cache = SemanticAnswerCache(threshold=0.9, embed=broken_embed)
+    cache.set("UARTで文字列を送信する方法", SCOPE, "answer")
+    
+    assert cache.get("UARTで文字列を送信するやり方", SCOPE)[0] == "answer"
+    assert cache.stats()["similarity"] == "content_terms"
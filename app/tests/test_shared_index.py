@@ -0,0 +1,63 @@
+"""
+プロセス内で共有するベクトルデータベースの確認
+（初期化タスクはプロセスで1回だけ、削除による再構築中の検索は途中の状態を見ない）
+"""
+import os
+import sys
+import time
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.schema import Document
+
+from models.simple_vector_db import SimpleVectorDatabase
+from models.vector_db_registry import SharedIndexRegistry
+
+def test_run_once_runs_task_once_across_sessions(tmp_path):
+    registry = SharedIndexRegistry()
+    calls = []
+    
+    def bootstrap():
+        time.sleep(0.1)
+        calls.append(threading.get_ident())
+    
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(registry.run_once("bootstrap", bootstrap, str(tmp_path))))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert len(calls) == 1
+    assert sorted(results) == [False, False, False, True]
+    assert registry.run_once("bootstrap", bootstrap, str(tmp_path)) is False
+
+def test_search_waits_for_delete_rebuild(tmp_path):
+    db = SimpleVectorDatabase(str(tmp_path))
+    texts = ["GPIO LED 点灯", "UART 送信", "GPIO 割り込み", "ADC 電圧"]
+    db.add_documents([
+        Document(page_content=f"{texts[i % 4]} {i}", metadata={"source": "keep.txt" if i % 2 else "drop.txt"})
+        for i in range(20)
+    ])
+    
+    # 削除処理がインデックスを空にした直後で止まるようにする
+    rebuilding = threading.Event()
+    reset_index_state = db._reset_index_state
+    
+    def slow_reset():
+        reset_index_state()
+        rebuilding.set()
+        time.sleep(0.2)
+    db._reset_index_state = slow_reset
+    
+    deleter = threading.Thread(target=db.delete_documents_by_source, args=(["drop.txt"],))
+    deleter.start()
+    rebuilding.wait(5)
+    results = db.search_similar_documents("UART 送信", k=5, score_threshold=0.0)
+    deleter.join()
+    
+    assert results
+    assert all(doc.metadata["source"] == "keep.txt" for doc, _ in results)
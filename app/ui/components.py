@@ -303,6 +303,16 @@ def render_performance_metrics(metrics: Dict):
         with col3:
             if "confidence" in metrics:
                 st.metric("信頼度", f"{metrics['confidence']:.1%}")
+        
+        if metrics.get("time_to_first_token") is not None:
+            col4, col5 = st.columns(2)
+            
+            with col4:
+                st.metric("最初の応答までの時間", f"{metrics['time_to_first_token'] * 1000:,.0f} ms")
+            
+            with col5:
+                if metrics.get("total_time") is not None:
+                    st.metric("生成完了までの時間", f"{metrics['total_time']:.1f} 秒")
 
 def render_error_message(error: str):
     """エラーメッセージを表示"""